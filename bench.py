@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark dei percorsi caldi del bot, senza Discord né GitHub:
+
+    python3 bench.py [--sizes 100,1000,10000] [--repeat 20] [--json]
+
+Usa un finto strato Discord in memoria (server, canale, messaggio, reazione
+paginata come l'API) e un finto Gist HTTP locale (aiohttp) raggiunto tramite
+GIST_API_BASE, così il salvataggio passa dallo stesso client HTTP di main.py.
+Per ogni dimensione stampa latenza (media/p50/p95) e throughput.
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import random
+import bisect
+import socket
+import asyncio
+import argparse
+import tempfile
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+# prima di importare main: niente journal su disco, file di stato in una cartella
+# temporanea rimossa all'uscita
+os.environ.setdefault("JOURNAL_ENABLED", "false")
+if "STATE_DIR" not in os.environ:
+    _STATE_TMP = tempfile.TemporaryDirectory(prefix="imperivm-bench-")
+    os.environ["STATE_DIR"] = _STATE_TMP.name
+
+import discord
+from aiohttp import web
+
+import main
+
+# ---------- Finto Discord ----------
+
+class FakeUser:
+    __slots__ = ("id", "bot", "display_name", "mention")
+
+    def __init__(self, uid: int, bot: bool = False):
+        self.id = uid
+        self.bot = bot
+        self.display_name = f"Cittadino{uid}"
+        self.mention = f"<@{uid}>"
+
+class FakeReaction:
+    """
+    Reazione ✅ che pagina come discord.Reaction.users() (2.3.x): richieste da
+    al massimo 100 utenti con after=ID, ogni pagina restituita al contrario
+    (ID decrescenti). `requests` conta le chiamate HTTP equivalenti.
+    """
+
+    emoji = "✅"
+
+    def __init__(self, users: List[FakeUser], page_latency: float = 0.0):
+        self._users = sorted(users, key=lambda u: u.id)
+        self._ids = [u.id for u in self._users]
+        self.count = len(users)
+        self.page_latency = page_latency
+        self.requests = 0
+
+    def users(self, limit: Optional[int] = None, after=None):
+        if limit is None:
+            limit = self.count
+
+        async def gen():
+            nonlocal limit, after
+            while limit > 0:
+                start = bisect.bisect_right(self._ids, after.id) if after is not None else 0
+                data = self._users[start:start + min(limit, 100)]
+                self.requests += 1
+                if self.page_latency:
+                    await asyncio.sleep(self.page_latency)
+                if not data:
+                    return
+                limit -= len(data)
+                after = data[-1]
+                for u in reversed(data):
+                    yield u
+        return gen()
+
+class FakeMessage:
+    def __init__(self, mid: int, embeds=None):
+        self.id = mid
+        self.embeds = embeds or []
+        self.reactions: List[FakeReaction] = []
+
+class FakeChannel:
+    def __init__(self, cid: int = 1):
+        self.id = cid
+        self.messages: Dict[int, FakeMessage] = {}
+        self.sent = 0
+        self._next_id = 10 ** 17
+
+    async def send(self, content=None, embed=None, embeds=None, **kwargs) -> FakeMessage:
+        self._next_id += 1
+        self.sent += 1
+        msg = FakeMessage(self._next_id, embeds or ([embed] if embed else []))
+        self.messages[msg.id] = msg
+        return msg
+
+    async def fetch_message(self, mid: int) -> FakeMessage:
+        if mid not in self.messages:
+            raise LookupError(mid)
+        return self.messages[mid]
+
+class FakeGuild:
+    def __init__(self, gid: int = 1):
+        self.id = gid
+        self.text_channels = [FakeChannel()]
+        self.members: Dict[int, FakeUser] = {}
+
+    def get_channel(self, cid: int):
+        return next((c for c in self.text_channels if c.id == cid), None)
+
+    def get_member(self, uid: int):
+        return self.members.get(uid)
+
+# ---------- Finto Gist ----------
+
+class FakeGist:
+    """GET/PATCH /gists/{id} in memoria, con latenza opzionale per simulare la rete."""
+
+    def __init__(self, latency: float = 0.0):
+        self.files: Dict[str, Dict] = {}
+        self.latency = latency
+        self.requests = 0
+        self.bytes_in = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _get(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response({"id": request.match_info["gid"], "files": self.files})
+
+    async def _patch(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        body = await request.read()
+        self.bytes_in += len(body)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        for name, f in json.loads(body).get("files", {}).items():
+            self.files[name] = {"filename": name, "content": f.get("content", "")}
+        return web.json_response({"id": request.match_info["gid"], "files": {}})
+
+    async def start(self) -> str:
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_get("/gists/{gid}", self._get)
+        app.router.add_patch("/gists/{gid}", self._patch)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        await web.TCPSite(self._runner, "127.0.0.1", port).start()
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+# ---------- Misure ----------
+
+def _percentile(vals: List[float], q: float) -> float:
+    return vals[min(len(vals) - 1, int(round(q * (len(vals) - 1))))]
+
+async def measure(name: str, n: int, repeat: int, fn, setup=None) -> Dict:
+    """Esegue fn() `repeat` volte (setup() prima di ognuna, fuori dal tempo)."""
+    times: List[float] = []
+    for _ in range(repeat):
+        if setup is not None:
+            res = setup()
+            if asyncio.iscoroutine(res):
+                await res
+        t0 = time.perf_counter()
+        res = fn()
+        if asyncio.iscoroutine(res):
+            await res
+        times.append(time.perf_counter() - t0)
+    times.sort()
+    mean = sum(times) / len(times)
+    row = {
+        "bench": name,
+        "n": n,
+        "mean_ms": round(mean * 1000, 3),
+        "p50_ms": round(_percentile(times, 0.50) * 1000, 3),
+        "p95_ms": round(_percentile(times, 0.95) * 1000, 3),
+        "ops_s": round(1.0 / mean, 1) if mean else 0.0,
+    }
+    print(f"{name:<28} n={n:<7} media {row['mean_ms']:>9} ms  p50 {row['p50_ms']:>9} ms  "
+          f"p95 {row['p95_ms']:>9} ms  {row['ops_s']:>9} op/s")
+    return row
+
+def populate(n: int, seed: int) -> List[int]:
+    """STATE nuovo con n utenti registrati (livelli, vittorie e ultime vittorie casuali)."""
+    rnd = random.Random(seed)
+    main.STATE = main.StateDict(main._normalize_state(copy.deepcopy(main.DEFAULT_STATE)))
+    now = int(time.time())
+    # ID distribuiti come account reali (2016 → oggi): le partizioni della scansione parallela lavorano davvero
+    lo = discord.utils.time_snowflake(datetime(2016, 1, 1, tzinfo=timezone.utc))
+    hi = discord.utils.time_snowflake(datetime.now(timezone.utc))
+    uids = rnd.sample(range(lo, hi), n)
+    for uid in uids:
+        rec = main.STATE.players.ensure(uid)
+        rec.level = rnd.randint(1, 3)
+        rec.victories = rnd.randint(0, 20)
+        rec.cycles = rec.victories // 3
+        rec.last_win = now - rnd.randint(0, 60) * 86400 if rec.victories else None
+        rec.name = f"Cittadino{uid}"
+        main.STATE.players.changed(rec, *main.USER_KEYS)
+    main.STATE.take_changes()
+    return uids
+
+async def open_lottery_message(guild: FakeGuild, uids: List[int], page_latency: float) -> FakeMessage:
+    """Apertura dal percorso del bot; poi i ✅ arrivano come eventi reazione (bot compreso)."""
+    msg = await main.post_open_message(guild.text_channels[0], False, main.default_lottery())
+    users = [FakeUser(u) for u in uids] + [FakeUser(1, bot=True)]
+    msg.reactions.append(FakeReaction(users, page_latency))
+    for u in users:
+        main.track_entrant(msg.id, u.id, u.bot, added=True)
+    return msg
+
+async def bench_size(n: int, args, gist: FakeGist) -> List[Dict]:
+    rows: List[Dict] = []
+    uids = populate(n, args.seed)
+    guild = FakeGuild()
+    for uid in uids[:200]:
+        guild.members[uid] = FakeUser(uid)
+    msg = await open_lottery_message(guild, uids, args.page_latency / 1000.0)
+    lot = main.default_lottery()
+    verified_key = (main.CURRENT_GUILD.get(), lot.id)
+
+    # partecipanti: set tracciato (caso normale) e riconciliazione completa via API,
+    # forzata come dopo una nuova sessione gateway (la scansione poi lo riallinea)
+    rows.append(await measure("collect_participants/live", n, args.repeat,
+                              lambda: main.collect_participants(msg, lot)))
+    rows.append(await measure("collect_participants/scan", n, max(1, args.repeat // 4),
+                              lambda: main.collect_participants(msg, lot),
+                              setup=lambda: main._ENTRANTS_VERIFIED.discard(verified_key)))
+
+    # scansione completa dei reattori: sequenziale contro partizioni parallele (chiamate HTTP per scansione)
+    reaction = msg.reactions[0]
+    reps = max(1, args.repeat // 4)
+    for label, scan in (("stream_reactors", main.stream_reactors), ("stream_reactors_parallel", main.stream_reactors_parallel)):
+        reaction.requests = 0
+        row = await measure(label, n, reps, lambda scan=scan: scan(reaction))
+        row["http_calls"] = reaction.requests // reps
+        print(f"{'':<28} {row['http_calls']} chiamate HTTP per scansione")
+        rows.append(row)
+
+    # estrazione pesata, con entrambi i motori quando NumPy è disponibile
+    engines = ["python"] + (["numpy"] if main.np is not None else [])
+    for engine in engines:
+        main.DRAW_ENGINE = engine
+        rows.append(await measure(f"weighted_pick/{engine}", n, args.repeat,
+                                  lambda: main.weighted_pick(uids, main.MOD_AGI)))
+        rows.append(await measure(f"weighted_sample k=2/{engine}", n, args.repeat,
+                                  lambda: main.weighted_sample(uids, 2, None)))
+    main.DRAW_ENGINE = os.getenv("DRAW_ENGINE", "auto").strip().lower()
+
+    # chiusura completa (fetch messaggio, partecipanti, anteprima nomi, estrazione, livelli)
+    rows.append(await measure("_close_and_pick_common", n, args.repeat,
+                              lambda: main._close_and_pick_common(guild, special=False, lot=lot)))
+
+    # stato: serializzazione, salvataggio sul finto Gist, caricamento
+    rows.append(await measure("STATE.serialize", n, args.repeat, main.STATE.serialize))
+
+    def touch():
+        main.set_level(rnd.choice(uids), rnd.randint(1, 3))
+        main.STATE["edition"] = int(main.STATE.get("edition") or 1) + 1
+
+    rnd = random.Random(args.seed)
+    rows.append(await measure("GistBackend.save", n, args.repeat,
+                              lambda: main.BACKEND.save(main.STATE), setup=touch))
+    rows.append(await measure("load_state_from_gist", n, max(1, args.repeat // 4),
+                              main.load_state_from_gist))
+
+    # classifica livelli: prima pagina dall'indice e ordinamento completo di confronto
+    main.STATE.players._index = None
+    rows.append(await measure("leaderboard/build+top20", n, max(1, args.repeat // 4),
+                              lambda: main.STATE.players.leaderboard(0, 20),
+                              setup=lambda: setattr(main.STATE.players, "_index", None)))
+    rows.append(await measure("leaderboard/top20", n, args.repeat,
+                              lambda: main.STATE.players.leaderboard(0, 20)))
+    rows.append(await measure("leaderboard/full sort", n, args.repeat,
+                              lambda: sorted(main.STATE.players.registered(),
+                                             key=lambda r: (-r.level, -r.victories, -r.cycles, r.uid))[:20]))
+    return rows
+
+async def run(args) -> List[Dict]:
+    gist = FakeGist(args.gist_latency / 1000.0)
+    main.GIST_API_BASE = await gist.start()
+    main.GIST_ID = "bench"
+    rows: List[Dict] = []
+    try:
+        for n in args.sizes:
+            print(f"--- {n} utenti ---")
+            rows.extend(await bench_size(n, args, gist))
+    finally:
+        await main.stop_persistence()
+        await gist.stop()
+    print(f"Finto Gist: {gist.requests} richieste, {gist.bytes_in / 1e6:.1f} MB ricevuti")
+    return rows
+
+def main_cli(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="bench.py", description="Benchmark dei percorsi caldi del bot.")
+    parser.add_argument("--sizes", default="100,1000,10000",
+                        type=lambda s: [int(x) for x in s.split(",") if x.strip()],
+                        help="popolazioni da misurare (default 100,1000,10000)")
+    parser.add_argument("--repeat", type=int, default=20, help="ripetizioni per misura (default 20)")
+    parser.add_argument("--page-latency", type=float, default=0.0, help="ms per pagina di reattori (default 0)")
+    parser.add_argument("--gist-latency", type=float, default=0.0, help="ms per richiesta al finto Gist (default 0)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", metavar="FILE", help="salva i risultati in JSON")
+    args = parser.parse_args(argv)
+    if args.repeat < 1 or not args.sizes:
+        parser.error("servono --repeat >= 1 e almeno una dimensione")
+
+    rows = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(rows, fh, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli(sys.argv[1:]))
@@ -11,19 +11,40 @@
 # Dopo un annuncio SPECIALE automatico, la modalità torna automaticamente a CLASSICA.
 
 import os
+import sys
+import copy
 import json
+import argparse
+import math
+import heapq
+import bisect
+import sqlite3
+import hashlib
 import random
+import string
+import functools
+import itertools
+import inspect
 import time
 import asyncio
-from datetime import datetime
+import queue
+import atexit
+import threading
+import traceback
+import contextlib
+import contextvars
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
 from typing import Optional, List, Dict, Tuple
 
-import urllib.request
-import urllib.error
-
+import aiohttp
 import pytz
+try:
+    import numpy as np
+except ImportError:  # opzionale: senza NumPy si usa il motore di estrazione in puro Python
+    np = None
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 from discord import app_commands
 
 # ---------- Config ----------
@@ -34,8 +55,6 @@ INTENTS.members = True
 INTENTS.reactions = True
 
 TOKEN = os.getenv("DISCORD_TOKEN")
-if not TOKEN:
-    raise RuntimeError("❌ Manca DISCORD_TOKEN nelle variabili ambiente.")
 
 LOTTERY_CHANNEL_ID = int(os.getenv("LOTTERY_CHANNEL_ID", "0"))
 
@@ -48,13 +67,56 @@ if _env_admins:
         ADMIN_IDS = set()
 
 TZ = pytz.timezone(os.getenv("TZ", "Europe/Rome"))
+
+# Motore di estrazione: "auto" (NumPy se installato e i partecipanti sono almeno
+# DRAW_NUMPY_MIN), "numpy" oppure "python"
+DRAW_ENGINE = os.getenv("DRAW_ENGINE", "auto").strip().lower()
+DRAW_NUMPY_MIN = int(os.getenv("DRAW_NUMPY_MIN", "64"))
+# Al primo avvio (nessun orario salvato) recupera gli eventi degli ultimi N minuti
 AUTO_WINDOW_MINUTES = int(os.getenv("AUTO_WINDOW_MINUTES", "10"))
 
 # Sync slash opzionale (solo se vuoi forzare sync al boot)
 SYNC_ON_START = os.getenv("SYNC_ON_START", "false").strip().lower() in {"1", "true", "yes", "on"}
 SYNC_GUILD_ID = int(os.getenv("SYNC_GUILD_ID", "0"))
 
-# Debounce salvataggi Gist
+# Calendario lotterie: JSON (lista di definizioni) in LOTTERIES oppure nel file
+# LOTTERIES_FILE. La lotteria settimanale "weekly" esiste sempre (si può
+# ridefinire con lo stesso id). Esempio di lotteria flash giornaliera:
+# [{"id": "flash", "name": "Flash", "open": "0 18 * * *", "close": "0 22 * * *",
+#   "announce": "5 22 * * *", "mode": "special", "period": "day"}]
+LOTTERIES_JSON = os.getenv("LOTTERIES", "").strip()
+LOTTERIES_FILE = os.getenv("LOTTERIES_FILE", "").strip()
+
+# Testi del bot: lingua (BOT_LOCALE) e file JSON opzionale con testi
+# aggiuntivi o sostitutivi, nella forma {"it": {"open.title": "..."}}
+BOT_LOCALE = os.getenv("BOT_LOCALE", "it").strip() or "it"
+MESSAGES_FILE = os.getenv("MESSAGES_FILE", "").strip()
+
+# Multi-server: il server "home" (HOME_GUILD_ID, altrimenti SYNC_GUILD_ID o il
+# primo server visto, poi memorizzato) usa le chiavi top-level dello stato; gli
+# altri server hanno un proprio namespace in STATE["guilds"], registro utenti
+# e nomi inclusi. Gli eventi automatici girano su al massimo GUILD_CONCURRENCY server alla volta.
+HOME_GUILD_ID = int(os.getenv("HOME_GUILD_ID", "0"))
+GUILD_CONCURRENCY = max(1, int(os.getenv("GUILD_CONCURRENCY", "8")))
+# Automazione nei server non-home appena aggiunti (default spenta: si attiva con /automazione)
+GUILD_AUTOMATION_DEFAULT = os.getenv("GUILD_AUTOMATION_DEFAULT", "false").strip().lower() in {"1", "true", "yes", "on"}
+# AutoShardedBot per molti server in un solo processo
+BOT_SHARDED = os.getenv("BOT_SHARDED", "false").strip().lower() in {"1", "true", "yes", "on"}
+
+# Numero massimo di vincitori per edizione impostabile con /vincitori
+MAX_WINNERS = 10
+
+# Riconciliazione partecipanti: oltre RECONCILE_PARALLEL_MIN reazioni lo spazio
+# degli ID viene diviso in intervalli letti in parallelo (al massimo
+# RECONCILE_CONCURRENCY richieste alla volta)
+RECONCILE_PARALLEL_MIN = int(os.getenv("RECONCILE_PARALLEL_MIN", "1000"))
+RECONCILE_CONCURRENCY = max(1, int(os.getenv("RECONCILE_CONCURRENCY", "4")))
+
+# Cache LRU dei nomi visualizzati (voci massime)
+NAME_CACHE_SIZE = max(1, int(os.getenv("NAME_CACHE_SIZE", "5000")))
+
+# Finestra di coalescenza salvataggi Gist (secondi): le modifiche di un burst
+# finiscono in un solo PATCH, sempre seguito da un flush finale
 GIST_SAVE_MIN_INTERVAL = float(os.getenv("GIST_SAVE_MIN_INTERVAL", "2.0"))
 
 # Colori
@@ -64,15 +126,270 @@ COLOR_AGI = discord.Color.from_str("#27AE60")
 COLOR_CHA = discord.Color.from_str("#2980B9")
 COLOR_STR = discord.Color.from_str("#8E5A2B")
 
-# Gist
+# Gist (GIST_API_BASE: API compatibile, es. GitHub Enterprise o il finto Gist di bench.py)
+GIST_API_BASE = (os.getenv("GIST_API_BASE") or "https://api.github.com").rstrip("/")
 GIST_ID = os.getenv("GIST_ID") or ""
 GIST_FILENAME = os.getenv("GIST_FILENAME") or "imperivm_state.json"
 GIST_TOKEN = os.getenv("GIST_TOKEN") or ""
+GIST_HTTP_TIMEOUT = float(os.getenv("GIST_HTTP_TIMEOUT", "20"))
+GIST_MAX_RETRIES = int(os.getenv("GIST_MAX_RETRIES", "4"))
+GIST_RETRY_BASE_DELAY = float(os.getenv("GIST_RETRY_BASE_DELAY", "1.0"))
+
+# Journal locale (write-ahead): ogni mutazione di STATE è scritta subito su disco,
+# il Gist riceve uno snapshot compatto ogni GIST_SNAPSHOT_INTERVAL secondi
+JOURNAL_ENABLED = os.getenv("JOURNAL_ENABLED", "true").strip().lower() in {"1", "true", "yes", "on"}
+STATE_DIR = os.getenv("STATE_DIR", ".")
+JOURNAL_PATH = os.getenv("JOURNAL_PATH") or os.path.join(STATE_DIR, "imperivm_journal.jsonl")
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH") or os.path.join(STATE_DIR, "imperivm_snapshot.json")
+GIST_SNAPSHOT_INTERVAL = float(os.getenv("GIST_SNAPSHOT_INTERVAL", "60"))
+
+# Backend di persistenza: "gist" (default) oppure "sqlite" (registri grandi)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "gist").strip().lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH") or os.path.join(STATE_DIR, "imperivm_state.sqlite3")
+
+# ---------- Metriche ----------
+
+# Endpoint HTTP in formato Prometheus (/metrics) servito da waitress in un
+# thread a parte, sulla porta METRICS_PORT (o PORT, quella del web service
+# Render). Le metriche sono aggiornate dal loop del bot e lette dal thread
+# HTTP: ogni accesso passa da _METRICS_LOCK.
+
+_METRICS_LOCK = threading.Lock()
+_METRICS: List = []
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = (1_000, 10_000, 100_000, 500_000, 1_000_000, 5_000_000, 20_000_000)
+PAGES_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    parts = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = ()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self.values: Dict[Tuple, float] = {}
+        _METRICS.append(self)
+
+    def inc(self, *labelvalues, amount: float = 1.0):
+        with _METRICS_LOCK:
+            self.values[labelvalues] = self.values.get(labelvalues, 0.0) + amount
+
+    def expose(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for lv, v in sorted(self.values.items()):
+            out.append(f"{self.name}{_fmt_labels(self.labels, lv)} {v}")
+        return out
+
+class Histogram:
+    def __init__(self, name: str, doc: str, buckets: Tuple[float, ...], labels: Tuple[str, ...] = ()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self.buckets = tuple(sorted(buckets))
+        # per serie: conteggi per bucket (non cumulativi), poi somma e totale
+        self.series: Dict[Tuple, List[float]] = {}
+        _METRICS.append(self)
+
+    def observe(self, value: float, *labelvalues):
+        i = bisect.bisect_left(self.buckets, value)
+        with _METRICS_LOCK:
+            s = self.series.get(labelvalues)
+            if s is None:
+                s = self.series[labelvalues] = [0] * len(self.buckets) + [0.0, 0]
+            if i < len(self.buckets):
+                s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, *labelvalues):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *labelvalues)
+
+    def expose(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for lv, s in sorted(self.series.items()):
+            cum = 0
+            for b, c in zip(self.buckets, s):
+                cum += c
+                le = f'le="{b}"'
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, lv, le)} {cum}")
+            le = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_fmt_labels(self.labels, lv, le)} {s[-1]}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, lv)} {s[-2]}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, lv)} {s[-1]}")
+        return out
+
+def render_metrics() -> str:
+    with _METRICS_LOCK:
+        lines = [line for m in _METRICS for line in m.expose()]
+    return "\n".join(lines) + "\n"
+
+GIST_SECONDS = Histogram("imperivm_gist_seconds", "Durata di load/save Gist (retry inclusi).", LATENCY_BUCKETS, ("op",))
+GIST_BYTES = Histogram("imperivm_gist_payload_bytes", "Dimensione dei contenuti letti/scritti sul Gist.", BYTES_BUCKETS, ("op",))
+COLLECT_SECONDS = Histogram("imperivm_collect_participants_seconds", "Raccolta partecipanti alla chiusura.", LATENCY_BUCKETS, ("path",))
+REACTOR_PAGES = Histogram("imperivm_reactor_scan_pages", "Pagine di reattori lette per scansione completa.", PAGES_BUCKETS)
+DRAW_SECONDS = Histogram("imperivm_draw_seconds", "Durata di un'estrazione pesata.", LATENCY_BUCKETS, ("engine",))
+LOTTERY_SECONDS = Histogram("imperivm_lottery_event_seconds", "Durata di apertura/chiusura/annuncio.", LATENCY_BUCKETS, ("event",))
+SCHEDULER_LAG = Histogram("imperivm_scheduler_lag_seconds", "Ritardo tra orario previsto ed esecuzione degli eventi automatici.", LATENCY_BUCKETS)
+LOOP_LAG = Histogram("imperivm_event_loop_lag_seconds", "Ritardo del loop asyncio rispetto a un timer periodico.", LATENCY_BUCKETS)
+SAVE_REQUESTS = Counter("imperivm_save_requests_total", "Chiamate a save_state per esito (scheduled/coalesced/deferred).", ("outcome",))
+STATE_FLUSHES = Counter("imperivm_state_flush_total", "Scritture del backend di stato per esito.", ("result",))
+GIST_UNCHANGED = Counter("imperivm_gist_save_unchanged_total", "Salvataggi Gist saltati perché il contenuto non era cambiato.")
+
+METRICS_PORT = int(os.getenv("METRICS_PORT") or os.getenv("PORT") or 0)
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+
+_METRICS_THREAD: Optional[threading.Thread] = None
+_LOOP_LAG_TASK: Optional[asyncio.Task] = None
+
+def start_metrics_server() -> bool:
+    """Avvia /metrics (e / come health check) in un thread daemon. Idempotente."""
+    global _METRICS_THREAD
+    if not METRICS_PORT or _METRICS_THREAD is not None:
+        return _METRICS_THREAD is not None
+    try:
+        from flask import Flask, Response
+        from waitress import serve
+    except ImportError as e:
+        print("[METRICS] Flask/waitress non disponibili, endpoint disattivato:", e)
+        return False
+
+    app = Flask("imperivm-metrics")
+
+    @app.get("/")
+    def health():
+        return Response("IMPERIVM Lottery Bot attivo\n", mimetype="text/plain")
+
+    @app.get("/metrics")
+    def metrics():
+        return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+    _METRICS_THREAD = threading.Thread(
+        target=serve, args=(app,), kwargs={"host": METRICS_HOST, "port": METRICS_PORT, "threads": 2},
+        name="metrics-http", daemon=True,
+    )
+    _METRICS_THREAD.start()
+    print(f"[METRICS] Endpoint su http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return True
+
+# ---------- Watchdog loop ----------
+
+# Il probe sul loop dorme LOOP_LAG_INTERVAL e pubblica l'istante in cui
+# dovrebbe risvegliarsi. Un thread di guardia controlla quell'istante: se il
+# loop è in ritardo di oltre LOOP_BLOCK_THRESHOLD, fotografa lo stack del
+# thread del loop (sys._current_frames) mentre è ancora bloccato. Al risveglio
+# il probe completa il campione con la durata reale e lo scrive nei log.
+
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.25"))
+LOOP_BLOCK_SAMPLES = int(os.getenv("LOOP_BLOCK_SAMPLES", "20"))
+_STACK_DEPTH = 12
+
+class LoopBlock:
+    """Un blocco del loop: quando, quanto, quale task e lo stack catturato durante il blocco."""
+    __slots__ = ("ts", "blocked", "task", "stack")
+
+    def __init__(self, ts: float, blocked: float, task: str, stack: List[str]):
+        self.ts = ts
+        self.blocked = blocked
+        self.task = task
+        self.stack = stack
+
+_WATCHDOG_LOCK = threading.Lock()
+_LOOP_DEADLINE: Optional[float] = None        # time.monotonic() del prossimo risveglio atteso
+_LOOP_PENDING: Optional[LoopBlock] = None     # campione del blocco in corso (dal thread di guardia)
+LOOP_BLOCKS: "deque[LoopBlock]" = deque(maxlen=LOOP_BLOCK_SAMPLES)
+LOOP_RECENT_LAGS: "deque[float]" = deque(maxlen=600)   # ~5 minuti con l'intervallo di default
+_WATCHDOG_THREAD: Optional[threading.Thread] = None
+
+def _format_stack(frame) -> List[str]:
+    out = []
+    for fs in traceback.extract_stack(frame)[-_STACK_DEPTH:]:
+        out.append(f"{os.path.basename(fs.filename)}:{fs.lineno} {fs.name}")
+    return out
+
+def _watchdog(loop: asyncio.AbstractEventLoop, loop_thread: int):
+    global _LOOP_PENDING
+    poll = max(0.01, LOOP_BLOCK_THRESHOLD / 4)
+    while not loop.is_closed():
+        time.sleep(poll)
+        deadline = _LOOP_DEADLINE
+        if deadline is None or _LOOP_PENDING is not None:
+            continue
+        late = time.monotonic() - deadline
+        if late < LOOP_BLOCK_THRESHOLD:
+            continue
+        frame = sys._current_frames().get(loop_thread)
+        if frame is None:
+            continue
+        task = "?"
+        try:
+            current = asyncio.current_task(loop)
+            if current is not None:
+                task = f"{current.get_name()} ({getattr(current.get_coro(), '__qualname__', '?')})"
+        except RuntimeError:
+            pass
+        with _WATCHDOG_LOCK:
+            if _LOOP_DEADLINE == deadline:
+                _LOOP_PENDING = LoopBlock(time.time(), late, task, _format_stack(frame))
+        del frame
+
+def _finish_block(lag: float):
+    """Chiude il campione del blocco appena terminato (dal loop, al risveglio)."""
+    global _LOOP_PENDING
+    with _WATCHDOG_LOCK:
+        block, _LOOP_PENDING = _LOOP_PENDING, None
+    if block is None:
+        return
+    block.blocked = lag
+    LOOP_BLOCKS.append(block)
+    where = " ← ".join(reversed(block.stack[-3:]))
+    print(f"[LOOP] Loop bloccato per {lag:.2f}s (task {block.task}): {where}")
+
+async def _loop_lag_probe():
+    """Misura di quanto arrivano in ritardo i risvegli di un timer: il tempo in cui il loop era bloccato."""
+    global _LOOP_DEADLINE
+    while True:
+        with _WATCHDOG_LOCK:
+            _LOOP_DEADLINE = time.monotonic() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.monotonic() - _LOOP_DEADLINE)
+        LOOP_LAG.observe(lag)
+        LOOP_RECENT_LAGS.append(lag)
+        _finish_block(lag)
+
+def start_loop_lag_probe():
+    """Avvia probe e thread di guardia sul loop corrente (idempotente)."""
+    global _LOOP_LAG_TASK, _WATCHDOG_THREAD
+    if _LOOP_LAG_TASK is None or _LOOP_LAG_TASK.done():
+        _LOOP_LAG_TASK = asyncio.create_task(_loop_lag_probe())
+    if LOOP_BLOCK_THRESHOLD > 0 and (_WATCHDOG_THREAD is None or not _WATCHDOG_THREAD.is_alive()):
+        _WATCHDOG_THREAD = threading.Thread(
+            target=_watchdog, args=(asyncio.get_running_loop(), threading.get_ident()),
+            name="loop-watchdog", daemon=True,
+        )
+        _WATCHDOG_THREAD.start()
+
+def loop_lag_summary() -> Dict[str, float]:
+    lags = sorted(LOOP_RECENT_LAGS)
+    if not lags:
+        return {"p50": 0.0, "p95": 0.0, "max": 0.0, "samples": 0}
+    return {
+        "p50": lags[len(lags) // 2],
+        "p95": lags[min(len(lags) - 1, int(len(lags) * 0.95))],
+        "max": lags[-1],
+        "samples": len(lags),
+    }
 
 # ---------- Gist / State ----------
 
 def _gist_api_url() -> str:
-    return f"https://api.github.com/gists/{GIST_ID}"
+    return f"{GIST_API_BASE}/gists/{GIST_ID}"
 
 def _gist_headers() -> Dict[str, str]:
     hdr = {"Accept": "application/vnd.github+json"}
@@ -80,19 +397,711 @@ def _gist_headers() -> Dict[str, str]:
         hdr["Authorization"] = f"Bearer {GIST_TOKEN}"
     return hdr
 
-STATE: Dict = {}
-_LAST_GIST_SAVE_TS = 0.0
+_SCALARS = (str, int, float, bool, type(None))
+
+def _same_scalar(a, b) -> bool:
+    return type(a) is type(b) and isinstance(a, _SCALARS) and a == b
+
+def _track(value, root: "StateDict", path: Tuple):
+    """Avvolge ricorsivamente i dict annidati perché segnalino le modifiche a `root`."""
+    if isinstance(value, dict):
+        return _TrackedDict(root, path, value)
+    return value
+
+_MISSING = object()
+
+_TXN_IDS = itertools.count(1)
+
+class StateTransaction:
+    """
+    Undo log di una transazione: prima della prima modifica di ogni percorso
+    (primi due livelli) e di ogni utente ne conserva una copia; rollback()
+    ripristina tutto in ordine inverso passando dai setter tracciati, così
+    journal e chiavi sporche vedono anche il ripristino.
+    Le mutazioni finiscono nel journal marcate con `id` e valgono solo se
+    seguite dalla riga di commit. `external` diventa True al primo messaggio
+    Discord inviato: da lì in poi non si annulla più nulla.
+    """
+    __slots__ = ("key", "id", "undo", "seen", "players", "save_pending", "save_force", "journaled", "external")
+
+    def __init__(self, key):
+        self.key = key
+        self.id = next(_TXN_IDS)
+        self.undo: List[Tuple[Tuple, object]] = []
+        self.seen: set = set()
+        self.players: Dict[Tuple[Optional[str], int], Optional[List]] = {}
+        self.save_pending = False
+        self.save_force = False
+        self.journaled = False
+        self.external = False
+
+    def capture(self, root: "StateDict", path: Tuple):
+        key = tuple(path[:2])
+        if key in self.seen:
+            return
+        self.seen.add(key)
+        target = root
+        for k in key:
+            target = dict.get(target, k, _MISSING) if isinstance(target, dict) else _MISSING
+            if target is _MISSING:
+                break
+        self.undo.append((key, copy.deepcopy(target) if target is not _MISSING else _MISSING))
+
+    def capture_player(self, scope: Optional[str], uid: int, rec: Optional["PlayerRecord"]):
+        if (scope, uid) not in self.players:
+            self.players[(scope, uid)] = rec.fields() if rec is not None else None
+
+    def rollback(self, root: "StateDict"):
+        for key, old in reversed(self.undo):
+            parent = root
+            for k in key[:-1]:
+                parent = parent.get(k) if isinstance(parent, dict) else None
+            if not isinstance(parent, dict):
+                continue
+            if old is _MISSING:
+                parent.pop(key[-1], None)
+            else:
+                parent[key[-1]] = old
+        for (scope, uid), fields in self.players.items():
+            table = root.players_for(scope)
+            if fields is None:
+                table.remove(uid)
+            else:
+                rec = table.ensure(uid)
+                rec.set_fields(fields)
+                table.changed(rec, *USER_KEYS)
+
+# Transazione attiva nel task corrente (vedi lottery_txn)
+_TXN: contextvars.ContextVar[Optional[StateTransaction]] = contextvars.ContextVar("STATE_TXN", default=None)
+
+class _TrackedDict(dict):
+    """
+    dict annidato dentro STATE: ogni modifica segna come "sporca" la chiave
+    top-level che lo contiene e finisce nel journal con il suo percorso.
+    Le liste NON sono tracciate (vanno riassegnate).
+    """
+    __slots__ = ("_root", "_path")
+
+    def __init__(self, root: "StateDict", path: Tuple, data: Dict):
+        super().__init__()
+        self._root = root
+        self._path = path
+        for k, v in data.items():
+            dict.__setitem__(self, k, _track(v, root, path + (k,)))
+
+    def __setitem__(self, k, v):
+        if k in self and _same_scalar(dict.__getitem__(self, k), v):
+            return
+        self._root._before_change(self._path + (k,))
+        dict.__setitem__(self, k, _track(v, self._root, self._path + (k,)))
+        self._root._changed("set", self._path + (k,), v)
+
+    def __delitem__(self, k):
+        self._root._before_change(self._path + (k,))
+        dict.__delitem__(self, k)
+        self._root._changed("del", self._path + (k,))
+
+    def pop(self, k, *default):
+        if k in self:
+            self._root._before_change(self._path + (k,))
+            self._root._changed("del", self._path + (k,))
+        return dict.pop(self, k, *default)
+
+    def popitem(self):
+        self._root._before_change(self._path)
+        k, v = dict.popitem(self)
+        self._root._changed("del", self._path + (k,))
+        return k, v
+
+    def setdefault(self, k, default=None):
+        if k not in self:
+            self[k] = default
+        return dict.__getitem__(self, k)
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def clear(self):
+        if self:
+            self._root._before_change(self._path)
+            dict.clear(self)
+            self._root._changed("set", self._path, {})
+
+    def __deepcopy__(self, memo):
+        return {k: copy.deepcopy(v, memo) for k, v in self.items()}
+
+# Chiavi per-utente dello schema JSON (mappe str(uid) -> valore).
+# In memoria vivono in STATE.players (un PlayerRecord per utente); gli altri
+# server hanno le stesse mappe nel proprio namespace e un registro a parte.
+USER_KEYS = ("wins", "victories", "cycles", "last_win_ts", "names")
+# Vecchie chiavi per-utente: lette al caricamento e convertite, mai più scritte
+LEGACY_USER_KEYS = ("last_win_iso",)
+
+def _epoch_from_iso(iso) -> Optional[int]:
+    try:
+        dt = datetime.fromisoformat(iso)
+    except (TypeError, ValueError):
+        return None
+    if dt.tzinfo is None:
+        dt = TZ.localize(dt)
+    return int(dt.timestamp())
+
+class PlayerRecord:
+    """Dati di un utente: sostituisce le cinque mappe parallele indicizzate per str(uid)."""
+    __slots__ = ("uid", "level", "victories", "cycles", "last_win", "name")
+
+    def __init__(self, uid: int):
+        self.uid = uid
+        self.level: Optional[int] = None      # None = non registrato nei livelli
+        self.victories = 0
+        self.cycles = 0
+        self.last_win: Optional[int] = None   # epoch (secondi) dell'ultima vittoria
+        self.name: Optional[str] = None
+
+    def fields(self) -> List:
+        return [self.level, self.victories, self.cycles, self.last_win, self.name]
+
+    def set_fields(self, values: List):
+        self.level, self.victories, self.cycles, self.last_win, self.name = values
+        if self.level is not None:
+            self.level = max(1, min(3, int(self.level)))
+
+    def is_empty(self) -> bool:
+        return (
+            self.level is None and not self.victories and not self.cycles
+            and self.last_win is None and not self.name
+        )
+
+class LevelIndex:
+    """
+    Classifica livelli mantenuta ordinata: un bucket per livello, ognuno una
+    lista ordinata di chiavi (-vittorie, -cicli, uid). Aggiornata a ogni
+    PlayerTable.changed/remove, così top-N e pagine costano O(pagina).
+    """
+
+    __slots__ = ("buckets", "keys")
+
+    def __init__(self):
+        self.buckets: Dict[int, List[Tuple[int, int, int]]] = {}
+        self.keys: Dict[int, Tuple[int, Tuple[int, int, int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @classmethod
+    def build(cls, records) -> "LevelIndex":
+        idx = cls()
+        for rec in records:
+            if rec.level is not None:
+                key = (-rec.victories, -rec.cycles, rec.uid)
+                idx.keys[rec.uid] = (rec.level, key)
+                idx.buckets.setdefault(rec.level, []).append(key)
+        for bucket in idx.buckets.values():
+            bucket.sort()
+        return idx
+
+    def discard(self, uid: int):
+        old = self.keys.pop(uid, None)
+        if old is None:
+            return
+        lvl, key = old
+        bucket = self.buckets[lvl]
+        del bucket[bisect.bisect_left(bucket, key)]
+        if not bucket:
+            del self.buckets[lvl]
+
+    def update(self, rec: PlayerRecord):
+        if rec.level is None:
+            self.discard(rec.uid)
+            return
+        new = (rec.level, (-rec.victories, -rec.cycles, rec.uid))
+        if self.keys.get(rec.uid) == new:
+            return
+        self.discard(rec.uid)
+        self.keys[rec.uid] = new
+        bisect.insort(self.buckets.setdefault(new[0], []), new[1])
+
+    def page(self, offset: int, limit: int) -> List[int]:
+        """uid in posizione [offset, offset+limit) della classifica."""
+        out: List[int] = []
+        for lvl in sorted(self.buckets, reverse=True):
+            bucket = self.buckets[lvl]
+            if offset >= len(bucket):
+                offset -= len(bucket)
+                continue
+            out.extend(key[2] for key in bucket[offset:offset + limit - len(out)])
+            offset = 0
+            if len(out) >= limit:
+                break
+        return out
+
+class PlayerTable:
+    """
+    Registro utenti indicizzato per id intero. Chi modifica un record chiama
+    changed(rec, *chiavi_schema): STATE viene segnato sporco e il record
+    finisce nel journal. `scope` è la chiave del server in STATE["guilds"]
+    (None = server home, mappe top-level).
+    """
+
+    def __init__(self, root: Optional["StateDict"] = None, scope: Optional[str] = None):
+        self.records: Dict[int, PlayerRecord] = {}
+        self.root = root
+        self.scope = scope
+        self._index: Optional[LevelIndex] = None   # costruito alla prima classifica
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records.values())
+
+    def _capture(self, uid: int, rec: Optional[PlayerRecord]):
+        txn = _TXN.get() if self.root is not None else None
+        if txn is not None:
+            txn.capture_player(self.scope, uid, rec)
+
+    def get(self, uid: int) -> Optional[PlayerRecord]:
+        rec = self.records.get(uid)
+        if rec is not None:
+            self._capture(uid, rec)
+        return rec
+
+    def ensure(self, uid: int) -> PlayerRecord:
+        rec = self.records.get(uid)
+        self._capture(uid, rec)
+        if rec is None:
+            rec = self.records[uid] = PlayerRecord(uid)
+        return rec
+
+    def registered(self) -> List[PlayerRecord]:
+        """Utenti con un livello registrato (quelli della vecchia mappa "wins")."""
+        return [r for r in self.records.values() if r.level is not None]
+
+    @property
+    def index(self) -> LevelIndex:
+        if self._index is None:
+            self._index = LevelIndex.build(self.records.values())
+        return self._index
+
+    def registered_count(self) -> int:
+        return len(self.index)
+
+    def leaderboard(self, offset: int = 0, limit: int = 20) -> List[PlayerRecord]:
+        """Pagina della classifica: livello, poi vittorie e cicli (decrescenti), poi uid."""
+        return [self.records[uid] for uid in self.index.page(offset, limit)]
+
+    def changed(self, rec: PlayerRecord, *keys: str):
+        if self._index is not None:
+            self._index.update(rec)
+        if self.root is not None:
+            self.root._player_changed(rec.uid, keys, rec.fields(), self.scope)
+
+    def remove(self, uid: int) -> bool:
+        self._capture(uid, self.records.get(uid))
+        if self.records.pop(uid, None) is None:
+            return False
+        if self._index is not None:
+            self._index.discard(uid)
+        if self.root is not None:
+            self.root._player_changed(uid, USER_KEYS, None, self.scope)
+        return True
+
+    def set_map_value(self, key: str, uid_s, value):
+        """Carica un valore nel formato dello schema JSON (mappa `key`, chiave str(uid))."""
+        try:
+            uid = int(uid_s)
+        except (TypeError, ValueError):
+            return
+        rec = self.ensure(uid)
+        try:
+            if key == "wins":
+                # livelli fuori 1..3 (stato vecchio o modificato a mano) finirebbero
+                # in un bucket a parte di LevelIndex, fuori ordine rispetto a get_level
+                rec.level = max(1, min(3, int(value)))
+            elif key == "victories":
+                rec.victories = int(value)
+            elif key == "cycles":
+                rec.cycles = int(value)
+            elif key == "last_win_ts":
+                rec.last_win = int(value) if value is not None else None
+            elif key == "last_win_iso":
+                rec.last_win = _epoch_from_iso(value)
+            elif key == "names":
+                rec.name = str(value) if value else None
+        except (TypeError, ValueError):
+            pass
+
+    def export_map(self, key: str) -> Dict[str, object]:
+        """Ricostruisce la mappa `key` dello schema JSON (compatibilità Gist)."""
+        out: Dict[str, object] = {}
+        for uid, rec in self.records.items():
+            if key == "wins":
+                if rec.level is not None:
+                    out[str(uid)] = rec.level
+            elif key == "victories":
+                if rec.victories:
+                    out[str(uid)] = rec.victories
+            elif key == "cycles":
+                if rec.cycles:
+                    out[str(uid)] = rec.cycles
+            elif key == "last_win_ts":
+                if rec.last_win is not None:
+                    out[str(uid)] = rec.last_win
+            elif key == "names":
+                if rec.name:
+                    out[str(uid)] = rec.name
+        return out
+
+    @classmethod
+    def from_maps(
+        cls, maps: Dict[str, Dict], root: Optional["StateDict"] = None, scope: Optional[str] = None
+    ) -> "PlayerTable":
+        table = cls(root, scope)
+        # last_win_ts (epoch) ha la precedenza sul vecchio last_win_iso
+        for key in LEGACY_USER_KEYS + USER_KEYS:
+            m = maps.get(key)
+            if isinstance(m, dict):
+                for uid_s, value in m.items():
+                    table.set_map_value(key, uid_s, value)
+        return table
+
+class StateDict(dict):
+    """
+    Mappa top-level di STATE con tracciamento delle chiavi modificate.
+    Ogni chiave tiene in cache il proprio frammento JSON: serialize() ricalcola
+    solo le chiavi sporche, e save_state() ignora i salvataggi senza modifiche.
+    Se è collegato un journal, ogni mutazione viene anche scritta su disco.
+    dirty_subkeys tiene le sottochiavi toccate (None = chiave riscritta per intero),
+    usate dai backend che salvano per riga.
+    Le mappe per-utente (USER_KEYS) non stanno nel dict: vivono in `players`
+    (in `guild_players` quelle dei namespace in "guilds") e vengono
+    ricostruite solo in serializzazione.
+    """
+    __slots__ = ("dirty_keys", "dirty_subkeys", "_fragments", "journal", "players", "guild_players")
+
+    def __init__(self, data: Optional[Dict] = None):
+        super().__init__()
+        self.dirty_keys: set = set()
+        self.dirty_subkeys: Dict[str, Optional[set]] = {}
+        self._fragments: Dict[str, str] = {}
+        self.journal: Optional["StateJournal"] = None
+        data = dict(data or {})
+        maps = {k: data.pop(k) for k in LEGACY_USER_KEYS + USER_KEYS if k in data}
+        self.players = PlayerTable.from_maps(maps, root=self)
+        self.guild_players: Dict[str, PlayerTable] = {}
+        if isinstance(data.get("guilds"), dict):
+            guilds = {}
+            for key, ns in data["guilds"].items():
+                ns = dict(ns) if isinstance(ns, dict) else {}
+                maps = {k: ns.pop(k) for k in LEGACY_USER_KEYS + USER_KEYS if k in ns}
+                self.guild_players[str(key)] = PlayerTable.from_maps(maps, root=self, scope=str(key))
+                guilds[key] = ns
+            data["guilds"] = guilds
+        self.dirty_keys.update(USER_KEYS)
+        for k, v in data.items():
+            self[k] = v
+
+    def players_for(self, scope: Optional[str]) -> PlayerTable:
+        """Registro utenti del namespace `scope` (None = server home)."""
+        if scope is None:
+            return self.players
+        table = self.guild_players.get(scope)
+        if table is None:
+            # registro vuoto solo in memoria: finisce nello stato al primo record
+            table = self.guild_players[scope] = PlayerTable(self, scope)
+        return table
+
+    def _player_changed(self, uid: int, keys: Tuple, fields: Optional[List], scope: Optional[str] = None):
+        if scope is not None:
+            # registro di un altro server: fa parte del suo namespace in "guilds"
+            self.dirty_keys.add("guilds")
+            sub = self.dirty_subkeys.setdefault("guilds", set())
+            if sub is not None:
+                sub.add(scope)
+            path: Tuple = ("guilds", scope, uid)
+        else:
+            uid_s = str(uid)
+            for k in keys:
+                self.dirty_keys.add(k)
+                sub = self.dirty_subkeys.setdefault(k, set())
+                if sub is not None:
+                    sub.add(uid_s)
+            path = (uid,)
+        if self.journal is not None:
+            if fields is None:
+                self.journal.append("player_del", path, txn=_TXN.get())
+            else:
+                self.journal.append("player", path, fields, txn=_TXN.get())
+
+    def _before_change(self, path: Tuple):
+        txn = _TXN.get()
+        if txn is not None:
+            txn.capture(self, path)
+
+    def _changed(self, op: str, path: Tuple, value=None):
+        top = path[0]
+        self.dirty_keys.add(top)
+        if len(path) == 1:
+            self.dirty_subkeys[top] = None
+        elif top not in self.dirty_subkeys:
+            self.dirty_subkeys[top] = {path[1]}
+        elif self.dirty_subkeys[top] is not None:
+            self.dirty_subkeys[top].add(path[1])
+        if self.journal is not None:
+            self.journal.append(op, path, value, txn=_TXN.get())
+
+    def __setitem__(self, k, v):
+        if k in self and _same_scalar(dict.__getitem__(self, k), v):
+            return
+        self._before_change((k,))
+        dict.__setitem__(self, k, _track(v, self, (k,)))
+        self._changed("set", (k,), v)
+
+    def __delitem__(self, k):
+        self._before_change((k,))
+        dict.__delitem__(self, k)
+        self._changed("del", (k,))
+
+    def pop(self, k, *default):
+        if k in self:
+            self._before_change((k,))
+            self._changed("del", (k,))
+        return dict.pop(self, k, *default)
+
+    def popitem(self):
+        k = next(reversed(self))
+        return k, self.pop(k)
+
+    def setdefault(self, k, default=None):
+        if k not in self:
+            self[k] = default
+        return dict.__getitem__(self, k)
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def clear(self):
+        for k in list(self.keys()):
+            del self[k]
+
+    def __deepcopy__(self, memo):
+        return {k: copy.deepcopy(v, memo) for k, v in self.items()}
+
+    def apply(self, op: str, path: List, value=None):
+        """Riapplica una mutazione letta dal journal (senza riscriverla)."""
+        journal, self.journal = self.journal, None
+        try:
+            self._apply(op, path, value)
+        finally:
+            self.journal = journal
+
+    def _apply(self, op: str, path: List, value):
+        if op in {"player", "player_del"}:
+            # [uid] nel server home, ["guilds", chiave, uid] negli altri
+            table = self.players_for(str(path[1]) if len(path) == 3 else None)
+            if op == "player":
+                rec = table.ensure(int(path[-1]))
+                rec.set_fields(value)
+                table.changed(rec, *USER_KEYS)
+            else:
+                table.remove(int(path[-1]))
+            return
+        if path[0] in USER_KEYS or path[0] in LEGACY_USER_KEYS:
+            # journal scritto prima del registro PlayerRecord: path ["wins", "123"]
+            if len(path) == 2:
+                self.players.set_map_value(path[0], path[1], value if op == "set" else None)
+                rec = self.players.get(int(path[1])) if str(path[1]).isdigit() else None
+                if rec is not None:
+                    self.players.changed(rec, "last_win_ts" if path[0] == "last_win_iso" else path[0])
+            return
+
+        target = self
+        for k in path[:-1]:
+            target = target.get(k) if isinstance(target, dict) else None
+            if not isinstance(target, dict):
+                return
+        if op == "set":
+            target[path[-1]] = value
+        elif op == "del":
+            target.pop(path[-1], None)
+
+    def take_changes(self) -> Tuple[set, Dict[str, Optional[set]]]:
+        """Consuma le chiavi sporche (per i backend incrementali)."""
+        keys, subkeys = self.dirty_keys, self.dirty_subkeys
+        for k in keys:
+            self._fragments.pop(k, None)
+        self.dirty_keys, self.dirty_subkeys = set(), {}
+        return keys, subkeys
+
+    def restore_changes(self, changes: Tuple[set, Dict[str, Optional[set]]]):
+        """Rimette le modifiche consumate da take_changes() (salvataggio fallito)."""
+        keys, subkeys = changes
+        self.dirty_keys |= keys
+        for k, sub in subkeys.items():
+            if sub is None or self.dirty_subkeys.get(k, set()) is None:
+                self.dirty_subkeys[k] = None
+            else:
+                self.dirty_subkeys.setdefault(k, set()).update(sub)
+
+    def export_value(self, k: str):
+        """Valore della chiave `k` nel formato dello schema JSON (mappe per-utente incluse)."""
+        if k in USER_KEYS:
+            return self.players.export_map(k)
+        value = dict.__getitem__(self, k)
+        if k != "guilds" or not self.guild_players:
+            return value
+        guilds = dict(value)
+        for scope, table in self.guild_players.items():
+            if len(table):
+                # un record scritto prima del namespace lo porta con sé (valori di default)
+                ns = dict(guilds.get(scope) or GUILD_STATE_DEFAULTS)
+                ns.update((key, table.export_map(key)) for key in USER_KEYS)
+                guilds[scope] = ns
+        return guilds
+
+    def serialize(self) -> str:
+        """
+        JSON nel formato dello schema (indent=2, mappe per-utente incluse),
+        ricostruito dai frammenti in cache.
+        """
+        for k in self.dirty_keys:
+            self._fragments.pop(k, None)
+        self.dirty_keys.clear()
+        self.dirty_subkeys.clear()
+
+        keys = list(self.keys()) + list(USER_KEYS)
+        for k in keys:
+            if k not in self._fragments:
+                frag = json.dumps(self.export_value(k), ensure_ascii=False, indent=2)
+                self._fragments[k] = frag.replace("\n", "\n  ")
+
+        body = ",\n".join(
+            f"  {json.dumps(k, ensure_ascii=False)}: {self._fragments[k]}" for k in keys
+        )
+        return "{\n" + body + "\n}"
+
+class StateJournal:
+    """
+    Journal locale append-only: una riga JSON per mutazione di STATE
+    ({"op": "set"|"del", "path": [...], "value": ...}; per i record utente
+    {"op": "player"|"player_del", "path": [uid], "value": [campi]}, con path
+    ["guilds", server, uid] per i registri degli altri server). La prima riga
+    ({"op": "base", "rev": N}) indica la revisione dello snapshot a cui
+    le mutazioni vanno applicate. Le operazioni sono assolute (idempotenti).
+    Le mutazioni di una transazione portano "txn": id e vengono riapplicate
+    solo se il journal contiene anche {"op": "commit", "txn": id}.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = 0
+        self._fh = None
+        self._sync_pending = False
+
+    def read(self) -> Tuple[Optional[int], List[Dict]]:
+        base: Optional[int] = None
+        ops: List[Dict] = []
+        committed: set = set()
+        try:
+            with open(self.path, "r", encoding="utf-8") as fh:
+                for line in fh:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # riga troncata da un crash: tutto ciò che segue non è affidabile
+                        break
+                    if rec.get("op") == "base":
+                        base = int(rec.get("rev") or 0)
+                        ops = []
+                        committed = set()
+                    elif rec.get("op") == "commit":
+                        committed.add(rec.get("txn"))
+                    elif rec.get("op") in {"set", "del", "player", "player_del"} and rec.get("path"):
+                        ops.append(rec)
+        except FileNotFoundError:
+            pass
+        # transazioni senza commit (crash o rollback): le loro mutazioni non contano
+        return base, [rec for rec in ops if "txn" not in rec or rec["txn"] in committed]
+
+    def reset(self, rev: int):
+        """Tronca il journal: le mutazioni precedenti sono nello snapshot `rev`."""
+        self.close()
+        self._fh = open(self.path, "w", encoding="utf-8")
+        self._fh.write(json.dumps({"op": "base", "rev": rev}) + "\n")
+        self._fh.flush()
+        self._sync()
+        self.entries = 0
+
+    def append(self, op: str, path: Tuple, value=None, txn: Optional[StateTransaction] = None):
+        if self._fh is None:
+            return
+        rec = {"op": op, "path": list(path)}
+        if op in {"set", "player"}:
+            rec["value"] = value
+        if txn is not None:
+            rec["txn"] = txn.id
+            txn.journaled = True
+        self._write(rec)
+
+    def commit(self, txn: StateTransaction):
+        if self._fh is not None and txn.journaled:
+            self._write({"op": "commit", "txn": txn.id})
+
+    def _write(self, rec: Dict):
+        self._fh.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self._fh.flush()
+        self.entries += 1
+        self._schedule_sync()
+
+    def _schedule_sync(self):
+        # un solo fsync per giro del loop, anche per un burst di mutazioni
+        if self._sync_pending:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._sync()
+            return
+        self._sync_pending = True
+        loop.call_soon(self._sync)
+
+    def _sync(self):
+        self._sync_pending = False
+        if self._fh is None:
+            return
+        try:
+            fd = self._fh.fileno()
+            if hasattr(os, "fdatasync"):
+                os.fdatasync(fd)
+            else:
+                os.fsync(fd)
+        except (OSError, ValueError) as e:
+            print("Errore fsync journal:", e)
+
+    def close(self):
+        if self._fh is not None:
+            self._sync()
+            self._fh.close()
+            self._fh = None
+
+STATE: StateDict = StateDict()
+JOURNAL: Optional[StateJournal] = None
+_LAST_SAVED_HASH: Optional[str] = None
 TEST_TASKS: Dict[str, asyncio.Task] = {}
 
 DEFAULT_STATE = {
     "schema": "imperivm.lottery.v2",
+    "revision": 0,                   # incrementata a ogni snapshot (locale/Gist)
     "edition": 1,
     "open_message_id": None,
+    "entrants": {},                  # str(uid) -> 1 (utente) / 0 (bot), ✅ tracciati live sul messaggio aperto
 
     "wins": {},
     "victories": {},
     "cycles": {},
-    "last_win_iso": {},
+    "last_win_ts": {},               # epoch (secondi) dell'ultima vittoria
 
     "last_winner_id": None,
     "last_winner_ids": [],
@@ -101,6 +1110,9 @@ DEFAULT_STATE = {
 
     "last_special_prize": None,
 
+    "winner_count": 1,               # vincitori per edizione classica (CHANCE li raddoppia)
+    "open_winner_count": None,       # winner_count annunciato all'apertura in corso (usato dall'estrazione)
+
     "weekly_modifier": None,
     "weekly_modifier_week": None,
     "test_override_modifier": None,
@@ -111,20 +1123,120 @@ DEFAULT_STATE = {
     "last_open_week": None,
     "last_close_week": None,
     "last_announce_week": None,
+    "auto_last_run_ts": None,        # epoch fino al quale gli eventi automatici sono stati gestiti
+    "auto_next_fire": None,          # {"lottery": ..., "event": ..., "ts": epoch} prossimo evento pianificato
+
+    "lotteries": {},                 # stato delle lotterie del calendario diverse da "weekly"
+    "channel_id": None,              # canale lotteria impostato con /canale (server home)
+
+    "home_guild_id": None,           # server che usa le chiavi top-level
+    "guilds": {},                    # str(guild_id) -> namespace degli altri server
 
     # Nuove chiavi
     "automation_enabled": True,      # True = automazione attiva
     "lottery_mode": "classic",       # "classic" oppure "special"
 }
 
-def load_state_from_gist() -> Dict:
+# Codici HTTP per cui ha senso ritentare
+_GIST_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+_GIST_SESSION: Optional[aiohttp.ClientSession] = None
+_STATE_WRITER_TASK: Optional[asyncio.Task] = None
+_SAVE_EVENT: Optional[asyncio.Event] = None
+_FORCE_EVENT: Optional[asyncio.Event] = None
+_FLUSH_LOCK: Optional[asyncio.Lock] = None
+_STATE_DIRTY = False
+
+def _gist_session() -> aiohttp.ClientSession:
+    """Sessione HTTP condivisa (connessioni riusate tra load e save)."""
+    global _GIST_SESSION
+    if _GIST_SESSION is None or _GIST_SESSION.closed:
+        _GIST_SESSION = aiohttp.ClientSession(
+            headers=_gist_headers(),
+            timeout=aiohttp.ClientTimeout(total=GIST_HTTP_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=4, keepalive_timeout=60),
+        )
+    return _GIST_SESSION
+
+async def _gist_request(method: str, payload: Optional[bytes] = None) -> Optional[Dict]:
+    """
+    Chiamata all'API Gist con retry e backoff esponenziale (con jitter).
+    Ritorna il JSON di risposta, oppure None se tutti i tentativi falliscono.
+    """
+    headers = {"Content-Type": "application/json"} if payload is not None else None
+    last_error = ""
+
+    for attempt in range(GIST_MAX_RETRIES + 1):
+        delay = GIST_RETRY_BASE_DELAY * (2 ** attempt) + random.uniform(0, GIST_RETRY_BASE_DELAY)
+        try:
+            async with _gist_session().request(method, _gist_api_url(), data=payload, headers=headers) as resp:
+                if resp.status < 400:
+                    return await resp.json(content_type=None)
+
+                last_error = f"HTTP {resp.status}: {await resp.text()}"
+                if resp.status not in _GIST_RETRY_STATUS:
+                    break
+
+                retry_after = resp.headers.get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, float(retry_after))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            last_error = repr(e)
+
+        if attempt < GIST_MAX_RETRIES:
+            await asyncio.sleep(delay)
+
+    print(f"Errore Gist {method}:", last_error)
+    return None
+
+def _content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def _normalize_state(parsed: Dict) -> Dict:
+    for k, v in DEFAULT_STATE.items():
+        if k not in parsed:
+            parsed[k] = v
+
+    if not isinstance(parsed.get("last_winner_ids"), list):
+        parsed["last_winner_ids"] = []
+    if not isinstance(parsed.get("names"), dict):
+        parsed["names"] = {}
+    if not isinstance(parsed.get("wins"), dict):
+        parsed["wins"] = {}
+    if not isinstance(parsed.get("victories"), dict):
+        parsed["victories"] = {}
+    if not isinstance(parsed.get("cycles"), dict):
+        parsed["cycles"] = {}
+    if not isinstance(parsed.get("last_win_ts"), dict):
+        parsed["last_win_ts"] = {}
+    if "last_win_iso" in parsed and not isinstance(parsed["last_win_iso"], dict):
+        parsed.pop("last_win_iso")
+    if not isinstance(parsed.get("last_winner_prev_levels"), dict):
+        parsed["last_winner_prev_levels"] = {}
+    if not isinstance(parsed.get("last_winner_reset_flags"), dict):
+        parsed["last_winner_reset_flags"] = {}
+
+    if parsed.get("lottery_mode") not in {"classic", "special"}:
+        parsed["lottery_mode"] = "classic"
+
+    try:
+        parsed["winner_count"] = max(1, min(MAX_WINNERS, int(parsed.get("winner_count") or 1)))
+    except (TypeError, ValueError):
+        parsed["winner_count"] = 1
+
+    parsed["automation_enabled"] = bool(parsed.get("automation_enabled", True))
+    return parsed
+
+async def load_state_from_gist() -> Dict:
+    global _LAST_SAVED_HASH
     if not GIST_ID:
         return DEFAULT_STATE.copy()
 
     try:
-        req = urllib.request.Request(_gist_api_url(), headers=_gist_headers(), method="GET")
-        with urllib.request.urlopen(req, timeout=20) as resp:
-            data = json.loads(resp.read().decode("utf-8"))
+        with GIST_SECONDS.time("load"):
+            data = await _gist_request("GET")
+        if data is None:
+            return DEFAULT_STATE.copy()
 
         files = data.get("files", {})
         file_obj = files.get(GIST_FILENAME)
@@ -134,81 +1246,782 @@ def load_state_from_gist() -> Dict:
         content = file_obj.get("content", "")
         if not content:
             return DEFAULT_STATE.copy()
+        GIST_BYTES.observe(len(content.encode("utf-8")), "load")
 
         parsed = json.loads(content)
+        # se dopo la normalizzazione il contenuto non cambia, il primo save viene saltato
+        _LAST_SAVED_HASH = _content_hash(content)
 
-        for k, v in DEFAULT_STATE.items():
-            if k not in parsed:
-                parsed[k] = v
-
-        if not isinstance(parsed.get("last_winner_ids"), list):
-            parsed["last_winner_ids"] = []
-        if not isinstance(parsed.get("names"), dict):
-            parsed["names"] = {}
-        if not isinstance(parsed.get("wins"), dict):
-            parsed["wins"] = {}
-        if not isinstance(parsed.get("victories"), dict):
-            parsed["victories"] = {}
-        if not isinstance(parsed.get("cycles"), dict):
-            parsed["cycles"] = {}
-        if not isinstance(parsed.get("last_win_iso"), dict):
-            parsed["last_win_iso"] = {}
-        if not isinstance(parsed.get("last_winner_prev_levels"), dict):
-            parsed["last_winner_prev_levels"] = {}
-        if not isinstance(parsed.get("last_winner_reset_flags"), dict):
-            parsed["last_winner_reset_flags"] = {}
-
-        if parsed.get("lottery_mode") not in {"classic", "special"}:
-            parsed["lottery_mode"] = "classic"
-
-        parsed["automation_enabled"] = bool(parsed.get("automation_enabled", True))
-        return parsed
+        return _normalize_state(parsed)
 
     except Exception as e:
         print("Errore load Gist:", e)
         return DEFAULT_STATE.copy()
 
-def save_state_to_gist(state: Dict):
-    if not GIST_ID:
-        return
-
-    payload = json.dumps({
+def _gist_payload(content: str) -> bytes:
+    return json.dumps({
         "files": {
             GIST_FILENAME: {
-                "content": json.dumps(state, ensure_ascii=False, indent=2)
+                "content": content
             }
         }
     }).encode("utf-8")
 
+async def save_state_to_gist(payload: bytes) -> bool:
+    if not GIST_ID:
+        return True
+    GIST_BYTES.observe(len(payload), "save")
     try:
-        req = urllib.request.Request(_gist_api_url(), headers=_gist_headers(), data=payload, method="PATCH")
-        with urllib.request.urlopen(req, timeout=20) as _:
-            pass
-    except urllib.error.HTTPError as e:
-        print("Errore salvataggio Gist:", e.read().decode("utf-8", errors="ignore"))
+        with GIST_SECONDS.time("save"):
+            return await _gist_request("PATCH", payload) is not None
     except Exception as e:
         print("Errore salvataggio Gist:", e)
+        return False
+
+def _read_local_snapshot() -> Optional[Dict]:
+    try:
+        with open(SNAPSHOT_PATH, "r", encoding="utf-8") as fh:
+            parsed = json.load(fh)
+        return _normalize_state(parsed) if isinstance(parsed, dict) else None
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print("Errore lettura snapshot locale:", e)
+        return None
+
+def _write_local_snapshot(content: str):
+    """Scrittura atomica: file temporaneo + fsync + rename."""
+    tmp = SNAPSHOT_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        fh.write(content)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, SNAPSHOT_PATH)
+
+def _compact_journal() -> str:
+    """
+    Nuova revisione di STATE: snapshot locale + journal troncato.
+    Ritorna il contenuto JSON dello snapshot (da caricare sul Gist).
+    """
+    assert JOURNAL is not None
+    STATE.journal = None
+    try:
+        STATE["revision"] = int(STATE.get("revision") or 0) + 1
+    finally:
+        STATE.journal = JOURNAL
+    content = STATE.serialize()
+    _write_local_snapshot(content)
+    JOURNAL.reset(STATE["revision"])
+    return content
+
+def _attach_journal():
+    """Riapplica il journal su STATE appena caricato e lo collega per le nuove mutazioni."""
+    global JOURNAL, _LAST_SAVED_HASH
+    journal = StateJournal(JOURNAL_PATH)
+    base_rev, ops = journal.read()
+    rev = int(STATE.get("revision") or 0)
+
+    if ops and base_rev == rev:
+        for rec in ops:
+            STATE.apply(rec["op"], rec["path"], rec.get("value"))
+        print(f"[STATE] Journal: {len(ops)} modifiche riapplicate sulla revisione {rev}.")
+    elif ops:
+        print(f"[STATE] Journal ignorato: base {base_rev}, snapshot caricato {rev}.")
+
+    # da qui snapshot locale == STATE e journal vuoto
+    content = STATE.serialize()
+    _write_local_snapshot(content)
+    journal.reset(rev)
+    if not GIST_ID:
+        _LAST_SAVED_HASH = _content_hash(content)
+    STATE.journal = journal
+    JOURNAL = journal
+
+# ---------- Storage backend ----------
+
+class StateBackend:
+    """
+    Interfaccia di persistenza dietro load_state()/save_state().
+    STATE resta in memoria (get_level/set_level leggono guild_players()):
+    il backend decide come caricarlo e come salvarne le modifiche.
+    """
+    name = "base"
+
+    async def load(self) -> Dict:
+        raise NotImplementedError
+
+    def attach(self, state: "StateDict"):
+        """Chiamato dopo load(), con STATE già costruito."""
+
+    def save_window(self) -> float:
+        return GIST_SAVE_MIN_INTERVAL
+
+    async def save(self, state: "StateDict") -> bool:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
 
-def load_state():
-    global STATE
-    STATE = load_state_from_gist()
+class GistBackend(StateBackend):
+    """Un unico file JSON su Gist (+ journal e snapshot locali): per gilde piccole."""
+    name = "gist"
+
+    async def load(self) -> Dict:
+        base = await load_state_from_gist()
+        if JOURNAL_ENABLED:
+            # lo snapshot locale vince se è almeno recente quanto il Gist
+            local = _read_local_snapshot()
+            if local is not None and int(local.get("revision") or 0) >= int(base.get("revision") or 0):
+                base = local
+        return base
+
+    def attach(self, state: "StateDict"):
+        if not JOURNAL_ENABLED:
+            return
+        try:
+            _attach_journal()
+        except OSError as e:
+            print("Errore journal locale (disattivato):", e)
+
+    def save_window(self) -> float:
+        # con il journal le mutazioni sono già durevoli su disco
+        return GIST_SNAPSHOT_INTERVAL if JOURNAL is not None else GIST_SAVE_MIN_INTERVAL
+
+    async def save(self, state: "StateDict") -> bool:
+        """
+        Se il contenuto coincide con l'ultimo salvato, il salvataggio viene saltato.
+        Con il journal attivo: snapshot locale, journal compattato, poi PATCH Gist.
+        """
+        global _LAST_SAVED_HASH
+        if not GIST_ID and JOURNAL is None:
+            return True
+
+        content = state.serialize()
+        digest = _content_hash(content)
+        if digest == _LAST_SAVED_HASH:
+            GIST_UNCHANGED.inc()
+            return True
+
+        if JOURNAL is not None:
+            content = _compact_journal()
+            digest = _content_hash(content)
+            if not GIST_ID:
+                _LAST_SAVED_HASH = digest
+                return True
+
+        ok = await save_state_to_gist(_gist_payload(content))
+        if ok:
+            _LAST_SAVED_HASH = digest
+        return ok
+
+    async def close(self):
+        global _GIST_SESSION, JOURNAL
+        if JOURNAL is not None:
+            JOURNAL.close()
+            STATE.journal = None
+            JOURNAL = None
+
+        if _GIST_SESSION is not None and not _GIST_SESSION.closed:
+            await _GIST_SESSION.close()
+        _GIST_SESSION = None
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS players (
+    uid          INTEGER PRIMARY KEY,
+    level        INTEGER,
+    victories    INTEGER,
+    cycles       INTEGER,
+    last_win     INTEGER,
+    name         TEXT
+);
+"""
+
+class SQLiteBackend(StateBackend):
+    """
+    Registro su SQLite (WAL): una riga per utente, chiavi globali in `meta`
+    (i registri degli altri server viaggiano nel loro namespace, in meta "guilds").
+    Salva solo le righe toccate dall'ultimo flush (upsert per utente).
+    Le query girano in un thread per non bloccare il loop.
+    """
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(_SQLITE_SCHEMA)
+            self._upgrade_schema(db)
+            self._db = db
+        return self._db
+
+    @staticmethod
+    def _upgrade_schema(db: sqlite3.Connection):
+        """Database creati con la colonna last_win_iso (testo): aggiunge last_win (epoch)."""
+        cols = {row[1] for row in db.execute("PRAGMA table_info(players)")}
+        if "last_win_iso" not in cols:
+            return
+        with db:
+            if "last_win" not in cols:
+                db.execute("ALTER TABLE players ADD COLUMN last_win INTEGER")
+            rows = db.execute(
+                "SELECT uid, last_win_iso FROM players WHERE last_win IS NULL AND last_win_iso IS NOT NULL"
+            ).fetchall()
+            db.executemany(
+                "UPDATE players SET last_win = ? WHERE uid = ?",
+                [(_epoch_from_iso(iso), uid) for uid, iso in rows],
+            )
+
+    async def load(self) -> Dict:
+        return await asyncio.to_thread(self._load_sync)
+
+    def attach(self, state: "StateDict"):
+        # appena caricato: il database coincide già con STATE
+        state.take_changes()
+
+    def _load_sync(self) -> Dict:
+        db = self._conn()
+        state: Dict = {}
+        for key, value in db.execute("SELECT key, value FROM meta"):
+            state[key] = json.loads(value)
+
+        maps: Dict[str, Dict] = {k: {} for k in USER_KEYS}
+        rows = db.execute("SELECT uid, level, victories, cycles, last_win, name FROM players")
+        for uid, *values in rows:
+            u = str(uid)
+            for key, value in zip(USER_KEYS, values):
+                if value is not None:
+                    maps[key][u] = value
+        state.update(maps)
+        return _normalize_state(state)
+
+    def _player_row(self, state: "StateDict", uid: int) -> Tuple:
+        rec = state.players.get(uid)
+        if rec is None or rec.is_empty():
+            return (uid, None, None, None, None, None)
+        return (uid, rec.level, rec.victories, rec.cycles, rec.last_win, rec.name)
+
+    async def save(self, state: "StateDict") -> bool:
+        changes = state.take_changes()
+        keys, subkeys = changes
+        if not keys:
+            return True
+
+        # snapshot delle righe sul loop: STATE può cambiare durante la scrittura
+        meta_rows: List[Tuple[str, Optional[str]]] = []
+        full_rewrite = False
+        uids: set = set()
+        for k in keys:
+            if k in USER_KEYS:
+                sub = subkeys.get(k)
+                if sub is None:
+                    full_rewrite = True
+                else:
+                    uids |= sub
+            else:
+                meta_rows.append((k, json.dumps(state.export_value(k), ensure_ascii=False) if k in state else None))
+
+        if full_rewrite:
+            uids = {str(r.uid) for r in state.players}
+        player_rows = [self._player_row(state, int(u)) for u in uids if str(u).isdigit()]
+
+        try:
+            await asyncio.to_thread(self._save_sync, meta_rows, player_rows, full_rewrite)
+            return True
+        except Exception as e:
+            print("Errore salvataggio SQLite:", e)
+            state.restore_changes(changes)
+            return False
+
+    def _save_sync(self, meta_rows: List[Tuple[str, Optional[str]]], player_rows: List[Tuple], full_rewrite: bool):
+        db = self._conn()
+        with db:
+            for key, value in meta_rows:
+                if value is None:
+                    db.execute("DELETE FROM meta WHERE key = ?", (key,))
+                else:
+                    db.execute(
+                        "INSERT INTO meta (key, value) VALUES (?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                        (key, value),
+                    )
+
+            if full_rewrite:
+                db.execute("DELETE FROM players")
+            for row in player_rows:
+                if all(v is None for v in row[1:]):
+                    # record vuoto o rimosso
+                    db.execute("DELETE FROM players WHERE uid = ?", (row[0],))
+                    continue
+                db.execute(
+                    "INSERT INTO players (uid, level, victories, cycles, last_win, name) "
+                    "VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(uid) DO UPDATE SET level = excluded.level, "
+                    "victories = excluded.victories, cycles = excluded.cycles, "
+                    "last_win = excluded.last_win, name = excluded.name",
+                    row,
+                )
+
+    async def import_state(self, state: Dict):
+        """Sostituisce il contenuto del database con `state` (migrazione)."""
+        tracked = StateDict(_normalize_state(dict(state)))
+        tracked.take_changes()
+        meta_rows = [(k, json.dumps(tracked.export_value(k), ensure_ascii=False)) for k in tracked]
+        player_rows = [self._player_row(tracked, r.uid) for r in tracked.players]
+        await asyncio.to_thread(self._save_sync, meta_rows, player_rows, True)
+        return len(player_rows)
+
+    async def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+def make_backend() -> StateBackend:
+    if STATE_BACKEND == "sqlite":
+        return SQLiteBackend(SQLITE_PATH)
+    return GistBackend()
+
+BACKEND: StateBackend = make_backend()
+
+async def migrate_to_sqlite(source: Optional[str] = None) -> int:
+    """
+    Copia lo stato imperivm.lottery.v2 (file JSON locale, oppure il Gist
+    configurato se `source` è vuoto) nel database SQLITE_PATH.
+    """
+    if source:
+        with open(source, "r", encoding="utf-8") as fh:
+            state = json.load(fh)
+    else:
+        state = await load_state_from_gist()
+        if _GIST_SESSION is not None and not _GIST_SESSION.closed:
+            await _GIST_SESSION.close()
+
+    backend = SQLiteBackend(SQLITE_PATH)
+    try:
+        return await backend.import_state(state)
+    finally:
+        await backend.close()
+
+# ---------- Persistenza ----------
+
+async def flush_state():
+    """Salva subito STATE tramite il backend se ci sono modifiche non ancora salvate."""
+    global _STATE_DIRTY
+    if _FLUSH_LOCK is None:
+        return
+
+    async with _FLUSH_LOCK:
+        if not _STATE_DIRTY:
+            return
+        # uno snapshot a metà transazione salverebbe modifiche non confermate
+        await _txns_idle().wait()
+        # pulito PRIMA dello snapshot: le modifiche durante il salvataggio restano "sporche"
+        _STATE_DIRTY = False
+        ok = False
+        try:
+            ok = await BACKEND.save(STATE)
+        finally:
+            STATE_FLUSHES.inc("ok" if ok else "failed")
+            if not ok:
+                _STATE_DIRTY = True
+
+async def _state_writer():
+    """
+    Task dedicato alle scritture: alla prima modifica apre una finestra di
+    coalescenza (o meno, se arriva un save forzato) e poi salva lo stato in
+    un'unica scrittura del backend.
+    """
+    assert _SAVE_EVENT is not None and _FORCE_EVENT is not None
+    while True:
+        await _SAVE_EVENT.wait()
+        if not _FORCE_EVENT.is_set():
+            try:
+                await asyncio.wait_for(_FORCE_EVENT.wait(), timeout=BACKEND.save_window())
+            except asyncio.TimeoutError:
+                pass
+        _SAVE_EVENT.clear()
+        _FORCE_EVENT.clear()
+
+        await flush_state()
+        if _STATE_DIRTY and not _SAVE_EVENT.is_set():
+            # salvataggio fallito: si riprova alla prossima finestra
+            _SAVE_EVENT.set()
+
+def start_persistence() -> bool:
+    """Avvia il writer sul loop corrente (idempotente)."""
+    global _SAVE_EVENT, _FORCE_EVENT, _FLUSH_LOCK, _STATE_WRITER_TASK
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+
+    if _STATE_WRITER_TASK is None or _STATE_WRITER_TASK.done():
+        _SAVE_EVENT = asyncio.Event()
+        _FORCE_EVENT = asyncio.Event()
+        _FLUSH_LOCK = asyncio.Lock()
+        _STATE_WRITER_TASK = asyncio.create_task(_state_writer())
+        if _STATE_DIRTY:
+            _SAVE_EVENT.set()
+    return True
+
+async def stop_persistence():
+    """Ferma il writer, esegue il flush finale e chiude il backend (spegnimento)."""
+    global _STATE_WRITER_TASK
+    task = _STATE_WRITER_TASK
+    # wait_for può assorbire un cancel che arriva mentre l'attesa si completa:
+    # si ripete finché il writer non è davvero fermo
+    while task is not None and not task.done():
+        task.cancel()
+        await asyncio.wait({task}, timeout=1.0)
+    if task is not None and not task.cancelled():
+        task.exception()
+    _STATE_WRITER_TASK = None
+
+    try:
+        await flush_state()
+    except Exception as e:
+        print("Errore flush stato allo spegnimento:", e)
+
+    await BACKEND.close()
+
+async def load_state():
+    global STATE, _STATE_DIRTY
+    STATE = StateDict(await BACKEND.load())
     if STATE.get("schema") != DEFAULT_STATE["schema"]:
         STATE["schema"] = DEFAULT_STATE["schema"]
+    BACKEND.attach(STATE)
+
+    _STATE_DIRTY = True
     save_state(force=True)
 
 def save_state(force: bool = False):
-    global _LAST_GIST_SAVE_TS
-    now_mono = time.monotonic()
+    """
+    Segna STATE come modificato e sveglia il writer: non blocca mai il loop.
+    force=True accorcia la finestra di coalescenza (flush appena possibile).
+    Dentro una transazione il salvataggio è rimandato al commit.
+    """
+    global _STATE_DIRTY
+    txn = _TXN.get()
+    if txn is not None:
+        txn.save_pending = True
+        txn.save_force = txn.save_force or force
+        SAVE_REQUESTS.inc("deferred")
+        return
+    if not STATE.dirty_keys and not _STATE_DIRTY:
+        return
 
-    if not force and (now_mono - _LAST_GIST_SAVE_TS) < GIST_SAVE_MIN_INTERVAL:
+    _STATE_DIRTY = True
+    if not start_persistence():
+        print("Errore salvataggio stato: nessun event loop attivo.")
         return
 
-    _LAST_GIST_SAVE_TS = now_mono
-    save_state_to_gist(STATE)
+    assert _SAVE_EVENT is not None and _FORCE_EVENT is not None
+    # già in attesa nella finestra di coalescenza: confluisce nella stessa scrittura
+    SAVE_REQUESTS.inc("coalesced" if _SAVE_EVENT.is_set() else "scheduled")
+    if force:
+        _FORCE_EVENT.set()
+    _SAVE_EVENT.set()
 
 # ---------- Bot ----------
 
-bot = commands.Bot(command_prefix="!", intents=INTENTS)
+# Server su cui sta lavorando il codice corrente (comando, evento o task di automazione)
+CURRENT_GUILD: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("CURRENT_GUILD", default=None)
+
+class ImperivmTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # stesso task del comando: il namespace resta quello del server dell'interazione
+        CURRENT_GUILD.set(interaction.guild_id)
+        return True
+
+class ImperivmBot(commands.AutoShardedBot if BOT_SHARDED else commands.Bot):
+    async def close(self):
+        # prima di chiudere, scarica le scritture ancora in coda
+        await stop_persistence()
+        await super().close()
+
+bot = ImperivmBot(command_prefix="!", intents=INTENTS, tree_cls=ImperivmTree)
+
+# ---------- Server ----------
+
+GUILD_STATE_DEFAULTS = {
+    "lottery_mode": "classic",
+    "automation_enabled": GUILD_AUTOMATION_DEFAULT,
+    "winner_count": 1,
+    "test_override_modifier": None,
+    "weekly_modifier": None,
+    "weekly_modifier_week": None,
+    "channel_id": None,
+    "lotteries": {},
+}
+
+def home_guild_id() -> Optional[int]:
+    gid = STATE.get("home_guild_id") or HOME_GUILD_ID or SYNC_GUILD_ID
+    if not gid and bot.guilds:
+        gid = bot.guilds[0].id
+    return gid or None
+
+def pin_home_guild():
+    """Memorizza il server home (on_ready): resta lui anche se cambia l'ordine dei server."""
+    gid = home_guild_id()
+    if gid and not STATE.get("home_guild_id"):
+        STATE["home_guild_id"] = gid
+        save_state()
+
+def _guild_scope() -> Optional[str]:
+    """Chiave del server corrente in STATE["guilds"] (None = server home)."""
+    gid = CURRENT_GUILD.get()
+    home = home_guild_id()
+    if gid is None or home is None or gid == home:
+        return None
+    return str(gid)
+
+def gstate(create: bool = False) -> Dict:
+    """
+    Namespace di stato del server corrente (STATE stesso per il server home).
+    Un server senza namespace legge i default; il namespace nasce solo con
+    create=True, dai percorsi che scrivono.
+    """
+    scope = _guild_scope()
+    if scope is None:
+        return STATE
+    ns = (STATE.get("guilds") or {}).get(scope)
+    if ns is not None:
+        return ns
+    if not create:
+        return copy.deepcopy(GUILD_STATE_DEFAULTS)
+    guilds = STATE.setdefault("guilds", {})
+    guilds[scope] = copy.deepcopy(GUILD_STATE_DEFAULTS)
+    return guilds[scope]
+
+def guild_players() -> PlayerTable:
+    """Registro utenti del server corrente (STATE.players per il server home)."""
+    return STATE.players_for(_guild_scope())
+
+async def for_each_guild(coro_func, guilds: Optional[List[discord.Guild]] = None):
+    """Esegue coro_func(guild) su tutti i server, ognuno nel proprio namespace, in parallelo limitato."""
+    sem = asyncio.Semaphore(GUILD_CONCURRENCY)
+
+    async def one(guild: discord.Guild):
+        async with sem:
+            CURRENT_GUILD.set(guild.id)
+            try:
+                await coro_func(guild)
+            except Exception as e:
+                print(f"[AUTO] Errore nel server {guild.id}:", e)
+
+    await asyncio.gather(*(one(g) for g in list(guilds if guilds is not None else bot.guilds)))
+
+# ---------- Template messaggi ----------
+
+# Tutti i testi del bot, per lingua. Gli slot {nome} vengono riempiti al
+# momento dell'invio; i layout vengono compilati una sola volta (per lingua,
+# chiavi e parti statiche come modificatore o tabella premi) e poi riusati.
+MESSAGES: Dict[str, Dict[str, str]] = {
+    "it": {
+        "embed.title": "📜  {title}  📜",
+        "embed.footer": "IMPERIVM • Lotteria settimanale",
+
+        "prize.level": "{amount}",
+        "prize.level.reset": "{amount} *(reset a Livello 1)*",
+
+        "open.title": "LOTTERIA IMPERIVM – APERTA",
+        "open.classic": (
+            "Cittadini dell'Impero 👑\n"
+            "La Lotteria Imperiale è ufficialmente **aperta**.\n\n"
+            "Reagite con ✅ per partecipare all’estrazione.\n\n"
+            "⚔️ Premi base per livello:\n"
+            "1️⃣ Livello 1 → {prize_1}\n"
+            "2️⃣ Livello 2 → {prize_2}\n"
+            "3️⃣ Livello 3 → {prize_3}\n\n"
+            "{winners_line}"
+            "{modifier_block}\n\n"
+            "**Edizione n°{edition} (Classica)**\n\n"
+            "⏳ La lotteria chiuderà alle **{close_time}**"
+        ),
+        "open.winners_line": "🏆 Vincitori per edizione: **{n}**\n\n",
+        "open.special": (
+            "Cittadini dell'Impero 👑\n"
+            "**EDIZIONE SPECIALE** sotto gli stendardi bianco e rosso dell’IMPERIVM!\n"
+            "Da ora fino alle {close_time}, la sorte si farà capricciosa e magnanima. 🧾\n\n"
+            "Reagite con ✅ a questo messaggio per partecipare.\n\n"
+            "⚙️ **Modificatori:** OFF\n"
+            "💎 **Borsa dei Premi Speciale (casuali):** {prize_pool}\n\n"
+            "**Edizione n°{edition} (SPECIALE)**\n\n"
+            "🕗 *Annuncio del vincitore alle **{announce_hour}**{announce_day}.*"
+        ),
+
+        "modifier.open.INT": (
+            "🧠 **MODIFICATORE ATTIVO — ELEMENTO INTELLIGENCE**\n"
+            "+30% Kama sul premio finale del vincitore"
+        ),
+        "modifier.open.CHA": (
+            "🍀 **MODIFICATORE ATTIVO — ELEMENTO CHANCE**\n"
+            "Doppia estrazione: verranno scelti **{n_words} vincitori**\n"
+            "{all_receive} il premio completo in base al livello"
+        ),
+        "modifier.open.both": "Entrambi ricevono",
+        "modifier.open.all": "Tutti ricevono",
+        "modifier.open.AGI": (
+            "🌪️ **MODIFICATORE ATTIVO — ELEMENTO AGILITY**\n"
+            "+50% probabilità ai partecipanti con livello più basso"
+        ),
+        "modifier.open.STR": (
+            "💪 **MODIFICATORE ATTIVO — ELEMENTO STRENGTH**\n"
+            "Premio raddoppiato — livello non avanza (L1/L2)\n"
+            "Se vinci da Livello 3 → reset immediato a Livello 1"
+        ),
+        "modifier.open.OFF": "⚙️ **MODIFICATORE ATTIVO:** OFF",
+
+        "close.title": "LOTTERIA IMPERIVM – CHIUSA",
+        "close.empty": (
+            "La sorte ha parlato… 😕  **Nessun partecipante valido** {period}.\n"
+            "Torniamo {next_open}! 👑"
+        ),
+        "close.period.week": "questa settimana",
+        "close.period.day": "oggi",
+        "close.body": (
+            "I sigilli sono stati chiusi.\n"
+            "I nomi sono stati consegnati al Fato.\n\n"
+            "{preview}"
+            "⚙️ {modifier_line}\n\n"
+            "🕗 **Annuncio del vincitore alle {announce_time}**."
+        ),
+        "close.modifiers.classic": "Modificatore attivo: **{label}**",
+        "close.modifiers.special": "Modificatori: **OFF**",
+
+        "winner.title": "ESTRAZIONE UFFICIALE – LOTTERIA IMPERIVM",
+        "winner.title.multi": "ESTRAZIONE {roman} – LOTTERIA IMPERIVM",
+        "winner.none": (
+            "Cittadini dell’Impero,\n"
+            "i sigilli sono stati spezzati… ma nessun nome è stato scelto.\n"
+            "Riproveremo {next_open}. 🕯️"
+        ),
+        "winner.header": (
+            "Cittadini dell’Impero,\n"
+            "i sigilli sono stati spezzati e il Fato ha pronunciato il suo verdetto.\n\n"
+            "👑 **Vincitore:** {mention}\n"
+            "🎖️ **Livello (prima della vittoria):** {prev_level}\n"
+            "📌 **Nuovo livello:** {level}\n\n"
+        ),
+        "winner.header.multi": (
+            "👑 **Vincitore {roman}:** {mention}\n"
+            "🎖️ **Livello (prima della vittoria):** {prev_level}\n"
+            "📌 **Nuovo livello:** {level}\n\n"
+        ),
+        "winner.body.INT": (
+            "🧠 **Elemento Intelligence attivo**\n\n"
+            "💰 **Ricompensa finale: {amount}**\n"
+            "(+30% già applicato)"
+        ),
+        "winner.body.AGI": (
+            "🌪️ **Elemento Agility attivo**\n"
+            "Bonus probabilità livello più basso applicato\n\n"
+            "💰 **Ricompensa:** {prize}"
+        ),
+        "winner.body.CHA": (
+            "🍀 **Elemento Chance attivo**\n\n"
+            "💰 **Ricompensa:** {prize}"
+        ),
+        "winner.body.STR": (
+            "💪 **Elemento Strength attivo**\n\n"
+            "💰 **Ricompensa finale: {amount}**\n"
+            "📌 {extra}"
+        ),
+        "winner.body.OFF": "💰 **Ricompensa:** {prize}",
+        "winner.str.reset": "✅ Reset a Livello 1 applicato",
+        "winner.str.hold": "Livello fermo (non avanza)",
+
+        "special.title": "ESTRAZIONE UFFICIALE – EDIZIONE SPECIALE",
+        "special.none": (
+            "I sigilli sono stati spezzati, ma stavolta il fato è rimasto muto.\n"
+            "Nessun nome scolpito negli annali: riproveremo {next_open}. 🕯️"
+        ),
+        "special.winner": (
+            "Cittadini dell’Impero, il sigillo dorato è stato infranto.\n"
+            "Tra pergamene e ceralacca, il nome inciso negli annali è stato scelto.\n\n"
+            "👑 **Vincitore:** {mention}\n"
+            "🎖️ **Livello classico (solo informativo):** {level}\n"
+            "⚙️ **Modificatori:** OFF\n"
+            "💎 **Ricompensa Speciale:** {amount}\n\n"
+            "Questa edizione **non modifica** i livelli.\n"
+            "Che la fortuna continui a sorriderti."
+        ),
+    },
+}
+DEFAULT_LOCALE = "it"
+
+def load_message_overrides():
+    """Unisce a MESSAGES i testi di MESSAGES_FILE (stessa forma: lingua -> chiave -> testo)."""
+    if not MESSAGES_FILE:
+        return
+    try:
+        with open(MESSAGES_FILE, "r", encoding="utf-8") as fh:
+            raw = json.load(fh)
+    except (OSError, ValueError) as e:
+        print("[TEXT] File testi non leggibile, uso i testi predefiniti:", e)
+        return
+    for locale, texts in (raw.items() if isinstance(raw, dict) else []):
+        if isinstance(texts, dict):
+            MESSAGES.setdefault(str(locale), {}).update({str(k): str(v) for k, v in texts.items()})
+    _compile_layout.cache_clear()
+
+def message_text(key: str, locale: Optional[str] = None) -> str:
+    texts = MESSAGES.get(locale or BOT_LOCALE) or {}
+    if key in texts:
+        return texts[key]
+    return MESSAGES[DEFAULT_LOCALE][key]
+
+_FORMATTER = string.Formatter()
+
+class MessageTemplate:
+    """Layout compilato: testo statico già unito, restano solo gli slot variabili."""
+
+    __slots__ = ("parts", "tail", "slots")
+
+    def __init__(self, text: str, static: Dict[str, object]):
+        parts: List[Tuple[str, str]] = []
+        buf = ""
+        for literal, field, _spec, _conv in _FORMATTER.parse(text):
+            buf += literal
+            if field is None:
+                continue
+            if field in static:
+                buf += str(static[field])
+                continue
+            parts.append((buf, field))
+            buf = ""
+        self.parts = tuple(parts)
+        self.tail = buf
+        self.slots = frozenset(f for _, f in parts)
+
+    def render(self, **values) -> str:
+        out: List[str] = []
+        for literal, field in self.parts:
+            out.append(literal)
+            out.append(str(values[field]))
+        out.append(self.tail)
+        return "".join(out)
+
+@functools.lru_cache(maxsize=512)
+def _compile_layout(locale: str, keys: Tuple[str, ...], static: Tuple[Tuple[str, object], ...]) -> MessageTemplate:
+    return MessageTemplate("".join(message_text(k, locale) for k in keys), dict(static))
+
+def layout(*keys: str, locale: Optional[str] = None, **static) -> MessageTemplate:
+    """Layout compilato per le chiavi date (concatenate), con le parti statiche già inserite."""
+    return _compile_layout(locale or BOT_LOCALE, keys, tuple(sorted(static.items())))
+
+def tr(key: str, **values) -> str:
+    return layout(key).render(**values)
+
+load_message_overrides()
 
 # ---------- Utility ----------
 
@@ -225,22 +2038,53 @@ def admin_only_command():
         return func
     return deco
 
-async def get_lottery_channel(guild: Optional[discord.Guild]) -> Optional[discord.TextChannel]:
+async def get_lottery_channel(guild: Optional[discord.Guild], lot: Optional["LotteryDef"] = None) -> Optional[discord.TextChannel]:
     if guild is None:
         return None
 
-    if LOTTERY_CHANNEL_ID:
-        ch = guild.get_channel(LOTTERY_CHANNEL_ID)
+    for channel_id in (gstate().get("channel_id"), lot.channel_id if lot is not None else 0, LOTTERY_CHANNEL_ID):
+        ch = guild.get_channel(channel_id) if channel_id else None
         if isinstance(ch, discord.TextChannel):
             return ch
 
     return guild.text_channels[0] if guild.text_channels else None
 
 def imperial_embed(title: str, desc: str, color: discord.Color = GOLD) -> discord.Embed:
-    e = discord.Embed(title=f"📜  {title}  📜", description=desc, color=color)
-    e.set_footer(text="IMPERIVM • Lotteria settimanale")
+    e = discord.Embed(title=tr("embed.title", title=title), description=desc, color=color)
+    e.set_footer(text=tr("embed.footer"))
     return e
 
+# Limiti Discord per singolo messaggio: max 10 embed e 6000 caratteri totali.
+EMBEDS_PER_MESSAGE = 10
+EMBED_CHARS_PER_MESSAGE = 6000
+
+def batch_embeds(embeds: List[discord.Embed]) -> List[List[discord.Embed]]:
+    """Raggruppa gli embed in blocchi inviabili con una sola chiamata."""
+    batches: List[List[discord.Embed]] = []
+    cur: List[discord.Embed] = []
+    chars = 0
+    for e in embeds:
+        size = len(e)
+        if cur and (len(cur) >= EMBEDS_PER_MESSAGE or chars + size > EMBED_CHARS_PER_MESSAGE):
+            batches.append(cur)
+            cur, chars = [], 0
+        cur.append(e)
+        chars += size
+    if cur:
+        batches.append(cur)
+    return batches
+
+async def send_embeds(send, embeds: List[discord.Embed], **kwargs) -> list:
+    """Invia embed già costruiti col minor numero di messaggi (send = channel.send o followup.send)."""
+    sent = []
+    for batch in batch_embeds(embeds):
+        if len(batch) == 1:
+            sent.append(await send(embed=batch[0], **kwargs))
+        else:
+            sent.append(await send(embeds=batch, **kwargs))
+        txn_sent()
+    return sent
+
 def week_key(dt: datetime) -> str:
     iso = dt.isocalendar()
     return f"{iso[0]}-{iso[1]:02d}"
@@ -251,74 +2095,522 @@ def now_tz() -> datetime:
 def fmt_kama(n: int) -> str:
     return f"{n:,}".replace(",", ".") + " Kama"
 
+# Nomi visualizzati: cache LRU in memoria alimentata dagli eventi membro e dal
+# tracker delle reazioni, per (server, utente): i nickname sono per server.
+# "names" del registro del server viene scritto solo per gli utenti già
+# presenti e solo quando il nome cambia davvero.
+_NAME_CACHE: "OrderedDict[Tuple[Optional[int], int], str]" = OrderedDict()
+
+def cache_name(uid: int, display_name: str, persist: bool = False):
+    if not display_name:
+        return
+    key = (CURRENT_GUILD.get(), uid)
+    _NAME_CACHE[key] = display_name
+    _NAME_CACHE.move_to_end(key)
+    if len(_NAME_CACHE) > NAME_CACHE_SIZE:
+        _NAME_CACHE.popitem(last=False)
+
+    players = guild_players()
+    rec = players.ensure(uid) if persist else players.get(uid)
+    if rec is not None and rec.name != display_name:
+        rec.name = display_name
+        players.changed(rec, "names")
+        save_state()
+
 def remember_name(uid: int, display_name: str):
-    if display_name:
-        STATE.setdefault("names", {})
-        STATE["names"][str(uid)] = display_name
+    cache_name(uid, display_name, persist=True)
 
 def name_fallback(uid: int) -> str:
-    return STATE.get("names", {}).get(str(uid), f"utente {uid}")
+    rec = guild_players().get(uid)
+    return rec.name if rec is not None and rec.name else f"utente {uid}"
+
+def display_name_for(guild: Optional[discord.Guild], uid: int) -> str:
+    key = (CURRENT_GUILD.get(), uid)
+    name = _NAME_CACHE.get(key)
+    if name is not None:
+        _NAME_CACHE.move_to_end(key)
+        return name
+    member = guild.get_member(uid) if guild is not None else None
+    if member:
+        cache_name(uid, member.display_name)
+        return member.display_name
+    return name_fallback(uid)
 
 def require_guild(inter: discord.Interaction) -> bool:
     return inter.guild is not None
 
-def clear_user_state(uid: str):
-    STATE.get("wins", {}).pop(uid, None)
-    STATE.get("victories", {}).pop(uid, None)
-    STATE.get("cycles", {}).pop(uid, None)
-    STATE.get("last_win_iso", {}).pop(uid, None)
-    STATE.get("names", {}).pop(uid, None)
+def clear_user_state(uid: int):
+    guild_players().remove(uid)
 
 def mode_label(mode: Optional[str]) -> str:
     return "SPECIALE" if mode == "special" else "CLASSICA"
 
 def automation_label() -> str:
-    return "ON" if STATE.get("automation_enabled", True) else "OFF"
+    return "ON" if gstate().get("automation_enabled", True) else "OFF"
 
 def get_future_effective_modifier() -> Optional[str]:
     """Modificatore che verrebbe usato alla prossima apertura classica."""
-    if STATE.get("lottery_mode", "classic") != "classic":
+    if gstate().get("lottery_mode", "classic") != "classic":
         return None
 
-    override = STATE.get("test_override_modifier")
+    override = gstate().get("test_override_modifier")
     if override in {MOD_INT, MOD_CHA, MOD_AGI, MOD_STR}:
         return override
 
     ensure_weekly_modifier()
-    return STATE.get("weekly_modifier")
-
-def in_time_window(now: datetime, target_weekday: int, target_hour: int, window_minutes: int = AUTO_WINDOW_MINUTES) -> bool:
-    """
-    True se siamo nel giorno/ora target e il minuto è dentro la finestra utile.
-    Esempio: 00:00 -> 00:09 se AUTO_WINDOW_MINUTES=10
-    """
-    return (
-        now.weekday() == target_weekday
-        and now.hour == target_hour
-        and 0 <= now.minute < window_minutes
+    return gstate().get("weekly_modifier")
+
+# ---------- Calendario lotterie ----------
+
+WEEKDAYS_IT = ("lunedì", "martedì", "mercoledì", "giovedì", "venerdì", "sabato", "domenica")
+
+class CronSpec:
+    """Espressione cron a 5 campi (minuto ora giorno mese giorno-settimana), valutata in TZ."""
+    __slots__ = ("expr", "minutes", "hours", "days", "months", "weekdays", "_dom_any", "_dow_any")
+
+    _RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expr: str):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron non valido (servono 5 campi): {expr!r}")
+        self.expr = expr
+        parsed = [self._field(f, lo, hi) for f, (lo, hi) in zip(fields, self._RANGES)]
+        self.minutes, self.hours, self.days, self.months, dow = parsed
+        self.weekdays = {d % 7 for d in dow}   # cron: 0 e 7 = domenica
+        self._dom_any = fields[2] == "*"
+        self._dow_any = fields[4] == "*"
+
+    @staticmethod
+    def _field(text: str, lo: int, hi: int) -> List[int]:
+        values = set()
+        for part in text.split(","):
+            rng, _, step = part.partition("/")
+            if rng == "*":
+                a, b = lo, hi
+            elif "-" in rng:
+                a, b = (int(x) for x in rng.split("-", 1))
+            else:
+                a = b = int(rng)
+                if step:
+                    b = hi
+            if a < lo or b > hi or a > b:
+                raise ValueError(f"valore cron fuori intervallo: {part!r}")
+            values.update(range(a, b + 1, int(step) if step else 1))
+        return sorted(values)
+
+    def _day_matches(self, day) -> bool:
+        if day.month not in self.months:
+            return False
+        dom = day.day in self.days
+        dow = (day.weekday() + 1) % 7 in self.weekdays
+        if self._dom_any or self._dow_any:
+            return dom and dow
+        return dom or dow
+
+    def next_after(self, after: datetime) -> datetime:
+        """Prima occorrenza strettamente dopo `after` (ora locale, DST incluso)."""
+        after = after.astimezone(TZ)
+        start = after.date()
+        for i in range(366 * 4):
+            day = start + timedelta(days=i)
+            if not self._day_matches(day):
+                continue
+            for h in self.hours:
+                for m in self.minutes:
+                    when = TZ.normalize(TZ.localize(datetime(day.year, day.month, day.day, h, m)))
+                    if when > after:
+                        return when
+        raise ValueError(f"cron senza occorrenze future: {self.expr!r}")
+
+LOTTERY_EVENTS = ("open", "close", "announce")
+DEFAULT_LOTTERY_ID = "weekly"
+
+class LotteryDef:
+    """Definizione di una lotteria del calendario: orari cron, modalità, canale."""
+    __slots__ = ("id", "name", "open", "close", "announce", "mode", "modifiers", "channel_id", "period")
+
+    def __init__(
+        self,
+        id: str,
+        open: str,
+        close: str,
+        announce: str,
+        name: Optional[str] = None,
+        mode: Optional[str] = None,
+        modifiers: bool = True,
+        channel_id: int = 0,
+        period: str = "week",
+    ):
+        if mode not in {None, "classic", "special"}:
+            raise ValueError(f"lotteria {id}: modalità non valida {mode!r}")
+        if period not in {"week", "day"}:
+            raise ValueError(f"lotteria {id}: periodo non valido {period!r}")
+        self.id = str(id)
+        self.name = name or self.id
+        self.open = CronSpec(open)
+        self.close = CronSpec(close)
+        self.announce = CronSpec(announce)
+        self.mode = mode              # None = segue /modalita (lottery_mode del server)
+        self.modifiers = bool(modifiers)
+        self.channel_id = int(channel_id or 0)
+        self.period = period          # "week"/"day": chiave anti-duplicato degli eventi
+        # un cron che non scatta mai (es. 30 febbraio) fermerebbe lo scheduler: si scarta ora
+        for event in LOTTERY_EVENTS:
+            try:
+                self.cron(event).next_after(now_tz())
+            except ValueError:
+                raise ValueError(f"lotteria {id}: evento {event} senza occorrenze ({self.cron(event).expr!r})") from None
+
+    def cron(self, event: str) -> CronSpec:
+        return getattr(self, event)
+
+    def period_key(self, when: datetime) -> str:
+        return week_key(when) if self.period == "week" else when.strftime("%Y-%m-%d")
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "LotteryDef":
+        keys = ("id", "name", "open", "close", "announce", "mode", "modifiers", "channel_id", "period")
+        return cls(**{k: data[k] for k in keys if k in data})
+
+def _default_lottery() -> LotteryDef:
+    return LotteryDef(
+        DEFAULT_LOTTERY_ID,
+        open="0 0 * * 3",        # mercoledì 00:00
+        close="0 0 * * 4",       # giovedì 00:00
+        announce="0 8 * * 4",    # giovedì 08:00
+        name="Settimanale",
+        channel_id=LOTTERY_CHANNEL_ID,
     )
 
-async def catch_up_automation_now():
+def load_lottery_defs() -> Dict[str, LotteryDef]:
+    raw: List[Dict] = []
+    try:
+        if LOTTERIES_FILE:
+            with open(LOTTERIES_FILE, "r", encoding="utf-8") as fh:
+                raw = json.load(fh)
+        elif LOTTERIES_JSON:
+            raw = json.loads(LOTTERIES_JSON)
+    except (OSError, ValueError) as e:
+        print("[LOTTERY] Calendario lotterie non leggibile, uso solo la settimanale:", e)
+        raw = []
+
+    defs = {DEFAULT_LOTTERY_ID: _default_lottery()}
+    for item in raw if isinstance(raw, list) else []:
+        try:
+            lot = LotteryDef.from_dict(item)
+        except (TypeError, ValueError, KeyError) as e:
+            print("[LOTTERY] Definizione lotteria scartata:", e)
+            continue
+        if item.get("enabled", True):
+            defs[lot.id] = lot
+        else:
+            defs.pop(lot.id, None)
+    return defs
+
+LOTTERY_DEFS: Dict[str, LotteryDef] = load_lottery_defs()
+
+# Chiavi di stato di ogni lotteria: per "weekly" nel server home sono le chiavi
+# top-level di STATE (schema invariato), per le altre vivono in
+# gstate()["lotteries"][id]
+LOTTERY_STATE_DEFAULTS = {
+    "edition": 1,
+    "open_message_id": None,
+    "entrants": {},
+    "last_winner_id": None,
+    "last_winner_ids": [],
+    "last_winner_prev_levels": {},
+    "last_winner_reset_flags": {},
+    "last_special_prize": None,
+    "active_modifier": None,
+    "open_winner_count": None,
+    "last_open_week": None,
+    "last_close_week": None,
+    "last_announce_week": None,
+}
+
+def default_lottery() -> LotteryDef:
+    return LOTTERY_DEFS.get(DEFAULT_LOTTERY_ID) or _default_lottery()
+
+def lottery_state(lot: Optional[LotteryDef] = None, create: bool = False) -> Dict:
+    """Stato della lotteria nel server corrente; create come per gstate()."""
+    lot = lot or default_lottery()
+    ns = gstate(create)
+    if lot.id == DEFAULT_LOTTERY_ID and ns is STATE:
+        return STATE
+    ls = (ns.get("lotteries") or {}).get(lot.id)
+    if ls is not None:
+        return ls
+    if not create:
+        return copy.deepcopy(LOTTERY_STATE_DEFAULTS)
+    lots = ns.setdefault("lotteries", {})
+    lots[lot.id] = copy.deepcopy(LOTTERY_STATE_DEFAULTS)
+    return lots[lot.id]
+
+_TXN_LOCKS: Dict[Optional[int], asyncio.Lock] = {}
+_OPEN_TXNS = 0
+_TXNS_IDLE: Optional[asyncio.Event] = None
+
+def _txns_idle() -> asyncio.Event:
+    global _TXNS_IDLE
+    if _TXNS_IDLE is None:
+        _TXNS_IDLE = asyncio.Event()
+        if not _OPEN_TXNS:
+            _TXNS_IDLE.set()
+    return _TXNS_IDLE
+
+def txn_sent():
+    """Segna che la transazione corrente ha pubblicato un messaggio: da qui niente rollback."""
+    txn = _TXN.get()
+    if txn is not None:
+        txn.external = True
+
+def _commit_txn(txn: StateTransaction):
+    if STATE.journal is not None:
+        STATE.journal.commit(txn)
+    if txn.save_pending:
+        save_state(force=txn.save_force)
+
+@contextlib.asynccontextmanager
+async def lottery_txn(lot: Optional[LotteryDef] = None):
     """
-    Recupera eventi automatici se il bot si avvia/riavvia dentro la finestra utile.
-    Non duplica grazie ai last_*_week.
+    Transazione sullo stato del server corrente (lotterie, chiavi del server
+    e registro utenti): lock per server (comandi admin e automazione si
+    serializzano), rollback delle chiavi toccate se il blocco solleva
+    un'eccezione prima di aver pubblicato messaggi e un solo salvataggio al
+    commit. Il writer non salva finché c'è una transazione aperta. Una
+    transazione aperta nello stesso task viene riusata (nessun deadlock).
     """
-    if not STATE.get("automation_enabled", True):
+    global _OPEN_TXNS
+    if _TXN.get() is not None:
+        yield _TXN.get()
         return
 
-    now = now_tz()
+    lot = lot or default_lottery()
+    key = CURRENT_GUILD.get() or home_guild_id()
+    lock = _TXN_LOCKS.setdefault(key, asyncio.Lock())
+    async with lock:
+        txn = StateTransaction(key)
+        token = _TXN.set(txn)
+        _OPEN_TXNS += 1
+        _txns_idle().clear()
+        try:
+            yield txn
+        except BaseException:
+            _TXN.reset(token)
+            if txn.external:
+                # messaggio già pubblicato: lo stato deve restare coerente con Discord
+                print(f"[STATE] Transazione {lot.id} interrotta dopo un invio: modifiche mantenute")
+                txn.save_force = True
+                txn.save_pending = True
+                _commit_txn(txn)
+            else:
+                txn.rollback(STATE)
+                print(f"[STATE] Transazione {lot.id} annullata: {len(txn.undo)} chiavi e {len(txn.players)} utenti ripristinati")
+                save_state(force=True)
+            raise
+        else:
+            _TXN.reset(token)
+            _commit_txn(txn)
+        finally:
+            _OPEN_TXNS -= 1
+            if not _OPEN_TXNS:
+                _txns_idle().set()
+
+def lottery_mode_for(lot: LotteryDef) -> str:
+    return lot.mode or gstate().get("lottery_mode", "classic")
+
+def event_time_parts(lot: LotteryDef, event: str) -> Tuple[str, str]:
+    """Es. ("08:00", " di giovedì"): ora e giorno della prossima occorrenza dell'evento."""
+    when = lot.cron(event).next_after(now_tz())
+    if lot.period == "day":
+        return f"{when:%H:%M}", ""
+    return f"{when:%H:%M}", f" di {WEEKDAYS_IT[when.weekday()]}"
+
+def event_time_label(lot: LotteryDef, event: str) -> str:
+    """Es. "00:00 di giovedì" (prossima occorrenza dell'evento)."""
+    return "".join(event_time_parts(lot, event))
+
+def event_schedule_label(lot: LotteryDef, event: str) -> str:
+    """Es. "Giovedì 08:00" oppure "Ogni giorno 08:00" (prossima occorrenza dell'evento)."""
+    when = lot.cron(event).next_after(now_tz())
+    day = "Ogni giorno" if lot.period == "day" else WEEKDAYS_IT[when.weekday()].capitalize()
+    return f"{day} {when:%H:%M}"
+
+def next_open_phrase(lot: LotteryDef) -> str:
+    if lot.period == "day":
+        return "domani"
+    day = WEEKDAYS_IT[lot.open.next_after(now_tz()).weekday()]
+    return f"{day} {'prossima' if day == 'domenica' else 'prossimo'}"
+
+# ---------- Tracciamento ----------
+
+# Span temporizzati sul ciclo apertura → chiusura → annuncio. Ogni span
+# eredita dal padre (ContextVar) la traccia e i tag dell'edizione: server,
+# lotteria, edizione, settimana e modalità; il modificatore è letto alla fine
+# dello span, perché all'apertura viene scelto durante lo span stesso. Gli span
+# finiti vanno in coda a un thread che li scrive come righe JSON in TRACE_PATH
+# (niente I/O sul loop); /profilo li riassume.
+
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "true").strip().lower() in {"1", "true", "yes", "on"}
+TRACE_PATH = os.getenv("TRACE_PATH") or os.path.join(STATE_DIR, "imperivm_trace.jsonl")
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(5 * 1024 * 1024)))
+
+class Span:
+    __slots__ = ("name", "parent", "lot", "guild", "tags", "ts", "start", "error")
+
+    def __init__(self, name: str, parent: Optional["Span"], lot: "LotteryDef", guild: Optional[int], tags: Dict):
+        self.name = name
+        self.parent = parent
+        self.lot = lot
+        self.guild = guild            # CURRENT_GUILD all'inizio dello span
+        self.tags = tags
+        self.ts = time.time()
+        self.start = time.perf_counter()
+        self.error: Optional[str] = None
+
+_SPAN: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("TRACE_SPAN", default=None)
+
+def _edition_tags(lot: "LotteryDef", stage: str, when: Optional[datetime]) -> Dict:
+    gid = CURRENT_GUILD.get() or home_guild_id() or 0
+    tags = {"trace": f"{gid}:{lot.id}:?", "guild": gid, "lottery": lot.id, "stage": stage}
+    try:
+        edition = int(lottery_state(lot).get("edition") or 1)
+        # dopo l'apertura "edition" è già la prossima: chiusura e annuncio riguardano quella prima
+        if stage != "open":
+            edition = max(1, edition - 1)
+        tags.update({
+            "trace": f"{gid}:{lot.id}:{edition}",
+            "edition": edition,
+            "week": lot.period_key(when or now_tz()),
+            "mode": lottery_mode_for(lot),
+        })
+    except Exception as e:
+        print(f"[TRACE] Tag edizione non disponibili ({lot.id}):", e)
+    return tags
 
-    # Mercoledì 00:00-00:09 -> apertura
-    if in_time_window(now, target_weekday=2, target_hour=0):
-        await run_auto_open()
+def _span_modifier(sp: Span) -> Optional[str]:
+    """Modificatore a fine span, letto nel server in cui lo span è iniziato; mai un'eccezione."""
+    token = CURRENT_GUILD.set(sp.guild)
+    try:
+        return lottery_modifier(sp.lot, lottery_state(sp.lot))
+    except Exception:
+        return None
+    finally:
+        CURRENT_GUILD.reset(token)
 
-    # Giovedì 00:00-00:09 -> chiusura
-    if in_time_window(now, target_weekday=3, target_hour=0):
-        await run_auto_close()
+_TRACE_QUEUE: "queue.Queue[Dict]" = queue.Queue(maxsize=10_000)
+_TRACE_LOCK = threading.Lock()
+_TRACE_THREAD: Optional[threading.Thread] = None
 
-    # Giovedì 08:00-08:09 -> annuncio
-    if in_time_window(now, target_weekday=3, target_hour=8):
-        await run_auto_announce()
+def _write_spans(records: List[Dict]):
+    with _TRACE_LOCK:
+        try:
+            if os.path.exists(TRACE_PATH) and os.path.getsize(TRACE_PATH) > TRACE_MAX_BYTES:
+                os.replace(TRACE_PATH, TRACE_PATH + ".1")
+            with open(TRACE_PATH, "a", encoding="utf-8") as fh:
+                fh.write("".join(json.dumps(r, separators=(",", ":")) + "\n" for r in records))
+        except OSError as e:
+            print("[TRACE] Scrittura span fallita:", e)
+
+def _drain_trace_queue() -> List[Dict]:
+    batch = []
+    while True:
+        try:
+            batch.append(_TRACE_QUEUE.get_nowait())
+        except queue.Empty:
+            return batch
+
+def _trace_writer():
+    while True:
+        # un'unica scrittura per tutti gli span arrivati nel frattempo
+        batch = [_TRACE_QUEUE.get()] + _drain_trace_queue()
+        _write_spans(batch)
+
+def flush_trace():
+    """Scrive subito gli span ancora in coda (uscita del processo)."""
+    batch = _drain_trace_queue()
+    if batch:
+        _write_spans(batch)
+
+def _emit_span(record: Dict):
+    global _TRACE_THREAD
+    if _TRACE_THREAD is None or not _TRACE_THREAD.is_alive():
+        _TRACE_THREAD = threading.Thread(target=_trace_writer, name="trace-writer", daemon=True)
+        _TRACE_THREAD.start()
+    try:
+        _TRACE_QUEUE.put_nowait(record)
+    except queue.Full:
+        pass   # disco lento o bloccato: meglio perdere uno span che rallentare il loop
+
+atexit.register(flush_trace)
+
+@contextlib.contextmanager
+def span(name: str, lot: Optional["LotteryDef"] = None, stage: str = "", when: Optional[datetime] = None):
+    """Span temporizzato: dentro un altro span ne eredita traccia e tag."""
+    parent = _SPAN.get()
+    if not TRACE_ENABLED:
+        yield None
+        return
+    if parent is not None:
+        sp = Span(name, parent, parent.lot, parent.guild, parent.tags)
+    else:
+        lot = lot or default_lottery()
+        sp = Span(name, None, lot, CURRENT_GUILD.get(), _edition_tags(lot, stage, when))
+    token = _SPAN.set(sp)
+    try:
+        yield sp
+    except BaseException as e:
+        sp.error = type(e).__name__
+        raise
+    finally:
+        ms = (time.perf_counter() - sp.start) * 1000.0
+        _SPAN.reset(token)
+        record = dict(sp.tags)
+        record.update({
+            "ts": int(sp.ts),
+            "span": name,
+            "parent": parent.name if parent is not None else None,
+            "ms": round(ms, 2),
+            "modifier": _span_modifier(sp),
+        })
+        if sp.error:
+            record["error"] = sp.error
+        _emit_span(record)
+
+def traced(stage: str):
+    """Decoratore: esegue la coroutine in uno span col suo nome (lot e when dagli argomenti)."""
+    def deco(func):
+        sig = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            bound = sig.bind_partial(*args, **kwargs).arguments
+            with span(func.__name__, bound.get("lot"), stage, bound.get("when")):
+                return await func(*args, **kwargs)
+        return wrapper
+    return deco
+
+def read_trace_editions(guild_id: int, n: int) -> List[List[Dict]]:
+    """Span delle ultime n edizioni tracciate del server (dalla più recente)."""
+    by_trace: "OrderedDict[str, List[Dict]]" = OrderedDict()
+    for path in (TRACE_PATH + ".1", TRACE_PATH):
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                lines = deque(fh, maxlen=5000)
+        except OSError:
+            continue
+        for line in lines:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if rec.get("guild") != guild_id:
+                continue
+            trace = rec.get("trace")
+            by_trace.setdefault(trace, []).append(rec)
+            by_trace.move_to_end(trace)
+    return list(by_trace.values())[::-1][:n]
 
 # ---------- Modificatori ----------
 
@@ -346,30 +2638,37 @@ def lottery_color_for_modifier(mod: Optional[str]) -> discord.Color:
         return COLOR_STR
     return GOLD
 
-def modifier_open_block(mod: str) -> List[str]:
-    if mod == MOD_INT:
-        return [
-            "🧠 **MODIFICATORE ATTIVO — ELEMENTO INTELLIGENCE**",
-            "+30% Kama sul premio finale del vincitore",
-        ]
+def _roman(n: int) -> str:
+    out = ""
+    for value, sym in ((10, "X"), (9, "IX"), (5, "V"), (4, "IV"), (1, "I")):
+        while n >= value:
+            out += sym
+            n -= value
+    return out
+
+_NUMBER_WORDS = {2: "DUE", 3: "TRE", 4: "QUATTRO", 5: "CINQUE", 6: "SEI", 8: "OTTO", 10: "DIECI"}
+
+def winners_for_modifier(mod: Optional[str], ls: Optional[Dict] = None) -> int:
+    """
+    Quanti vincitori estrarre in un'edizione classica con il modificatore `mod`:
+    quelli annunciati all'apertura della lotteria `ls`, se presenti, altrimenti
+    l'impostazione attuale del server.
+    """
+    count = ls.get("open_winner_count") if ls is not None else None
+    try:
+        base = max(1, min(MAX_WINNERS, int(count or gstate().get("winner_count") or 1)))
+    except (TypeError, ValueError):
+        base = 1
+    return base * 2 if mod == MOD_CHA else base
+
+def modifier_open_block(mod: Optional[str]) -> str:
     if mod == MOD_CHA:
-        return [
-            "🍀 **MODIFICATORE ATTIVO — ELEMENTO CHANCE**",
-            "Doppia estrazione: verranno scelti **DUE vincitori**",
-            "Entrambi ricevono il premio completo in base al livello",
-        ]
-    if mod == MOD_AGI:
-        return [
-            "🌪️ **MODIFICATORE ATTIVO — ELEMENTO AGILITY**",
-            "+50% probabilità ai partecipanti con livello più basso",
-        ]
-    if mod == MOD_STR:
-        return [
-            "💪 **MODIFICATORE ATTIVO — ELEMENTO STRENGTH**",
-            "Premio raddoppiato — livello non avanza (L1/L2)",
-            "Se vinci da Livello 3 → reset immediato a Livello 1",
-        ]
-    return ["⚙️ **MODIFICATORE ATTIVO:** OFF"]
+        n = winners_for_modifier(MOD_CHA)
+        receive = tr("modifier.open.both" if n == 2 else "modifier.open.all")
+        return layout("modifier.open.CHA", n_words=_NUMBER_WORDS.get(n, n), all_receive=receive).render()
+    if mod in {MOD_INT, MOD_AGI, MOD_STR}:
+        return tr(f"modifier.open.{mod}")
+    return tr("modifier.open.OFF")
 
 def pick_weekly_modifier() -> str:
     population = [MOD_INT, MOD_AGI, MOD_STR, MOD_CHA]
@@ -378,47 +2677,59 @@ def pick_weekly_modifier() -> str:
 
 def ensure_weekly_modifier():
     wk = week_key(now_tz())
-    if STATE.get("weekly_modifier_week") != wk or STATE.get("weekly_modifier") not in {MOD_INT, MOD_CHA, MOD_AGI, MOD_STR}:
-        STATE["weekly_modifier"] = pick_weekly_modifier()
-        STATE["weekly_modifier_week"] = wk
+    if gstate().get("weekly_modifier_week") != wk or gstate().get("weekly_modifier") not in {MOD_INT, MOD_CHA, MOD_AGI, MOD_STR}:
+        ns = gstate(create=True)
+        ns["weekly_modifier"] = pick_weekly_modifier()
+        ns["weekly_modifier_week"] = wk
         save_state()
 
 def get_effective_modifier_for_open() -> str:
-    override = STATE.get("test_override_modifier")
+    override = gstate().get("test_override_modifier")
     if override in {MOD_INT, MOD_CHA, MOD_AGI, MOD_STR}:
         return override
     ensure_weekly_modifier()
-    return STATE["weekly_modifier"]
+    return gstate()["weekly_modifier"]
+
+def lottery_modifier(lot: "LotteryDef", ls: Dict) -> Optional[str]:
+    """Modificatore della lotteria in corso (None se la lotteria non li usa)."""
+    if not lot.modifiers:
+        return None
+    return ls.get("active_modifier") or gstate().get("weekly_modifier")
 
 # ---------- Livelli ----------
 
-def get_level(uid: str) -> int:
-    try:
-        v = int(STATE.get("wins", {}).get(uid, 1))
-    except Exception:
-        v = 1
-    return max(1, min(3, v))
+def get_level(uid: int) -> int:
+    rec = guild_players().get(uid)
+    if rec is None or rec.level is None:
+        return 1
+    return max(1, min(3, rec.level))
 
-def set_level(uid: str, lvl: int):
-    lvl = max(1, min(3, int(lvl)))
-    STATE.setdefault("wins", {})
-    STATE["wins"][uid] = lvl
+def set_level(uid: int, lvl: int):
+    players = guild_players()
+    rec = players.ensure(uid)
+    rec.level = max(1, min(3, int(lvl)))
+    players.changed(rec, "wins")
+
+BASE_PRIZES = {1: 100_000, 2: 250_000, 3: 500_000}
+SPECIAL_PRIZES = (600_000, 800_000, 1_000_000)
 
 def base_prize_amount_for_level(lvl: int) -> int:
-    if lvl == 1:
-        return 100_000
-    if lvl == 2:
-        return 250_000
-    return 500_000
+    return BASE_PRIZES.get(lvl, BASE_PRIZES[3])
 
 def base_prize_text_for_level(lvl: int) -> str:
-    if lvl == 1:
-        return "100.000 Kama"
-    if lvl == 2:
-        return "250.000 Kama"
-    return "500.000 Kama *(reset a Livello 1)*"
+    key = "prize.level.reset" if lvl >= 3 else "prize.level"
+    return tr(key, amount=fmt_kama(base_prize_amount_for_level(lvl)))
+
+def classic_prize_amount(mod: Optional[str], prev_lvl: int) -> int:
+    """Premio effettivo di un vincitore classico (INT +30%, STR x2)."""
+    base = base_prize_amount_for_level(prev_lvl)
+    if mod == MOD_INT:
+        return int(round(base * 1.30))
+    if mod == MOD_STR:
+        return base * 2
+    return base
 
-def advance_level_after_classic_win(uid: str, prev_lvl: int) -> Tuple[int, bool]:
+def advance_level_after_classic_win(uid: int, prev_lvl: int) -> Tuple[int, bool]:
     if prev_lvl == 1:
         new, cycle = 2, False
     elif prev_lvl == 2:
@@ -428,19 +2739,20 @@ def advance_level_after_classic_win(uid: str, prev_lvl: int) -> Tuple[int, bool]
     set_level(uid, new)
     return new, cycle
 
-def apply_classic_win_after_prize(uid: str, prev_lvl: int):
-    _, cycle = advance_level_after_classic_win(uid, prev_lvl)
-
-    STATE.setdefault("victories", {})
-    STATE.setdefault("cycles", {})
-    STATE.setdefault("last_win_iso", {})
-
-    STATE["victories"][uid] = int(STATE["victories"].get(uid, 0)) + 1
+def _record_win(uid: int, cycle: bool):
+    players = guild_players()
+    rec = players.ensure(uid)
+    rec.victories += 1
     if cycle:
-        STATE["cycles"][uid] = int(STATE["cycles"].get(uid, 0)) + 1
-    STATE["last_win_iso"][uid] = now_tz().isoformat(timespec="seconds")
+        rec.cycles += 1
+    rec.last_win = int(time.time())
+    players.changed(rec, "victories", "cycles", "last_win_ts")
 
-def apply_strength_win_after_prize(uid: str, prev_lvl: int) -> Tuple[int, bool]:
+def apply_classic_win_after_prize(uid: int, prev_lvl: int):
+    _, cycle = advance_level_after_classic_win(uid, prev_lvl)
+    _record_win(uid, cycle)
+
+def apply_strength_win_after_prize(uid: int, prev_lvl: int) -> Tuple[int, bool]:
     did_reset = False
     if prev_lvl == 3:
         set_level(uid, 1)
@@ -450,134 +2762,138 @@ def apply_strength_win_after_prize(uid: str, prev_lvl: int) -> Tuple[int, bool]:
         set_level(uid, prev_lvl)
         new = prev_lvl
 
-    STATE.setdefault("victories", {})
-    STATE.setdefault("cycles", {})
-    STATE.setdefault("last_win_iso", {})
-
-    STATE["victories"][uid] = int(STATE["victories"].get(uid, 0)) + 1
-    if did_reset:
-        STATE["cycles"][uid] = int(STATE["cycles"].get(uid, 0)) + 1
-    STATE["last_win_iso"][uid] = now_tz().isoformat(timespec="seconds")
+    _record_win(uid, did_reset)
     return new, did_reset
 
-def update_last_win_iso_only(uid: str):
-    STATE.setdefault("last_win_iso", {})
-    STATE["last_win_iso"][uid] = now_tz().isoformat(timespec="seconds")
+def update_last_win_only(uid: int):
+    players = guild_players()
+    rec = players.ensure(uid)
+    rec.last_win = int(time.time())
+    players.changed(rec, "last_win_ts")
 
 # ---------- Testi ----------
 
-def _classic_open_lines(edition: int, mod: str) -> List[str]:
-    base = [
-        "Cittadini dell'Impero 👑",
-        "La Lotteria Imperiale è ufficialmente **aperta**.",
-        "",
-        "Reagite con ✅ per partecipare all’estrazione.",
-        "",
-        "⚔️ Premi base per livello:",
-        "1️⃣ Livello 1 → 100.000 Kama",
-        "2️⃣ Livello 2 → 250.000 Kama",
-        "3️⃣ Livello 3 → 500.000 Kama *(reset a Livello 1)*",
-        "",
-    ]
-    base += modifier_open_block(mod)
-    base += [
-        "",
-        f"**Edizione n°{edition} (Classica)**",
-        "",
-        "⏳ La lotteria chiuderà alle **00:00 di giovedì**",
-    ]
-    return base
-
-def _special_open_lines(edition: int) -> List[str]:
-    return [
-        "Cittadini dell'Impero 👑",
-        "**EDIZIONE SPECIALE** sotto gli stendardi bianco e rosso dell’IMPERIVM!",
-        "Da ora fino alle 00:00 di giovedì, la sorte si farà capricciosa e magnanima. 🧾",
-        "",
-        "Reagite con ✅ a questo messaggio per partecipare.",
-        "",
-        "⚙️ **Modificatori:** OFF",
-        "💎 **Borsa dei Premi Speciale (casuali):** 600.000 / 800.000 / 1.000.000 Kama",
-        "",
-        f"**Edizione n°{edition} (SPECIALE)**",
-        "",
-        "🕗 *Annuncio del vincitore alle **08:00** di giovedì.*",
-    ]
+def _classic_open_text(edition: int, mod: Optional[str], lot: Optional["LotteryDef"] = None) -> str:
+    lot = lot or default_lottery()
+    n_winners = winners_for_modifier(None)
+    winners_line = tr("open.winners_line", n=n_winners) if n_winners > 1 else ""
+    tpl = layout(
+        "open.classic",
+        prize_1=base_prize_text_for_level(1),
+        prize_2=base_prize_text_for_level(2),
+        prize_3=base_prize_text_for_level(3),
+        winners_line=winners_line,
+        modifier_block=modifier_open_block(mod),
+    )
+    return tpl.render(edition=edition, close_time=event_time_label(lot, "close"))
+
+def _special_open_text(edition: int, lot: Optional["LotteryDef"] = None) -> str:
+    lot = lot or default_lottery()
+    pool = " / ".join(fmt_kama(n)[:-len(" Kama")] for n in SPECIAL_PRIZES) + " Kama"
+    tpl = layout("open.special", prize_pool=pool)
+    announce_hour, announce_day = event_time_parts(lot, "announce")
+    return tpl.render(
+        edition=edition,
+        close_time=event_time_label(lot, "close"),
+        announce_time=announce_hour + announce_day,
+        announce_hour=announce_hour,
+        announce_day=announce_day,
+    )
 
 # ---------- Messaggi ----------
 
-async def post_open_message(channel: discord.TextChannel, special: bool):
-    edition = STATE["edition"]
+@traced("open")
+async def post_open_message(channel: discord.TextChannel, special: bool, lot: Optional["LotteryDef"] = None):
+    lot = lot or default_lottery()
+    ls = lottery_state(lot, create=True)
+    edition = ls["edition"]
 
     if special:
-        STATE["active_modifier"] = None
+        ls["active_modifier"] = None
+        ls["open_winner_count"] = None
         save_state()
-        lines = _special_open_lines(edition)
-        embed = imperial_embed("LOTTERIA IMPERIVM – APERTA", "\n".join(lines), color=GOLD)
+        embed = imperial_embed(tr("open.title"), _special_open_text(edition, lot), color=GOLD)
     else:
-        mod = get_effective_modifier_for_open()
-        STATE["active_modifier"] = mod
+        mod = get_effective_modifier_for_open() if lot.modifiers else None
+        ls["active_modifier"] = mod
+        # il numero di vincitori del messaggio vale fino all'estrazione, anche se /vincitori cambia
+        ls["open_winner_count"] = winners_for_modifier(None)
         save_state()
-        lines = _classic_open_lines(edition, mod)
-        embed = imperial_embed("LOTTERIA IMPERIVM – APERTA", "\n".join(lines), color=lottery_color_for_modifier(mod))
+        embed = imperial_embed(tr("open.title"), _classic_open_text(edition, mod, lot), color=lottery_color_for_modifier(mod))
 
     msg = await channel.send(embed=embed)
-    STATE["open_message_id"] = msg.id
+    txn_sent()
+    ls["entrants"] = {}
+    # messaggio nuovo: il set vuoto è esatto, da qui lo aggiornano gli eventi reazione
+    _ENTRANTS_VERIFIED.add((CURRENT_GUILD.get(), lot.id))
+    ls["open_message_id"] = msg.id
     save_state()
-    print(f"[LOTTERY] Apertura {'SPECIALE' if special else 'classica'} inviata (edizione {edition})")
+    print(f"[LOTTERY] {lot.name}: apertura {'SPECIALE' if special else 'classica'} inviata (edizione {edition})")
     return msg
 
-async def post_close_message(channel: discord.TextChannel, no_participants: bool, names_preview: Optional[str], special: bool):
+@traced("close")
+async def post_close_message(
+    channel: discord.TextChannel,
+    no_participants: bool,
+    names_preview: Optional[str],
+    special: bool,
+    lot: Optional["LotteryDef"] = None,
+):
+    lot = lot or default_lottery()
+    ls = lottery_state(lot)
     if no_participants:
-        desc = (
-            "La sorte ha parlato… 😕  **Nessun partecipante valido** questa settimana.\n"
-            "Torniamo mercoledì prossimo! 👑"
-        )
+        desc = tr("close.empty", period=tr(f"close.period.{lot.period}"), next_open=next_open_phrase(lot))
         color = GOLD
         if not special:
-            mod = STATE.get("active_modifier") or STATE.get("weekly_modifier")
+            mod = lottery_modifier(lot, ls)
             color = lottery_color_for_modifier(mod)
-        await channel.send(embed=imperial_embed("LOTTERIA IMPERIVM – CHIUSA", desc, color=color))
+        await channel.send(embed=imperial_embed(tr("close.title"), desc, color=color))
+        txn_sent()
         return
 
-    desc = "I sigilli sono stati chiusi.\nI nomi sono stati consegnati al Fato.\n\n"
-    if names_preview:
-        desc += names_preview + "\n\n"
-
     if special:
-        desc += "⚙️ Modificatori: **OFF**\n\n"
-        desc += "🕗 **Annuncio del vincitore alle 08:00 di giovedì**."
-        await channel.send(embed=imperial_embed("LOTTERIA IMPERIVM – CHIUSA", desc, color=GOLD))
-        return
-
-    mod = STATE.get("active_modifier") or STATE.get("weekly_modifier")
-    desc += f"⚙️ Modificatore attivo: **{modifier_label(mod)}**\n\n"
-    desc += "🕗 **Annuncio del vincitore alle 08:00 di giovedì**."
-    await channel.send(embed=imperial_embed("LOTTERIA IMPERIVM – CHIUSA", desc, color=lottery_color_for_modifier(mod)))
+        modifier_line = tr("close.modifiers.special")
+        color = GOLD
+    else:
+        mod = lottery_modifier(lot, ls)
+        modifier_line = tr("close.modifiers.classic", label=modifier_label(mod))
+        color = lottery_color_for_modifier(mod)
+    desc = layout("close.body", modifier_line=modifier_line).render(
+        preview=names_preview + "\n\n" if names_preview else "",
+        announce_time=event_time_label(lot, "announce"),
+    )
+    await channel.send(embed=imperial_embed(tr("close.title"), desc, color=color))
+    txn_sent()
 
 def _special_compute_prize() -> int:
-    return random.choice([600_000, 800_000, 1_000_000])
+    return random.choice(SPECIAL_PRIZES)
 
 # ---------- Annunci ----------
 
-async def post_winner_announcement_classic(channel: discord.TextChannel, guild: discord.Guild):
-    ids: List[int] = STATE.get("last_winner_ids") or []
-    mod = STATE.get("active_modifier") or STATE.get("weekly_modifier")
+@traced("announce")
+async def post_winner_announcement_classic(channel: discord.TextChannel, guild: discord.Guild, lot: Optional["LotteryDef"] = None):
+    lot = lot or default_lottery()
+    ls = lottery_state(lot)
+    ids: List[int] = ls.get("last_winner_ids") or []
+    mod = lottery_modifier(lot, ls)
     color = lottery_color_for_modifier(mod)
 
-    prev_levels: Dict[str, int] = STATE.get("last_winner_prev_levels", {}) or {}
-    reset_flags: Dict[str, bool] = STATE.get("last_winner_reset_flags", {}) or {}
+    prev_levels: Dict[str, int] = ls.get("last_winner_prev_levels", {}) or {}
+    reset_flags: Dict[str, bool] = ls.get("last_winner_reset_flags", {}) or {}
 
     if not ids:
-        desc = (
-            "Cittadini dell’Impero,\n"
-            "i sigilli sono stati spezzati… ma nessun nome è stato scelto.\n"
-            "Riproveremo mercoledì prossimo. 🕯️"
-        )
-        await channel.send(embed=imperial_embed("ESTRAZIONE UFFICIALE – LOTTERIA IMPERIVM", desc, color=color))
+        desc = tr("winner.none", next_open=next_open_phrase(lot))
+        await channel.send(embed=imperial_embed(tr("winner.title"), desc, color=color))
+        txn_sent()
         return
 
-    async def send_one(idx: int, uid_int: int):
+    multi = len(ids) > 1
+    # Il corpo dipende solo da modificatore e numero di vincitori: un layout
+    # compilato per tutta l'edizione, poi per ogni vincitore si riempiono gli slot
+    body_mod = mod if mod in {MOD_INT, MOD_AGI, MOD_STR} or (mod == MOD_CHA and multi) else "OFF"
+    tpl = layout("winner.header.multi" if multi else "winner.header", f"winner.body.{body_mod}")
+
+    def build_one(idx: int, uid_int: int) -> discord.Embed:
         uid = str(uid_int)
 
         member = guild.get_member(uid_int)
@@ -589,83 +2905,39 @@ async def post_winner_announcement_classic(channel: discord.TextChannel, guild:
 
         prev_lvl = int(prev_levels.get(uid, 1))
         prev_lvl = max(1, min(3, prev_lvl))
-        lvl_now = get_level(uid)
-
-        if mod == MOD_CHA and len(ids) == 2:
-            title = f"ESTRAZIONE {'I' if idx == 1 else 'II'} – LOTTERIA IMPERIVM"
-            header = (
-                f"👑 **Vincitore {'I' if idx == 1 else 'II'}:** {mention}\n"
-                f"🎖️ **Livello (prima della vittoria):** {prev_lvl}\n"
-                f"📌 **Nuovo livello:** {lvl_now}\n\n"
-            )
-        else:
-            title = "ESTRAZIONE UFFICIALE – LOTTERIA IMPERIVM"
-            header = (
-                "Cittadini dell’Impero,\n"
-                "i sigilli sono stati spezzati e il Fato ha pronunciato il suo verdetto.\n\n"
-                f"👑 **Vincitore:** {mention}\n"
-                f"🎖️ **Livello (prima della vittoria):** {prev_lvl}\n"
-                f"📌 **Nuovo livello:** {lvl_now}\n\n"
-            )
-
-        base_amt = base_prize_amount_for_level(prev_lvl)
-        base_txt = base_prize_text_for_level(prev_lvl)
-
-        if mod == MOD_INT:
-            final_amt = int(round(base_amt * 1.30))
-            body = (
-                "🧠 **Elemento Intelligence attivo**\n\n"
-                f"💰 **Ricompensa finale: {fmt_kama(final_amt)}**\n"
-                "(+30% già applicato)"
-            )
-            await channel.send(embed=imperial_embed(title, header + body, color=color))
-            return
-
-        if mod == MOD_AGI:
-            body = (
-                "🌪️ **Elemento Agility attivo**\n"
-                "Bonus probabilità livello più basso applicato\n\n"
-                f"💰 **Ricompensa:** {base_txt}"
-            )
-            await channel.send(embed=imperial_embed(title, header + body, color=color))
-            return
-
-        if mod == MOD_CHA and len(ids) == 2:
-            body = (
-                "🍀 **Elemento Chance attivo**\n\n"
-                f"💰 **Ricompensa:** {base_txt}"
-            )
-            await channel.send(embed=imperial_embed(title, header + body, color=color))
-            return
-
-        if mod == MOD_STR:
-            final_amt = base_amt * 2
-            did_reset = bool(reset_flags.get(uid, False))
-            extra = "✅ Reset a Livello 1 applicato" if did_reset else "Livello fermo (non avanza)"
-            body = (
-                "💪 **Elemento Strength attivo**\n\n"
-                f"💰 **Ricompensa finale: {fmt_kama(final_amt)}**\n"
-                f"📌 {extra}"
-            )
-            await channel.send(embed=imperial_embed(title, header + body, color=color))
-            return
-
-        await channel.send(embed=imperial_embed(title, header + f"💰 **Ricompensa:** {base_txt}", color=color))
-
-    if mod == MOD_CHA and len(ids) == 2:
-        await send_one(1, ids[0])
-        await send_one(2, ids[1])
-        return
-
-    await send_one(1, ids[0])
-
-async def post_winner_announcement_special(channel: discord.TextChannel, guild: discord.Guild, winner_id: Optional[int]):
-    if not winner_id:
-        desc = (
-            "I sigilli sono stati spezzati, ma stavolta il fato è rimasto muto.\n"
-            "Nessun nome scolpito negli annali: riproveremo mercoledì prossimo. 🕯️"
+        amount = fmt_kama(classic_prize_amount(mod, prev_lvl))
+        extra = ""
+        if body_mod == MOD_STR:
+            extra = tr("winner.str.reset" if reset_flags.get(uid, False) else "winner.str.hold")
+
+        desc = tpl.render(
+            roman=_roman(idx),
+            mention=mention,
+            prev_level=prev_lvl,
+            level=get_level(uid_int),
+            amount=amount,
+            prize=base_prize_text_for_level(prev_lvl),
+            extra=extra,
         )
-        await channel.send(embed=imperial_embed("ESTRAZIONE UFFICIALE – LOTTERIA IMPERIVM", desc, color=GOLD))
+        title = tr("winner.title.multi", roman=_roman(idx)) if multi else tr("winner.title")
+        return imperial_embed(title, desc, color=color)
+
+    embeds = [build_one(idx, uid_int) for idx, uid_int in enumerate(ids, start=1)]
+    await send_embeds(channel.send, embeds)
+
+@traced("announce")
+async def post_winner_announcement_special(
+    channel: discord.TextChannel,
+    guild: discord.Guild,
+    winner_id: Optional[int],
+    lot: Optional["LotteryDef"] = None,
+):
+    lot = lot or default_lottery()
+    ls = lottery_state(lot, create=True)
+    if not winner_id:
+        desc = tr("special.none", next_open=next_open_phrase(lot))
+        await channel.send(embed=imperial_embed(tr("winner.title"), desc, color=GOLD))
+        txn_sent()
         return
 
     member = guild.get_member(winner_id)
@@ -675,84 +2947,337 @@ async def post_winner_announcement_special(channel: discord.TextChannel, guild:
     else:
         mention = f"@{name_fallback(winner_id)}"
 
-    premio = STATE.get("last_special_prize")
+    premio = ls.get("last_special_prize")
     if not isinstance(premio, int) or premio <= 0:
         premio = _special_compute_prize()
-        STATE["last_special_prize"] = premio
+        ls["last_special_prize"] = premio
         save_state()
 
-    lvl = get_level(str(winner_id))
-    desc = (
-        "Cittadini dell’Impero, il sigillo dorato è stato infranto.\n"
-        "Tra pergamene e ceralacca, il nome inciso negli annali è stato scelto.\n\n"
-        f"👑 **Vincitore:** {mention}\n"
-        f"🎖️ **Livello classico (solo informativo):** {lvl}\n"
-        f"⚙️ **Modificatori:** OFF\n"
-        f"💎 **Ricompensa Speciale:** {fmt_kama(premio)}\n\n"
-        "Questa edizione **non modifica** i livelli.\n"
-        "Che la fortuna continui a sorriderti."
-    )
-    await channel.send(embed=imperial_embed("ESTRAZIONE UFFICIALE – EDIZIONE SPECIALE", desc, color=GOLD))
+    desc = tr("special.winner", mention=mention, level=get_level(winner_id), amount=fmt_kama(premio))
+    await channel.send(embed=imperial_embed(tr("special.title"), desc, color=GOLD))
+    txn_sent()
 
 # ---------- Partecipanti ----------
 
-async def collect_participants(msg: discord.Message) -> List[int]:
-    ids: List[int] = []
+# I partecipanti vengono tracciati live da on_raw_reaction_add/remove negli
+# "entrants" della lotteria aperta (bot inclusi, con valore 0, per poter confrontare il totale
+# con reaction.count). Alla chiusura basta il fetch del messaggio: la scansione
+# completa dei reattori parte solo se i conti non tornano.
+
+_ENTRANTS_VERIFIED: set = set()   # (server, lotteria) riallineati nella sessione gateway corrente
+_ENTRANTS_RESYNC_TASK: Optional[asyncio.Task] = None
+
+def lottery_for_message(message_id: int) -> Optional["LotteryDef"]:
+    for lot in LOTTERY_DEFS.values():
+        if message_id == lottery_state(lot).get("open_message_id"):
+            return lot
+    return None
+
+def track_entrant(message_id: int, uid: int, is_bot: bool, added: bool) -> bool:
+    lot = lottery_for_message(message_id)
+    if lot is None:
+        return False
+    entrants = lottery_state(lot, create=True).setdefault("entrants", {})
+    if added:
+        entrants[str(uid)] = 0 if is_bot else 1
+    else:
+        entrants.pop(str(uid), None)
+    save_state()
+    return True
+
+def _tracked_participants(ls: Dict) -> List[int]:
+    return [int(k) for k, v in (ls.get("entrants") or {}).items() if v]
+
+REACTORS_PAGE = 100   # massimo consentito da Discord per GET reactions
+
+class ReactorScan:
+    """Risultato (parziale) di una scansione dei reattori: solo ID interi, bot a parte."""
+    __slots__ = ("expected", "ids", "bots", "pages")
+
+    def __init__(self, expected: int):
+        self.expected = expected      # reaction.count al momento del fetch
+        self.ids: set = set()
+        self.bots: set = set()
+        self.pages = 0
+
+    @property
+    def seen(self) -> int:
+        return len(self.ids) + len(self.bots)
+
+    def progress(self) -> float:
+        return min(1.0, self.seen / self.expected) if self.expected else 1.0
+
+async def stream_reactors(
+    reaction: discord.Reaction,
+    scan: Optional[ReactorScan] = None,
+    lo: Optional[int] = None,
+    hi: Optional[int] = None,
+) -> ReactorScan:
+    """
+    Legge i reattori pagina per pagina (after=ID più alto della pagina) tenendo
+    solo gli ID: gli oggetti User di ogni pagina vengono rilasciati subito.
+    discord.py restituisce ogni pagina in ordine inverso (ID decrescenti), per
+    questo il cursore è il massimo e non l'ultimo utente letto. Il limite di
+    ogni pagina è ridotto ai reattori mancanti secondo reaction.count: discord.py
+    rilancia la richiesta quando una pagina arriva incompleta, e chiedendo solo
+    quelli che mancano l'ultima pagina è piena e non segue una richiesta vuota.
+    Con lo/hi legge solo gli ID nell'intervallo (lo, hi].
+    """
+    scan = scan or ReactorScan(reaction.count)
+    after = discord.Object(id=lo) if lo else None
+    while (remaining := scan.expected - scan.seen) > 0:
+        limit = min(REACTORS_PAGE, remaining)
+        n = 0
+        last_id = None
+        past_hi = False
+        async for u in reaction.users(limit=limit, after=after):
+            n += 1
+            if last_id is None or u.id > last_id:
+                last_id = u.id
+            if hi is not None and u.id > hi:
+                past_hi = True
+                continue
+            (scan.bots if u.bot else scan.ids).add(u.id)
+            if scan.seen >= scan.expected:
+                break
+        scan.pages += 1
+        if scan.pages % 10 == 0:
+            print(f"[LOTTERY] Scansione reattori: {scan.seen}/{scan.expected} ({scan.progress():.0%})")
+        if past_hi or n < limit or last_id is None:
+            return scan
+        after = discord.Object(id=last_id)
+    return scan
+
+async def stream_reactors_parallel(reaction: discord.Reaction) -> ReactorScan:
+    """
+    Divide lo spazio degli snowflake (dall'epoch Discord a oggi) in intervalli
+    e li legge in parallelo, con al massimo RECONCILE_CONCURRENCY richieste in
+    volo. I bucket di rate limit restano gestiti dal client HTTP di discord.py,
+    che serializza le richieste sullo stesso bucket e attende i Retry-After.
+    """
+    scan = ReactorScan(reaction.count)
+    top = discord.utils.time_snowflake(datetime.now(timezone.utc), high=True)
+    parts = max(1, min(RECONCILE_CONCURRENCY * 4, -(-reaction.count // REACTORS_PAGE)))
+    step = top // parts + 1
+    bounds = [(i * step or None, (i + 1) * step if i < parts - 1 else None) for i in range(parts)]
+    sem = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+
+    async def worker(lo: Optional[int], hi: Optional[int]):
+        async with sem:
+            if scan.seen < scan.expected:
+                await stream_reactors(reaction, scan, lo, hi)
+
+    await asyncio.gather(*(worker(lo, hi) for lo, hi in bounds))
+    return scan
+
+async def resync_entrants(msg: discord.Message, lot: Optional["LotteryDef"] = None) -> List[int]:
+    """Scansione completa dei ✅ (fallback): sostituisce il set tracciato."""
+    lot = lot or default_lottery()
+    ls = lottery_state(lot, create=True)
+    scan = ReactorScan(0)
     for r in msg.reactions:
         if str(r.emoji) == "✅":
-            users = [u async for u in r.users()]
-            for u in users:
-                if not u.bot:
-                    ids.append(u.id)
-    return list(dict.fromkeys(ids))
+            if r.count >= RECONCILE_PARALLEL_MIN:
+                scan = await stream_reactors_parallel(r)
+            else:
+                scan = await stream_reactors(r)
+    REACTOR_PAGES.observe(scan.pages)
+    if ls.get("open_message_id") == msg.id:
+        entrants = dict.fromkeys(map(str, scan.ids), 1)
+        entrants.update(dict.fromkeys(map(str, scan.bots), 0))
+        ls["entrants"] = entrants
+        save_state()
+        _ENTRANTS_VERIFIED.add((CURRENT_GUILD.get(), lot.id))
+    return sorted(scan.ids)
+
+@traced("close")
+async def collect_participants(msg: discord.Message, lot: Optional["LotteryDef"] = None) -> List[int]:
+    lot = lot or default_lottery()
+    ls = lottery_state(lot)
+    r = next((r for r in msg.reactions if str(r.emoji) == "✅"), None)
+    entrants = ls.get("entrants") or {}
+    if r is None:
+        return []
+    if (CURRENT_GUILD.get(), lot.id) in _ENTRANTS_VERIFIED and r.count == len(entrants):
+        with COLLECT_SECONDS.time("live"):
+            return _tracked_participants(ls)
+
+    print(f"[LOTTERY] Riconciliazione partecipanti: {r.count} reazioni, {len(entrants)} tracciate")
+    with COLLECT_SECONDS.time("scan"):
+        return await resync_entrants(msg, lot)
+
+def schedule_entrants_resync():
+    """Dopo una nuova sessione gateway: riallinea i set in background."""
+    global _ENTRANTS_RESYNC_TASK
+    _ENTRANTS_VERIFIED.clear()
+    if _ENTRANTS_RESYNC_TASK is not None and not _ENTRANTS_RESYNC_TASK.done():
+        return
+
+    async def resync_guild(guild: discord.Guild):
+        for lot in list(LOTTERY_DEFS.values()):
+            msg_id = lottery_state(lot).get("open_message_id")
+            channel = await get_lottery_channel(guild, lot) if msg_id else None
+            if not channel:
+                continue
+            try:
+                msg = await channel.fetch_message(msg_id)
+            except Exception:
+                continue
+            n = len(await resync_entrants(msg, lot))
+            print(f"[LOTTERY] {lot.name} (server {guild.id}): partecipanti riallineati: {n}")
+
+    _ENTRANTS_RESYNC_TASK = asyncio.create_task(for_each_guild(resync_guild))
 
 # ---------- Weighted pick ----------
 
-def _time_weight_from_last_win(uid: str) -> float:
-    iso = STATE.get("last_win_iso", {}).get(uid)
-    if not iso:
+def _time_weight(last_win: Optional[int], now: float) -> float:
+    if last_win is None:
         return 2.0
-    try:
-        last = datetime.fromisoformat(iso)
-        delta_days = max(0.0, (now_tz() - last).total_seconds() / 86400.0)
-        return 1.0 + min(delta_days / 7.0, 2.0)
-    except Exception:
-        return 1.5
+    delta_days = max(0.0, (now - last_win) / 86400.0)
+    return 1.0 + min(delta_days / 7.0, 2.0)
+
+def _time_weight_from_last_win(uid: int, now: Optional[float] = None) -> float:
+    rec = guild_players().get(uid)
+    return _time_weight(rec.last_win if rec is not None else None, time.time() if now is None else now)
 
-def _agility_bonus_factor(uid: str, min_level: int) -> float:
+def _agility_bonus_factor(uid: int, min_level: int) -> float:
     lvl = get_level(uid)
     return 1.5 if lvl == min_level else 1.0
 
-def weighted_pick(participants: List[int], mod: Optional[str]) -> int:
+_NP_RNG = np.random.default_rng() if np is not None else None
+
+def _use_numpy(n: int) -> bool:
+    if np is None or DRAW_ENGINE == "python":
+        return False
+    return DRAW_ENGINE == "numpy" or n >= DRAW_NUMPY_MIN
+
+def _draw_weights(participants: List[int], mod: Optional[str], now: float) -> List[float]:
+    # un solo lookup per utente (e un solo `now` per estrazione): il resto è aritmetica
+    records = guild_players().records
+    levels: List[int] = []
+    last_wins: List[Optional[int]] = []
+    for uid in participants:
+        rec = records.get(uid)
+        if rec is None:
+            levels.append(1)
+            last_wins.append(None)
+        else:
+            levels.append(max(1, min(3, rec.level)) if rec.level is not None else 1)
+            last_wins.append(rec.last_win)
+    min_lvl = min(levels)
+
+    weights: List[float] = []
+    for lvl, last in zip(levels, last_wins):
+        w = _time_weight(last, now)
+        if mod == MOD_AGI and lvl == min_lvl:
+            w *= 1.5
+        weights.append(max(0.1, w))
+    return weights
+
+def _draw_weights_np(participants: List[int], mod: Optional[str], now: float) -> "np.ndarray":
+    """Stessi pesi di _draw_weights, calcolati in blocco sugli array livello/ultima vittoria."""
+    records = guild_players().records
+    n = len(participants)
+    # array riempiti da np.fromiter: nessuna assegnazione elemento per elemento
+    recs = [records.get(uid) for uid in participants]
+    levels = np.fromiter(
+        (rec.level if rec is not None and rec.level is not None else 1 for rec in recs),
+        dtype=np.int64, count=n,
+    )
+    np.clip(levels, 1, 3, out=levels)
+    last = np.fromiter(
+        (rec.last_win if rec is not None and rec.last_win is not None else np.nan for rec in recs),
+        dtype=np.float64, count=n,
+    )
+
+    delta_days = np.maximum(0.0, (now - last) / 86400.0)
+    weights = 1.0 + np.minimum(delta_days / 7.0, 2.0)
+    weights[np.isnan(last)] = 2.0
+    if mod == MOD_AGI:
+        weights[levels == levels.min()] *= 1.5
+    return np.maximum(0.1, weights)
+
+def _np_sample(participants: List[int], weights: "np.ndarray", k: int) -> List[int]:
+    """
+    k vincitori distinti in un solo passaggio. k=1: ricerca sulla cumulata
+    (come random.choices). k>1: chiavi di Efraimidis–Spirakis log(u)/w, le k
+    più alte nell'ordine di estrazione: stessa distribuzione di k estrazioni
+    pesate successive senza reinserimento.
+    """
+    n = len(participants)
+    k = min(k, n)
+    if k == 1:
+        cum = np.cumsum(weights)
+        idx = int(np.searchsorted(cum, _NP_RNG.random() * cum[-1], side="right"))
+        return [participants[min(idx, n - 1)]]
+
+    keys = np.log(1.0 - _NP_RNG.random(n)) / weights
+    top = np.argpartition(-keys, k - 1)[:k]
+    top = top[np.argsort(-keys[top])]
+    return [participants[i] for i in top]
+
+def weighted_sample(participants: List[int], k: int, mod: Optional[str], now: Optional[float] = None) -> List[int]:
+    """
+    Estrae k vincitori distinti, nell'ordine di estrazione. I pesi sono
+    calcolati una volta sola; per k>1 si usano le chiavi di Efraimidis–Spirakis
+    (log(u)/w, si tengono le k più alte): equivale a k estrazioni pesate
+    successive senza reinserimento, ma costa un solo passaggio.
+    """
     if not participants:
         raise ValueError("participants empty")
+    k = max(1, min(k, len(participants)))
 
-    min_lvl = 99
-    for uid_int in participants:
-        uid = str(uid_int)
-        min_lvl = min(min_lvl, get_level(uid))
-    if min_lvl == 99:
-        min_lvl = 1
+    if now is None:
+        now = time.time()
+    if _use_numpy(len(participants)):
+        with DRAW_SECONDS.time("numpy"):
+            return _np_sample(participants, _draw_weights_np(participants, mod, now), k)
 
-    weights: List[float] = []
-    for uid_int in participants:
-        uid = str(uid_int)
-        w = _time_weight_from_last_win(uid)
-        if mod == MOD_AGI:
-            w *= _agility_bonus_factor(uid, min_lvl)
-        weights.append(max(0.1, float(w)))
+    with DRAW_SECONDS.time("python"):
+        weights = _draw_weights(participants, mod, now)
+        if k == 1:
+            return random.choices(participants, weights=weights, k=1)
+
+        keyed = ((math.log(1.0 - random.random()) / w, uid) for uid, w in zip(participants, weights))
+        return [uid for _, uid in heapq.nlargest(k, keyed)]
+
+def weighted_pick(participants: List[int], mod: Optional[str], now: Optional[float] = None) -> int:
+    return weighted_sample(participants, 1, mod, now)[0]
+
+def draw_classic_winners(participants: List[int], mod: Optional[str], ls: Dict, now: Optional[float] = None) -> List[int]:
+    """
+    Estrazione classica e avanzamento livelli dei vincitori. Scrive i livelli
+    precedenti e i reset STR in ls; usata dalla chiusura e dal simulatore.
+    """
+    n_winners = winners_for_modifier(mod, ls)
+    if n_winners > 1 and len(participants) >= 2:
+        # CHANCE: estrazione senza bonus AGI, come la doppia estrazione storica
+        winners = weighted_sample(participants, n_winners, mod=None if mod == MOD_CHA else mod, now=now)
+    else:
+        winners = [weighted_pick(participants, mod=mod, now=now)]
 
-    return random.choices(participants, weights=weights, k=1)[0]
+    for wid in winners:
+        prev_lvl = get_level(wid)
+        ls["last_winner_prev_levels"][str(wid)] = prev_lvl
+        if mod == MOD_STR:
+            _, did_reset = apply_strength_win_after_prize(wid, prev_lvl)
+            ls["last_winner_reset_flags"][str(wid)] = did_reset
+        else:
+            apply_classic_win_after_prize(wid, prev_lvl)
+    return winners
 
 # ---------- Core lottery ----------
 
-async def _close_and_pick_common(guild: discord.Guild, special: bool):
-    channel = await get_lottery_channel(guild)
+@traced("close")
+async def _close_and_pick_common(guild: discord.Guild, special: bool, lot: Optional["LotteryDef"] = None):
+    lot = lot or default_lottery()
+    ls = lottery_state(lot, create=True)
+    channel = await get_lottery_channel(guild, lot)
     if not channel:
         return None, [], "", []
 
     msg = None
-    msg_id = STATE.get("open_message_id")
+    msg_id = ls.get("open_message_id")
     if msg_id:
         try:
             msg = await channel.fetch_message(msg_id)
@@ -761,18 +3286,11 @@ async def _close_and_pick_common(guild: discord.Guild, special: bool):
 
     participants: List[int] = []
     if msg:
-        participants = await collect_participants(msg)
+        participants = await collect_participants(msg, lot)
 
     names_preview = None
     if participants:
-        names = []
-        for uid_int in participants[:50]:
-            m = guild.get_member(uid_int)
-            if m:
-                remember_name(uid_int, m.display_name)
-                names.append(m.display_name)
-            else:
-                names.append(name_fallback(uid_int))
+        names = [display_name_for(guild, uid_int) for uid_int in participants[:50]]
         more = len(participants) - 50
         header = f"📜 **Partecipanti ({len(participants)}):**"
         body = "• " + "\n".join(f"• {n}" for n in names)
@@ -781,231 +3299,328 @@ async def _close_and_pick_common(guild: discord.Guild, special: bool):
         names_preview = f"{header}\n{body}"
 
     winners: List[int] = []
-    mod = None if special else (STATE.get("active_modifier") or STATE.get("weekly_modifier"))
+    mod = None if special else lottery_modifier(lot, ls)
 
-    STATE["last_winner_prev_levels"] = {}
-    STATE["last_winner_reset_flags"] = {}
-    STATE["last_special_prize"] = None
+    ls["last_winner_prev_levels"] = {}
+    ls["last_winner_reset_flags"] = {}
+    ls["last_special_prize"] = None
 
     if participants:
         if special:
             win_id = random.choice(participants)
             winners = [win_id]
-            update_last_win_iso_only(str(win_id))
-            STATE["last_special_prize"] = _special_compute_prize()
+            update_last_win_only(win_id)
+            ls["last_special_prize"] = _special_compute_prize()
             save_state()
 
         else:
-            if mod == MOD_CHA and len(participants) >= 2:
-                first = weighted_pick(participants, mod=None)
-                remaining = [x for x in participants if x != first]
-                second = weighted_pick(remaining, mod=None)
-                winners = [first, second]
-
-                for wid in winners:
-                    uid = str(wid)
-                    prev_lvl = get_level(uid)
-                    STATE["last_winner_prev_levels"][uid] = prev_lvl
-                    apply_classic_win_after_prize(uid, prev_lvl)
-                save_state()
-
-            else:
-                win_id = weighted_pick(participants, mod=mod)
-                winners = [win_id]
-                uid = str(win_id)
-
-                prev_lvl = get_level(uid)
-                STATE["last_winner_prev_levels"][uid] = prev_lvl
-
-                if mod == MOD_STR:
-                    _, did_reset = apply_strength_win_after_prize(uid, prev_lvl)
-                    STATE["last_winner_reset_flags"][uid] = did_reset
-                    save_state()
-                else:
-                    apply_classic_win_after_prize(uid, prev_lvl)
-                    save_state()
+            with span("draw_classic_winners"):
+                winners = draw_classic_winners(participants, mod, ls)
+            save_state()
 
-    STATE["last_winner_ids"] = winners[:] if winners else []
-    STATE["last_winner_id"] = winners[0] if winners else None
+    ls["last_winner_ids"] = winners[:] if winners else []
+    ls["last_winner_id"] = winners[0] if winners else None
     save_state()
 
     return channel, winners, (names_preview or ""), participants
 
-async def close_and_pick(guild: discord.Guild, announce_now: bool = False, special: bool = False):
-    channel, winners, names_preview, participants = await _close_and_pick_common(guild, special=special)
+@traced("close")
+async def close_and_pick(
+    guild: discord.Guild,
+    announce_now: bool = False,
+    special: bool = False,
+    lot: Optional["LotteryDef"] = None,
+):
+    lot = lot or default_lottery()
+    ls = lottery_state(lot, create=True)
+    channel, winners, names_preview, participants = await _close_and_pick_common(guild, special=special, lot=lot)
     if not channel:
         return None
 
-    await post_close_message(channel, len(participants) == 0, names_preview, special=special)
+    await post_close_message(channel, len(participants) == 0, names_preview, special=special, lot=lot)
 
     if announce_now:
         if special:
-            await post_winner_announcement_special(channel, guild, winners[0] if winners else None)
+            await post_winner_announcement_special(channel, guild, winners[0] if winners else None, lot)
         else:
-            await post_winner_announcement_classic(channel, guild)
+            await post_winner_announcement_classic(channel, guild, lot)
 
-    STATE["open_message_id"] = None
+    ls["open_message_id"] = None
+    ls["entrants"] = {}
     save_state()
-    print(f"[LOTTERY] Chiusura eseguita ({'SPECIALE' if special else 'classica'}) (partecipanti: {len(participants)})")
+    print(f"[LOTTERY] {lot.name}: chiusura eseguita ({'SPECIALE' if special else 'classica'}) (partecipanti: {len(participants)})")
     return winners[0] if winners else None
 
-async def open_lottery(guild: Optional[discord.Guild], special: bool = False):
+@traced("open")
+async def open_lottery(guild: Optional[discord.Guild], special: bool = False, lot: Optional["LotteryDef"] = None):
     if guild is None:
         return
 
-    channel = await get_lottery_channel(guild)
+    lot = lot or default_lottery()
+    ls = lottery_state(lot)
+    channel = await get_lottery_channel(guild, lot)
     if not channel:
         return
 
-    if STATE.get("open_message_id"):
+    if ls.get("open_message_id"):
         try:
-            await channel.fetch_message(STATE["open_message_id"])
-            print("[LOTTERY] Apertura saltata: messaggio già presente.")
+            await channel.fetch_message(ls["open_message_id"])
+            print(f"[LOTTERY] {lot.name}: apertura saltata, messaggio già presente.")
             return
         except Exception:
             pass
 
-    await post_open_message(channel, special=special)
+    await post_open_message(channel, special=special, lot=lot)
 
 # ---------- Automazione ----------
 
 def auto_schedule_status_lines() -> List[str]:
-    mode = STATE.get("lottery_mode", "classic")
-    if not STATE.get("automation_enabled", True):
+    mode = gstate().get("lottery_mode", "classic")
+    if not gstate().get("automation_enabled", True):
         return [
             "⏰ **Automazione:** OFF",
             f"📌 **Modalità automatica impostata:** {mode_label(mode)}",
         ]
 
-    if mode == "special":
-        return [
-            "⏰ **Automazione:** ON",
-            "• Mercoledì 00:00 → apertura SPECIALE",
-            "• Giovedì 00:00 → chiusura SPECIALE",
-            "• Giovedì 08:00 → annuncio SPECIALE",
-            "• Dopo l'annuncio speciale → reset automatico a CLASSICA",
+    # orari letti dai cron di ogni lotteria (LOTTERIES), non fissi
+    lines = ["⏰ **Automazione:** ON"]
+    for lot in LOTTERY_DEFS.values():
+        lot_mode = lottery_mode_for(lot)
+        special = (lot_mode == "special")
+        if len(LOTTERY_DEFS) > 1:
+            is_open = bool(lottery_state(lot).get("open_message_id"))
+            lines.append(f"**{lot.name}** ({mode_label(lot_mode)}){' — aperta' if is_open else ''}")
+        lines += [
+            f"• {event_schedule_label(lot, 'open')} → apertura {mode_label(lot_mode)}",
+            f"• {event_schedule_label(lot, 'close')} → chiusura {mode_label(lot_mode)}",
+            f"• {event_schedule_label(lot, 'announce')} → annuncio {'SPECIALE' if special else 'CLASSICO'}",
         ]
-
-    return [
-        "⏰ **Automazione:** ON",
-        "• Mercoledì 00:00 → apertura CLASSICA",
-        "• Giovedì 00:00 → chiusura CLASSICA",
-        "• Giovedì 08:00 → annuncio CLASSICO",
-    ]
-
-async def run_auto_open():
-    if not STATE.get("automation_enabled", True):
-        return
-
-    guild = bot.guilds[0] if bot.guilds else None
-    if guild is None:
+        if special and lot.mode is None:
+            lines.append("• Dopo l'annuncio speciale → reset automatico a CLASSICA")
+    return lines
+
+def auto_next_fire_label() -> str:
+    nxt = STATE.get("auto_next_fire")
+    if not isinstance(nxt, dict) or not nxt.get("ts"):
+        return "non pianificato"
+    labels = {"open": "apertura", "close": "chiusura", "announce": "annuncio"}
+    lot = LOTTERY_DEFS.get(nxt.get("lottery") or DEFAULT_LOTTERY_ID)
+    when = datetime.fromtimestamp(nxt["ts"], TZ)
+    label = f"{labels.get(nxt.get('event'), nxt.get('event'))} — {when:%d/%m %H:%M}"
+    return label if lot is None or lot.id == DEFAULT_LOTTERY_ID else f"{lot.name}: {label}"
+
+@traced("open")
+async def run_auto_open(guild: discord.Guild, lot: LotteryDef, when: Optional[datetime] = None):
+    if not gstate().get("automation_enabled", True):
         return
 
-    wk = week_key(now_tz())
-    if STATE.get("last_open_week") == wk:
+    ls = lottery_state(lot, create=True)
+    wk = lot.period_key(when or now_tz())
+    if ls.get("last_open_week") == wk:
         return
 
-    mode = STATE.get("lottery_mode", "classic")
+    mode = lottery_mode_for(lot)
     special = (mode == "special")
 
-    ed = int(STATE.get("edition", 1))
-    await open_lottery(guild, special=special)
-    STATE["edition"] = ed + 1
-    STATE["last_open_week"] = wk
+    ed = int(ls.get("edition", 1))
+    await open_lottery(guild, special=special, lot=lot)
+    ls["edition"] = ed + 1
+    ls["last_open_week"] = wk
     save_state(force=True)
-    print(f"[AUTO] Apertura automatica eseguita per settimana {wk} — modalità {mode_label(mode)}")
-
-async def run_auto_close():
-    if not STATE.get("automation_enabled", True):
-        return
+    print(f"[AUTO] {lot.name}: apertura automatica eseguita per {wk} — modalità {mode_label(mode)}")
 
-    guild = bot.guilds[0] if bot.guilds else None
-    if guild is None:
+@traced("close")
+async def run_auto_close(guild: discord.Guild, lot: LotteryDef, when: Optional[datetime] = None):
+    if not gstate().get("automation_enabled", True):
         return
 
-    wk = week_key(now_tz())
-    if STATE.get("last_close_week") == wk:
+    ls = lottery_state(lot, create=True)
+    wk = lot.period_key(when or now_tz())
+    if ls.get("last_close_week") == wk:
         return
 
-    mode = STATE.get("lottery_mode", "classic")
+    mode = lottery_mode_for(lot)
     special = (mode == "special")
 
-    await close_and_pick(guild, announce_now=False, special=special)
-    STATE["last_close_week"] = wk
+    await close_and_pick(guild, announce_now=False, special=special, lot=lot)
+    ls["last_close_week"] = wk
     save_state(force=True)
-    print(f"[AUTO] Chiusura automatica eseguita per settimana {wk} — modalità {mode_label(mode)}")
+    print(f"[AUTO] {lot.name}: chiusura automatica eseguita per {wk} — modalità {mode_label(mode)}")
 
-async def run_auto_announce():
-    if not STATE.get("automation_enabled", True):
+@traced("announce")
+async def run_auto_announce(guild: discord.Guild, lot: LotteryDef, when: Optional[datetime] = None):
+    if not gstate().get("automation_enabled", True):
         return
 
-    guild = bot.guilds[0] if bot.guilds else None
-    if guild is None:
+    ls = lottery_state(lot, create=True)
+    wk = lot.period_key(when or now_tz())
+    if ls.get("last_announce_week") == wk:
         return
 
-    wk = week_key(now_tz())
-    if STATE.get("last_announce_week") == wk:
-        return
-
-    ch = await get_lottery_channel(guild)
+    ch = await get_lottery_channel(guild, lot)
     if not ch:
         return
 
-    mode = STATE.get("lottery_mode", "classic")
+    mode = lottery_mode_for(lot)
     special = (mode == "special")
 
     if special:
-        lw = STATE.get("last_winner_id")
+        lw = ls.get("last_winner_id")
         winner_id = int(lw) if lw else None
-        await post_winner_announcement_special(ch, guild, winner_id)
+        await post_winner_announcement_special(ch, guild, winner_id, lot)
 
-        STATE["last_announce_week"] = wk
-        STATE["last_winner_id"] = None
-        STATE["last_winner_ids"] = []
-        STATE["last_special_prize"] = None
+        ls["last_announce_week"] = wk
+        ls["last_winner_id"] = None
+        ls["last_winner_ids"] = []
+        ls["last_special_prize"] = None
 
-        # reset automatico a classica dopo una speciale automatica
-        STATE["lottery_mode"] = "classic"
+        if lot.mode is None:
+            # reset automatico a classica dopo una speciale automatica
+            gstate(create=True)["lottery_mode"] = "classic"
         save_state(force=True)
-        print(f"[AUTO] Annuncio automatico SPECIALE eseguito per settimana {wk} — reset modalità a CLASSICA")
+        print(f"[AUTO] {lot.name}: annuncio automatico SPECIALE eseguito per {wk}")
         return
 
-    await post_winner_announcement_classic(ch, guild)
+    await post_winner_announcement_classic(ch, guild, lot)
 
-    STATE["last_announce_week"] = wk
-    STATE["last_winner_id"] = None
-    STATE["last_winner_ids"] = []
-    STATE["last_winner_prev_levels"] = {}
-    STATE["last_winner_reset_flags"] = {}
+    ls["last_announce_week"] = wk
+    ls["last_winner_id"] = None
+    ls["last_winner_ids"] = []
+    ls["last_winner_prev_levels"] = {}
+    ls["last_winner_reset_flags"] = {}
     save_state(force=True)
-    print(f"[AUTO] Annuncio automatico CLASSICO eseguito per settimana {wk}")
-
-@tasks.loop(minutes=1)
-async def automation_loop():
-    if not STATE.get("automation_enabled", True):
+    print(f"[AUTO] {lot.name}: annuncio automatico CLASSICO eseguito per {wk}")
+
+# Gli orari degli eventi vengono dalle definizioni in LOTTERY_DEFS (cron in TZ)
+AutoEvent = Tuple[datetime, str, str]   # (quando, evento, id lotteria)
+_AUTO_ORDER = {name: i for i, name in enumerate(LOTTERY_EVENTS)}
+_AUTO_RUNNERS = {"open": run_auto_open, "close": run_auto_close, "announce": run_auto_announce}
+_SCHEDULER_TASK: Optional[asyncio.Task] = None
+
+def _auto_event_key(e: AutoEvent):
+    return (e[0], _AUTO_ORDER[e[1]], e[2])
+
+def next_auto_events(after: datetime) -> List[AutoEvent]:
+    """Prossima occorrenza (strettamente dopo `after`) di ogni evento di ogni lotteria."""
+    out = [
+        (lot.cron(name).next_after(after), name, lot.id)
+        for lot in LOTTERY_DEFS.values()
+        for name in LOTTERY_EVENTS
+    ]
+    out.sort(key=_auto_event_key)
+    return out
+
+def _last_occurrence(cron: CronSpec, since: datetime, until: datetime) -> Optional[datetime]:
+    last = None
+    when = cron.next_after(since)
+    while when <= until:
+        last = when
+        when = cron.next_after(when)
+    return last
+
+def missed_auto_events(since: datetime, until: datetime) -> List[AutoEvent]:
+    """Ultima occorrenza di ogni evento in (since, until], in ordine cronologico."""
+    start = max(since, until - timedelta(days=7))
+    out: List[AutoEvent] = []
+    for lot in LOTTERY_DEFS.values():
+        missed = {}
+        for name in LOTTERY_EVENTS:
+            when = _last_occurrence(lot.cron(name), start, until)
+            if when is not None:
+                missed[name] = when
+
+        # apertura e relativa chiusura entrambe perse: il ciclo è ormai passato.
+        # Se era rimasta aperta una lotteria precedente, la si chiude comunque.
+        opened, closed = missed.get("open"), missed.get("close")
+        if opened and closed and closed > opened:
+            print(f"[AUTO] {lot.name}: ciclo del {opened:%d/%m %H:%M} perso per intero, apertura non recuperata")
+            del missed["open"]
+            if not lottery_state(lot).get("open_message_id"):
+                missed = {n: w for n, w in missed.items() if w < opened}
+
+        out += [(when, name, lot.id) for name, when in missed.items()]
+    out.sort(key=_auto_event_key)
+    return out
+
+async def _run_auto_event(guild: discord.Guild, event: AutoEvent):
+    when, name, lot_id = event
+    lot = LOTTERY_DEFS.get(lot_id)
+    if lot is None:
         return
+    try:
+        with LOTTERY_SECONDS.time(name):
+            async with lottery_txn(lot):
+                await _AUTO_RUNNERS[name](guild, lot, when)
+    except Exception as e:
+        print(f"[AUTO] {lot.name} (server {guild.id}): errore evento {name}:", e)
+
+async def _fire_auto_event(event: AutoEvent):
+    # stesso evento su tutti i server in parallelo (limitato), ognuno nel suo namespace
+    await for_each_guild(lambda guild: _run_auto_event(guild, event))
+    STATE["auto_last_run_ts"] = int(event[0].timestamp())
+    save_state()
 
+async def catch_up_automation_now():
+    """
+    Esegue in ordine gli eventi automatici persi mentre il bot era offline.
+    Non duplica grazie ai last_*_week. Restituisce l'istante fino a cui ha recuperato.
+    """
     now = now_tz()
+    last_ts = STATE.get("auto_last_run_ts")
+    if isinstance(last_ts, (int, float)):
+        since = datetime.fromtimestamp(last_ts, TZ)
+    else:
+        since = now - timedelta(minutes=AUTO_WINDOW_MINUTES)
 
-    try:
-        # Mercoledì 00:00-00:09
-        if in_time_window(now, target_weekday=2, target_hour=0):
-            await run_auto_open()
+    async def catch_up_guild(guild: discord.Guild):
+        # gli eventi persi dipendono dallo stato del server (lotteria rimasta aperta o no)
+        for event in missed_auto_events(since, now):
+            print(f"[AUTO] Server {guild.id}: recupero evento {event[1]} ({event[2]}) del {event[0]:%d/%m %H:%M}")
+            await _run_auto_event(guild, event)
 
-        # Giovedì 00:00-00:09
-        if in_time_window(now, target_weekday=3, target_hour=0):
-            await run_auto_close()
+    await for_each_guild(catch_up_guild)
 
-        # Giovedì 08:00-08:09
-        if in_time_window(now, target_weekday=3, target_hour=8):
-            await run_auto_announce()
+    if not isinstance(last_ts, (int, float)) or last_ts < now.timestamp():
+        STATE["auto_last_run_ts"] = int(now.timestamp())
+        save_state()
+    return now
 
+async def automation_scheduler():
+    """Dorme fino al prossimo evento (invece di svegliarsi ogni minuto)."""
+    await bot.wait_until_ready()
+    # cursore = ultimo istante già eseguito: gli eventi scaduti mentre il
+    # precedente (o il catch-up iniziale) era in corso vengono eseguiti subito, non saltati
+    cursor = now_tz()
+    try:
+        cursor = await catch_up_automation_now()
     except Exception as e:
-        print("[AUTO] Errore automation_loop:", e)
+        print("[AUTO] Errore catch-up:", e)
 
-@automation_loop.before_loop
-async def before_automation_loop():
-    await bot.wait_until_ready()
+    while True:
+        upcoming = next_auto_events(cursor)
+        when = upcoming[0][0]
+        ts = when.timestamp()
+        STATE["auto_next_fire"] = {"lottery": upcoming[0][2], "event": upcoming[0][1], "ts": int(ts)}
+        save_state()
+
+        # sonno a tratti: un orologio di sistema corretto nel frattempo non fa saltare l'evento
+        while (delay := ts - time.time()) > 0:
+            await asyncio.sleep(min(delay, 3600))
+        SCHEDULER_LAG.observe(max(0.0, time.time() - ts))
+
+        # tutti gli eventi che cadono nello stesso istante, nell'ordine apertura/chiusura/annuncio
+        for event in upcoming:
+            if event[0] == when:
+                try:
+                    await _fire_auto_event(event)
+                except Exception as e:
+                    print(f"[AUTO] Errore evento {event[1]} ({event[2]}) del {when:%d/%m %H:%M}:", e)
+        cursor = when
+
+def start_automation_scheduler():
+    global _SCHEDULER_TASK
+    if _SCHEDULER_TASK is None or _SCHEDULER_TASK.done():
+        _SCHEDULER_TASK = asyncio.create_task(automation_scheduler())
 
 def schedule_test_task(name: str, minutes: int, coro_func):
     async def runner():
@@ -1041,20 +3656,47 @@ async def on_ready():
     except Exception:
         pass
 
-    if not automation_loop.is_running():
-        automation_loop.start()
+    pin_home_guild()
+    start_automation_scheduler()
+    start_loop_lag_probe()
+
+    schedule_entrants_resync()
 
     print(f"✅ Bot online come {bot.user} — prossima edizione: {STATE.get('edition')}")
     print(f"✅ Gist attivo: {'sì' if bool(GIST_ID) else 'no'}")
     print(f"✅ Canale lotteria ID: {LOTTERY_CHANNEL_ID or 'auto-primo-canale'}")
+    print(f"✅ Server: {len(bot.guilds)} (home: {home_guild_id()}){' — shard: ' + str(bot.shard_count) if BOT_SHARDED else ''}")
     print(f"✅ Admin extra caricati: {len(ADMIN_IDS)}")
     print(f"✅ Automazione: {automation_label()} — Modalità: {mode_label(STATE.get('lottery_mode', 'classic'))}")
-    print(f"✅ Finestra automazione: primi {AUTO_WINDOW_MINUTES} minuti utili dell'ora target")
+    nxt = STATE.get("auto_next_fire")
+    if nxt:
+        print(f"✅ Prossimo evento automatico: {nxt['event']} alle {datetime.fromtimestamp(nxt['ts'], TZ):%d/%m %H:%M}")
 
-    try:
-        await catch_up_automation_now()
-    except Exception as e:
-        print("[AUTO] Errore catch-up on_ready:", e)
+@bot.event
+async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
+    if str(payload.emoji) != "✅" or payload.guild_id is None:
+        return
+    CURRENT_GUILD.set(payload.guild_id)
+    member = payload.member
+    if track_entrant(payload.message_id, payload.user_id, bool(member and member.bot), added=True) and member:
+        cache_name(payload.user_id, member.display_name)
+
+@bot.event
+async def on_member_join(member: discord.Member):
+    CURRENT_GUILD.set(member.guild.id)
+    cache_name(member.id, member.display_name)
+
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    if before.display_name != after.display_name:
+        CURRENT_GUILD.set(after.guild.id)
+        cache_name(after.id, after.display_name)
+
+@bot.event
+async def on_raw_reaction_remove(payload: discord.RawReactionActionEvent):
+    if str(payload.emoji) == "✅" and payload.guild_id is not None:
+        CURRENT_GUILD.set(payload.guild_id)
+        track_entrant(payload.message_id, payload.user_id, False, added=False)
 
 # ---------- Comandi test modificatori ----------
 
@@ -1067,9 +3709,11 @@ async def on_ready():
     app_commands.Choice(name="Strength (STR)", value=MOD_STR),
 ])
 async def slash_testmodificatore(inter: discord.Interaction, elemento: app_commands.Choice[str]):
-    STATE["test_override_modifier"] = elemento.value
-    save_state(force=True)
-    await inter.response.send_message(
+    await inter.response.defer(ephemeral=True, thinking=True)
+    async with lottery_txn():
+        gstate(create=True)["test_override_modifier"] = elemento.value
+        save_state(force=True)
+    await inter.followup.send(
         f"🧪 TEST attivo: la prossima apertura **classica** userà **{modifier_label(elemento.value)}**.\n"
         f"Per tornare casuale: **/testoff**",
         ephemeral=True
@@ -1078,9 +3722,11 @@ async def slash_testmodificatore(inter: discord.Interaction, elemento: app_comma
 @bot.tree.command(name="testoff", description="Disattiva il test override e torna al casuale settimanale (solo admin).")
 @admin_only_command()
 async def slash_testoff(inter: discord.Interaction):
-    STATE["test_override_modifier"] = None
-    save_state(force=True)
-    await inter.response.send_message(
+    await inter.response.defer(ephemeral=True, thinking=True)
+    async with lottery_txn():
+        gstate(create=True)["test_override_modifier"] = None
+        save_state(force=True)
+    await inter.followup.send(
         "✅ Test disattivato. Da ora la prossima apertura **classica** usa il modificatore **casuale settimanale**.",
         ephemeral=True
     )
@@ -1096,21 +3742,21 @@ async def slash_whoami(inter: discord.Interaction):
 @bot.tree.command(name="mostraedizione", description="Mostra la PROSSIMA edizione che verrà aperta.")
 @admin_only_command()
 async def slash_mostraedizione(inter: discord.Interaction):
-    ed = STATE.get("edition", 1)
+    ed = lottery_state().get("edition", 1)
     await inter.response.send_message(f"🧾 **Prossima edizione da aprire:** n°{ed}", ephemeral=True)
 
 @bot.tree.command(name="stato", description="Mostra lo stato attuale della lotteria e dell'automazione (solo admin).")
 @admin_only_command()
 async def slash_stato(inter: discord.Interaction):
-    open_msg = STATE.get("open_message_id")
+    open_msg = lottery_state().get("open_message_id")
     current_week = week_key(now_tz())
-    mode = STATE.get("lottery_mode", "classic")
-    auto_enabled = STATE.get("automation_enabled", True)
-    current_active_modifier = STATE.get("active_modifier")
+    mode = gstate().get("lottery_mode", "classic")
+    auto_enabled = gstate().get("automation_enabled", True)
+    current_active_modifier = lottery_state().get("active_modifier")
     future_modifier = get_future_effective_modifier()
 
     desc = [
-        f"🧾 **Prossima edizione:** {STATE.get('edition', 1)}",
+        f"🧾 **Prossima edizione:** {lottery_state().get('edition', 1)}",
         f"📬 **Lotteria aperta:** {'Sì' if open_msg else 'No'}",
         f"🗓️ **Settimana corrente:** {current_week}",
         f"🎭 **Modalità attiva:** {mode_label(mode)}",
@@ -1126,18 +3772,21 @@ async def slash_stato(inter: discord.Interaction):
         ]
     else:
         desc += [
-            f"⚙️ **Weekly modifier:** {modifier_label(STATE.get('weekly_modifier'))}",
-            f"🧪 **Override test:** {modifier_label(STATE.get('test_override_modifier')) if STATE.get('test_override_modifier') else 'Nessuno'}",
+            f"⚙️ **Weekly modifier:** {modifier_label(gstate().get('weekly_modifier'))}",
+            f"🧪 **Override test:** {modifier_label(gstate().get('test_override_modifier')) if gstate().get('test_override_modifier') else 'Nessuno'}",
             f"🎯 **Modifier apertura corrente:** {modifier_label(current_active_modifier)}",
+            f"🏆 **Vincitori per edizione:** {gstate().get('winner_count', 1)} (×2 con CHANCE)",
             f"🔮 **Prossimo modificatore effettivo:** {modifier_label(future_modifier)}",
             "🔮 **Prossima apertura automatica:** CLASSICA" if auto_enabled else "🔮 **Prossima apertura automatica:** disattivata",
         ]
 
     desc += [
-        f"📤 **Ultima apertura auto:** {STATE.get('last_open_week') or 'mai'}",
-        f"🔒 **Ultima chiusura auto:** {STATE.get('last_close_week') or 'mai'}",
-        f"📣 **Ultimo annuncio auto:** {STATE.get('last_announce_week') or 'mai'}",
-        f"👥 **Utenti registrati:** {len(STATE.get('wins', {}))}",
+        f"📤 **Ultima apertura auto:** {lottery_state().get('last_open_week') or 'mai'}",
+        f"🔒 **Ultima chiusura auto:** {lottery_state().get('last_close_week') or 'mai'}",
+        f"📣 **Ultimo annuncio auto:** {lottery_state().get('last_announce_week') or 'mai'}",
+        f"⏭️ **Prossimo evento auto:** {auto_next_fire_label()}",
+        f"👥 **Utenti registrati:** {guild_players().registered_count()}",
+        f"🏰 **Server:** {'principale' if gstate() is STATE else 'namespace dedicato'} ({len(bot.guilds)} collegati)",
         "",
     ]
     desc += auto_schedule_status_lines()
@@ -1147,6 +3796,76 @@ async def slash_stato(inter: discord.Interaction):
         ephemeral=True
     )
 
+@bot.tree.command(name="ritardi", description="Ritardo del loop del bot e ultimi blocchi rilevati (solo admin).")
+@admin_only_command()
+async def slash_ritardi(inter: discord.Interaction):
+    lag = loop_lag_summary()
+    desc = [
+        f"⏱️ **Ritardo loop** (ultimi {lag['samples']} campioni): "
+        f"p50 {lag['p50'] * 1000:.0f} ms · p95 {lag['p95'] * 1000:.0f} ms · max {lag['max'] * 1000:.0f} ms",
+        f"🚨 **Soglia blocco:** {LOOP_BLOCK_THRESHOLD * 1000:.0f} ms — blocchi registrati: **{len(LOOP_BLOCKS)}**",
+    ]
+    for block in list(LOOP_BLOCKS)[-3:][::-1]:
+        when = datetime.fromtimestamp(block.ts, TZ)
+        stack = "\n".join(block.stack[-6:])
+        desc.append(
+            f"\n**{when:%d/%m %H:%M:%S}** — bloccato **{block.blocked:.2f}s** (task {block.task})\n"
+            f"```\n{stack}\n```"
+        )
+    if not LOOP_BLOCKS:
+        desc.append("\n✅ Nessun blocco sopra soglia dall'avvio.")
+    await inter.response.send_message(
+        embed=imperial_embed("DIAGNOSTICA LOOP", "\n".join(desc)[:4000], color=GOLD),
+        ephemeral=True,
+    )
+
+def _fmt_ms(ms: float) -> str:
+    return f"{ms / 1000:.2f}s" if ms >= 1000 else f"{ms:.0f}ms"
+
+@bot.tree.command(name="profilo", description="Tempi per fase delle ultime edizioni (solo admin).")
+@app_commands.describe(edizioni="Quante edizioni mostrare (1-10, default 5)")
+@admin_only_command()
+async def slash_profilo(inter: discord.Interaction, edizioni: int = 5):
+    if not TRACE_ENABLED:
+        await inter.response.send_message("⚠️ Tracciamento disattivato (TRACE_ENABLED=false).", ephemeral=True)
+        return
+    n = max(1, min(10, edizioni))
+    traces = read_trace_editions(inter.guild_id or home_guild_id() or 0, n)
+    if not traces:
+        await inter.response.send_message("📜 Nessuna edizione tracciata finora.", ephemeral=True)
+        return
+
+    desc: List[str] = []
+    totals: Dict[str, List[float]] = {}
+    for spans in traces:
+        head = spans[-1]
+        mods = {s.get("modifier") for s in spans if s.get("modifier")}
+        desc.append(
+            f"**Ed. {head['edition']}** ({head['lottery']}, {head['week']}) — "
+            f"{mode_label(head['mode'])}{' · ' + ', '.join(sorted(mods)) if mods else ''}"
+        )
+        # le fasi (span radice) con i sotto-span più lenti
+        for root in (s for s in spans if s.get("parent") is None):
+            children = sorted(
+                (s for s in spans if s.get("stage") == root["stage"] and s.get("parent") is not None and s["ts"] >= root["ts"]),
+                key=lambda s: -s["ms"],
+            )[:3]
+            detail = " · ".join(f"{c['span']} {_fmt_ms(c['ms'])}" for c in children)
+            err = " ❌" if root.get("error") else ""
+            desc.append(f"• {root['stage']}: **{_fmt_ms(root['ms'])}**{err}{' — ' + detail if detail else ''}")
+        for s in spans:
+            totals.setdefault(s["span"], []).append(s["ms"])
+        desc.append("")
+
+    desc.append("**Media / max per span:**")
+    for name, vals in sorted(totals.items(), key=lambda kv: -max(kv[1])):
+        desc.append(f"`{name}` {_fmt_ms(sum(vals) / len(vals))} / {_fmt_ms(max(vals))}")
+
+    await inter.response.send_message(
+        embed=imperial_embed(f"PROFILO ULTIME {len(traces)} EDIZIONI", "\n".join(desc)[:4000], color=GOLD),
+        ephemeral=True,
+    )
+
 @bot.tree.command(name="automazione", description="Attiva o disattiva l'automazione settimanale (solo admin).")
 @admin_only_command()
 @app_commands.describe(stato="on oppure off")
@@ -1155,14 +3874,26 @@ async def slash_stato(inter: discord.Interaction):
     app_commands.Choice(name="OFF", value="off"),
 ])
 async def slash_automazione(inter: discord.Interaction, stato: app_commands.Choice[str]):
-    new_state = (stato.value == "on")
-    STATE["automation_enabled"] = new_state
-    save_state(force=True)
-    await inter.response.send_message(
+    await inter.response.defer(ephemeral=True, thinking=True)
+    async with lottery_txn():
+        new_state = (stato.value == "on")
+        gstate(create=True)["automation_enabled"] = new_state
+        save_state(force=True)
+    await inter.followup.send(
         f"🤖 Automazione impostata su **{automation_label()}**.",
         ephemeral=True
     )
 
+@bot.tree.command(name="canale", description="Imposta il canale della lotteria per questo server (solo admin).")
+@admin_only_command()
+@app_commands.describe(canale="Canale testuale in cui pubblicare aperture, chiusure e annunci")
+async def slash_canale(inter: discord.Interaction, canale: discord.TextChannel):
+    await inter.response.defer(ephemeral=True, thinking=True)
+    async with lottery_txn():
+        gstate(create=True)["channel_id"] = canale.id
+        save_state(force=True)
+    await inter.followup.send(f"📌 Canale lotteria impostato su {canale.mention}.", ephemeral=True)
+
 @bot.tree.command(name="modalita", description="Imposta la modalità settimanale automatica: classica o speciale (solo admin).")
 @admin_only_command()
 @app_commands.describe(tipo="classica oppure speciale")
@@ -1171,16 +3902,20 @@ async def slash_automazione(inter: discord.Interaction, stato: app_commands.Choi
     app_commands.Choice(name="SPECIALE", value="special"),
 ])
 async def slash_modalita(inter: discord.Interaction, tipo: app_commands.Choice[str]):
-    if STATE.get("open_message_id"):
-        await inter.response.send_message(
+    await inter.response.defer(ephemeral=True, thinking=True)
+    async with lottery_txn():
+        is_open = bool(lottery_state().get("open_message_id"))
+        if not is_open:
+            gstate(create=True)["lottery_mode"] = tipo.value
+            save_state(force=True)
+
+    if is_open:
+        await inter.followup.send(
             "❌ Non puoi cambiare modalità mentre una lotteria è già aperta.",
             ephemeral=True
         )
         return
 
-    STATE["lottery_mode"] = tipo.value
-    save_state(force=True)
-
     if tipo.value == "special":
         msg = (
             "🎭 Modalità automatica impostata su **SPECIALE**.\n"
@@ -1190,7 +3925,7 @@ async def slash_modalita(inter: discord.Interaction, tipo: app_commands.Choice[s
     else:
         msg = "🎭 Modalità automatica impostata su **CLASSICA**."
 
-    await inter.response.send_message(msg, ephemeral=True)
+    await inter.followup.send(msg, ephemeral=True)
 
 # ---------- Comandi livelli ----------
 
@@ -1203,34 +3938,26 @@ async def slash_mostralivelli(inter: discord.Interaction):
 
     await inter.response.defer(ephemeral=True, thinking=True)
 
-    wins = STATE.get("wins", {})
-    if not wins:
+    total = guild_players().registered_count()
+    if not total:
         await inter.followup.send("📜 Nessun livello registrato al momento.", ephemeral=True)
         return
 
-    items = sorted(wins.items(), key=lambda x: (-int(x[1]), int(x[0])))
-
-    lines = []
-    for uid, lvl in items:
-        uid_int = int(uid)
-        lvl_int = max(1, min(3, int(lvl)))
-        member = inter.guild.get_member(uid_int)
-        if member:
-            remember_name(uid_int, member.display_name)
-            name = member.display_name
-        else:
-            name = name_fallback(uid_int)
-        lines.append(f"• **{name}** — Livello: **{lvl_int}**")
-
     page_size = 20
-    pages = [lines[i:i + page_size] for i in range(0, len(lines), page_size)]
-    for idx, page in enumerate(pages, start=1):
-        embed = imperial_embed(
-            f"REGISTRO LIVELLI (corrente) — Pag. {idx}/{len(pages)}",
-            "\n".join(page),
+    n_pages = (total + page_size - 1) // page_size
+    embeds = []
+    for idx in range(1, n_pages + 1):
+        lines = []
+        for rec in guild_players().leaderboard((idx - 1) * page_size, page_size):
+            lvl_int = max(1, min(3, rec.level))
+            name = display_name_for(inter.guild, rec.uid)
+            lines.append(f"• **{name}** — Livello: **{lvl_int}**")
+        embeds.append(imperial_embed(
+            f"REGISTRO LIVELLI (corrente) — Pag. {idx}/{n_pages}",
+            "\n".join(lines),
             color=GOLD
-        )
-        await inter.followup.send(embed=embed, ephemeral=True)
+        ))
+    await send_embeds(inter.followup.send, embeds, ephemeral=True)
 
 @bot.tree.command(name="pubblicalivelli", description="Pubblica nel canale lotteria la classifica livelli (solo admin).")
 @admin_only_command()
@@ -1246,33 +3973,24 @@ async def slash_pubblicalivelli(inter: discord.Interaction):
         await inter.followup.send("⚠️ Canale lotteria non trovato.", ephemeral=True)
         return
 
-    wins = STATE.get("wins", {})
-    if not wins:
+    total = guild_players().registered_count()
+    if not total:
         await inter.followup.send("📜 Nessun livello registrato al momento.", ephemeral=True)
         return
 
-    items = sorted(wins.items(), key=lambda x: (-int(x[1]), int(x[0])))
-
     lines = []
     max_public = 30
-    for uid, lvl in items[:max_public]:
-        uid_int = int(uid)
-        lvl_int = max(1, min(3, int(lvl)))
-        member = inter.guild.get_member(uid_int)
-        if member:
-            remember_name(uid_int, member.display_name)
-            name = member.display_name
-        else:
-            name = name_fallback(uid_int)
+    for rec in guild_players().leaderboard(0, max_public):
+        lvl_int = max(1, min(3, rec.level))
+        name = display_name_for(inter.guild, rec.uid)
         lines.append(f"• **{name}** — Livello **{lvl_int}**")
 
-    more = max(0, len(items) - max_public)
+    more = max(0, total - max_public)
     desc = "📜 **Classifica Livelli (Top):**\n" + "\n".join(lines)
     if more > 0:
         desc += f"\n\n…e altri **{more}**."
 
     await ch.send(embed=imperial_embed("ALBO IMPERIALE — LIVELLI", desc, color=GOLD))
-    save_state()
     await inter.followup.send("✅ Classifica pubblicata nel canale lotteria.", ephemeral=True)
 
 # ---------- Comandi gestione stato ----------
@@ -1284,9 +4002,28 @@ async def slash_setedition(inter: discord.Interaction, numero: int):
     if numero < 1:
         await inter.response.send_message("❌ L'edizione deve essere ≥ 1.", ephemeral=True)
         return
-    STATE["edition"] = int(numero)
-    save_state(force=True)
-    await inter.response.send_message(f"✅ Prossima edizione impostata a **{numero}**.", ephemeral=True)
+    await inter.response.defer(ephemeral=True, thinking=True)
+    async with lottery_txn():
+        lottery_state(create=True)["edition"] = int(numero)
+        save_state(force=True)
+    await inter.followup.send(f"✅ Prossima edizione impostata a **{numero}**.", ephemeral=True)
+
+@bot.tree.command(name="vincitori", description="Imposta quanti vincitori estrarre nelle edizioni classiche (solo admin).")
+@admin_only_command()
+@app_commands.describe(numero=f"Vincitori per edizione (1–{MAX_WINNERS}). Con l'elemento CHANCE il numero raddoppia.")
+async def slash_vincitori(inter: discord.Interaction, numero: int):
+    if numero < 1 or numero > MAX_WINNERS:
+        await inter.response.send_message(f"❌ Il numero di vincitori deve essere tra 1 e {MAX_WINNERS}.", ephemeral=True)
+        return
+    await inter.response.defer(ephemeral=True, thinking=True)
+    async with lottery_txn():
+        gstate(create=True)["winner_count"] = int(numero)
+        save_state(force=True)
+    await inter.followup.send(
+        f"🏆 Vincitori per edizione classica impostati a **{numero}** "
+        f"(con CHANCE: **{numero * 2}**).",
+        ephemeral=True
+    )
 
 @bot.tree.command(name="setlivello", description="Imposta manualmente il livello (1–3) di un utente (solo admin).")
 @admin_only_command()
@@ -1296,14 +4033,16 @@ async def slash_setlivello(inter: discord.Interaction, utente: discord.Member, l
         await inter.response.send_message("❌ Il livello deve essere tra 1 e 3.", ephemeral=True)
         return
 
-    uid = str(utente.id)
-    remember_name(utente.id, utente.display_name)
-    set_level(uid, livello)
-    save_state(force=True)
+    await inter.response.defer(ephemeral=True, thinking=True)
+    async with lottery_txn():
+        remember_name(utente.id, utente.display_name)
+        set_level(utente.id, livello)
+        save_state(force=True)
 
-    tot = int(STATE.get("victories", {}).get(uid, 0))
-    cyc = int(STATE.get("cycles", {}).get(uid, 0))
-    await inter.response.send_message(
+        rec = guild_players().ensure(utente.id)
+        tot = rec.victories
+        cyc = rec.cycles
+    await inter.followup.send(
         f"✅ Impostato **livello {livello}** per **{utente.display_name}** "
         f"(vittorie totali: {tot}, cicli: {cyc}).",
         ephemeral=True
@@ -1313,9 +4052,11 @@ async def slash_setlivello(inter: discord.Interaction, utente: discord.Member, l
 @admin_only_command()
 @app_commands.describe(utente="Utente da cancellare dalla memoria vincitori")
 async def slash_rimuoviwinner(inter: discord.Interaction, utente: discord.Member):
-    clear_user_state(str(utente.id))
-    save_state(force=True)
-    await inter.response.send_message(
+    await inter.response.defer(ephemeral=True, thinking=True)
+    async with lottery_txn():
+        clear_user_state(utente.id)
+        save_state(force=True)
+    await inter.followup.send(
         f"🧹 **{utente.display_name}** rimosso dalla memoria dei vincitori.",
         ephemeral=True
     )
@@ -1324,9 +4065,11 @@ async def slash_rimuoviwinner(inter: discord.Interaction, utente: discord.Member
 @admin_only_command()
 @app_commands.describe(utente="Utente da cancellare dalla memoria vincitori")
 async def slash_removewinner(inter: discord.Interaction, utente: discord.Member):
-    clear_user_state(str(utente.id))
-    save_state(force=True)
-    await inter.response.send_message(
+    await inter.response.defer(ephemeral=True, thinking=True)
+    async with lottery_txn():
+        clear_user_state(utente.id)
+        save_state(force=True)
+    await inter.followup.send(
         f"🧹 **{utente.display_name}** rimosso dalla memoria dei vincitori.",
         ephemeral=True
     )
@@ -1342,11 +4085,12 @@ async def slash_apertura(inter: discord.Interaction):
         await inter.followup.send("❌ Questo comando funziona solo dentro un server.", ephemeral=True)
         return
 
-    ed = int(STATE.get("edition", 1))
-    await open_lottery(inter.guild, special=False)
+    async with lottery_txn():
+        ed = int(lottery_state().get("edition", 1))
+        await open_lottery(inter.guild, special=False)
 
-    STATE["edition"] = ed + 1
-    save_state(force=True)
+        lottery_state(create=True)["edition"] = ed + 1
+        save_state(force=True)
     await inter.followup.send(f"📜 Apertura **classica** eseguita (edizione n°{ed}).", ephemeral=True)
 
 @bot.tree.command(name="chiusura", description="Chiude e seleziona il vincitore (lotteria CLASSICA, solo admin).")
@@ -1358,9 +4102,10 @@ async def slash_chiusura(inter: discord.Interaction):
         await inter.followup.send("❌ Questo comando funziona solo dentro un server.", ephemeral=True)
         return
 
-    await close_and_pick(inter.guild, announce_now=False, special=False)
-    STATE["last_close_week"] = week_key(now_tz())
-    save_state(force=True)
+    async with lottery_txn():
+        await close_and_pick(inter.guild, announce_now=False, special=False)
+        lottery_state(create=True)["last_close_week"] = week_key(now_tz())
+        save_state(force=True)
     await inter.followup.send("🗝️ Chiusura **classica** eseguita.", ephemeral=True)
 
 @bot.tree.command(name="annuncio", description="Annuncia il vincitore (lotteria CLASSICA, solo admin).")
@@ -1377,14 +4122,16 @@ async def slash_annuncio(inter: discord.Interaction):
         await inter.followup.send("⚠️ Canale lotteria non trovato.", ephemeral=True)
         return
 
-    await post_winner_announcement_classic(ch, inter.guild)
+    async with lottery_txn():
+        await post_winner_announcement_classic(ch, inter.guild)
 
-    STATE["last_announce_week"] = week_key(now_tz())
-    STATE["last_winner_id"] = None
-    STATE["last_winner_ids"] = []
-    STATE["last_winner_prev_levels"] = {}
-    STATE["last_winner_reset_flags"] = {}
-    save_state(force=True)
+        ls = lottery_state(create=True)
+        ls["last_announce_week"] = week_key(now_tz())
+        ls["last_winner_id"] = None
+        ls["last_winner_ids"] = []
+        ls["last_winner_prev_levels"] = {}
+        ls["last_winner_reset_flags"] = {}
+        save_state(force=True)
     await inter.followup.send("📣 Annuncio **classico** eseguito.", ephemeral=True)
 
 # ---------- Comandi lotteria speciale ----------
@@ -1398,11 +4145,12 @@ async def slash_aperturaspeciale(inter: discord.Interaction):
         await inter.followup.send("❌ Questo comando funziona solo dentro un server.", ephemeral=True)
         return
 
-    ed = int(STATE.get("edition", 1))
-    await open_lottery(inter.guild, special=True)
+    async with lottery_txn():
+        ed = int(lottery_state().get("edition", 1))
+        await open_lottery(inter.guild, special=True)
 
-    STATE["edition"] = ed + 1
-    save_state(force=True)
+        lottery_state(create=True)["edition"] = ed + 1
+        save_state(force=True)
     await inter.followup.send(f"💎 Apertura **SPECIALE** eseguita (edizione n°{ed}).", ephemeral=True)
 
 @bot.tree.command(name="chiusuraspeciale", description="Chiude e seleziona il vincitore (EDIZIONE SPECIALE, solo admin).")
@@ -1414,9 +4162,10 @@ async def slash_chiusuraspeciale(inter: discord.Interaction):
         await inter.followup.send("❌ Questo comando funziona solo dentro un server.", ephemeral=True)
         return
 
-    await close_and_pick(inter.guild, announce_now=False, special=True)
-    STATE["last_close_week"] = week_key(now_tz())
-    save_state(force=True)
+    async with lottery_txn():
+        await close_and_pick(inter.guild, announce_now=False, special=True)
+        lottery_state(create=True)["last_close_week"] = week_key(now_tz())
+        save_state(force=True)
     await inter.followup.send("🗝️ Chiusura **SPECIALE** eseguita.", ephemeral=True)
 
 @bot.tree.command(name="annunciospeciale", description="Annuncia il vincitore (EDIZIONE SPECIALE, solo admin).")
@@ -1433,15 +4182,17 @@ async def slash_annunciospeciale(inter: discord.Interaction):
         await inter.followup.send("⚠️ Canale lotteria non trovato.", ephemeral=True)
         return
 
-    lw = STATE.get("last_winner_id")
-    winner_id = int(lw) if lw else None
-    await post_winner_announcement_special(ch, inter.guild, winner_id)
+    async with lottery_txn():
+        lw = lottery_state().get("last_winner_id")
+        winner_id = int(lw) if lw else None
+        await post_winner_announcement_special(ch, inter.guild, winner_id)
 
-    STATE["last_announce_week"] = week_key(now_tz())
-    STATE["last_winner_id"] = None
-    STATE["last_winner_ids"] = []
-    STATE["last_special_prize"] = None
-    save_state(force=True)
+        ls = lottery_state(create=True)
+        ls["last_announce_week"] = week_key(now_tz())
+        ls["last_winner_id"] = None
+        ls["last_winner_ids"] = []
+        ls["last_special_prize"] = None
+        save_state(force=True)
     await inter.followup.send("📣 Annuncio **SPECIALE** eseguito.", ephemeral=True)
 
 # ---------- Comandi test automazione ----------
@@ -1458,16 +4209,17 @@ async def slash_testautoapertura(inter: discord.Interaction, minuti: int):
         return
 
     async def _runner():
-        special = (STATE.get("lottery_mode", "classic") == "special")
-        ed = int(STATE.get("edition", 1))
-        await open_lottery(inter.guild, special=special)
-        STATE["edition"] = ed + 1
-        save_state(force=True)
+        async with lottery_txn():
+            special = (gstate().get("lottery_mode", "classic") == "special")
+            ed = int(lottery_state().get("edition", 1))
+            await open_lottery(inter.guild, special=special)
+            lottery_state(create=True)["edition"] = ed + 1
+            save_state(force=True)
 
     schedule_test_task("open", minuti, _runner)
     await inter.response.send_message(
         f"⏰ Test apertura automatica programmato tra **{minuti} minuti** "
-        f"(modalità {mode_label(STATE.get('lottery_mode', 'classic'))}).",
+        f"(modalità {mode_label(gstate().get('lottery_mode', 'classic'))}).",
         ephemeral=True
     )
 
@@ -1483,13 +4235,14 @@ async def slash_testautochiusura(inter: discord.Interaction, minuti: int):
         return
 
     async def _runner():
-        special = (STATE.get("lottery_mode", "classic") == "special")
-        await close_and_pick(inter.guild, announce_now=False, special=special)
+        async with lottery_txn():
+            special = (gstate().get("lottery_mode", "classic") == "special")
+            await close_and_pick(inter.guild, announce_now=False, special=special)
 
     schedule_test_task("close", minuti, _runner)
     await inter.response.send_message(
         f"⏰ Test chiusura automatica programmato tra **{minuti} minuti** "
-        f"(modalità {mode_label(STATE.get('lottery_mode', 'classic'))}).",
+        f"(modalità {mode_label(gstate().get('lottery_mode', 'classic'))}).",
         ephemeral=True
     )
 
@@ -1505,22 +4258,23 @@ async def slash_testautoannuncio(inter: discord.Interaction, minuti: int):
         return
 
     async def _runner():
-        ch = await get_lottery_channel(inter.guild)
-        if not ch:
-            return
-
-        special = (STATE.get("lottery_mode", "classic") == "special")
-        if special:
-            lw = STATE.get("last_winner_id")
-            winner_id = int(lw) if lw else None
-            await post_winner_announcement_special(ch, inter.guild, winner_id)
-        else:
-            await post_winner_announcement_classic(ch, inter.guild)
+        async with lottery_txn():
+            ch = await get_lottery_channel(inter.guild)
+            if not ch:
+                return
+
+            special = (gstate().get("lottery_mode", "classic") == "special")
+            if special:
+                lw = lottery_state().get("last_winner_id")
+                winner_id = int(lw) if lw else None
+                await post_winner_announcement_special(ch, inter.guild, winner_id)
+            else:
+                await post_winner_announcement_classic(ch, inter.guild)
 
     schedule_test_task("announce", minuti, _runner)
     await inter.response.send_message(
         f"⏰ Test annuncio automatico programmato tra **{minuti} minuti** "
-        f"(modalità {mode_label(STATE.get('lottery_mode', 'classic'))}).",
+        f"(modalità {mode_label(gstate().get('lottery_mode', 'classic'))}).",
         ephemeral=True
     )
 
@@ -1533,10 +4287,178 @@ async def slash_annullatestauto(inter: discord.Interaction):
         ephemeral=True
     )
 
+# ---------- Simulazione ----------
+
+# python3 main.py simulate --weeks 520 --users 1000: riproduce N edizioni
+# classiche su una popolazione sintetica con lo stesso motore del bot (pesi,
+# modificatori settimanali, livelli, premi) su uno STATE solo in memoria.
+# Nessuna connessione a Discord né al Gist.
+
+WEEK_SECONDS = 7 * 86400
+
+def _percentile(sorted_vals: List[float], q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(round(q * (len(sorted_vals) - 1))))]
+
+def _gini(values: List[float]) -> float:
+    vals = sorted(values)
+    n, total = len(vals), sum(vals)
+    if n == 0 or total <= 0:
+        return 0.0
+    cum = sum((i + 1) * v for i, v in enumerate(vals))
+    return (2.0 * cum) / (n * total) - (n + 1.0) / n
+
+def simulate_editions(
+    weeks: int,
+    users: int,
+    turnout: float = 0.5,
+    winner_count: int = 1,
+    seed: Optional[int] = None,
+    engine: Optional[str] = None,
+) -> Dict:
+    """
+    Simula `weeks` edizioni classiche con `users` utenti sintetici, ognuno dei
+    quali partecipa con probabilità `turnout`. Sostituisce STATE con uno stato
+    vuoto in memoria: da usare solo fuori dal bot.
+    """
+    global STATE, DRAW_ENGINE, _NP_RNG
+    random.seed(seed)
+    if np is not None:
+        _NP_RNG = np.random.default_rng(seed)
+    if engine:
+        DRAW_ENGINE = engine
+    STATE = StateDict(_normalize_state(copy.deepcopy(DEFAULT_STATE)))
+    gstate(create=True)["winner_count"] = max(1, min(MAX_WINNERS, winner_count))
+
+    records = STATE.players.records
+    population = range(1, users + 1)
+    wins = [0] * (users + 1)
+    exposure = [0.0] * (users + 1)
+    level_entries = {1: 0, 2: 0, 3: 0}
+    level_wins = {1: 0, 2: 0, 3: 0}
+    modifiers: Dict[str, int] = {}
+    payout: Dict[str, int] = {}
+    draw_times: List[float] = []
+    entries = 0
+    clock = float(int(time.time()))
+
+    for _ in range(weeks):
+        mod = pick_weekly_modifier()
+        modifiers[mod] = modifiers.get(mod, 0) + 1
+        participants = [u for u in population if random.random() < turnout]
+        if not participants:
+            clock += WEEK_SECONDS
+            continue
+        entries += len(participants)
+        for u in participants:
+            rec = records.get(u)
+            level_entries[rec.level if rec is not None and rec.level else 1] += 1
+
+        ls = {"last_winner_prev_levels": {}, "last_winner_reset_flags": {}}
+        t0 = time.perf_counter()
+        winners = draw_classic_winners(participants, mod, ls, now=clock)
+        draw_times.append(time.perf_counter() - t0)
+
+        share = len(winners) / len(participants)
+        for u in participants:
+            exposure[u] += share
+        for wid in winners:
+            prev = ls["last_winner_prev_levels"][str(wid)]
+            wins[wid] += 1
+            level_wins[prev] += 1
+            payout[mod] = payout.get(mod, 0) + classic_prize_amount(mod, prev)
+            records[wid].last_win = int(clock)   # orologio simulato, non time.time()
+        clock += WEEK_SECONDS
+
+    ratios = sorted(wins[u] / exposure[u] for u in population if exposure[u] > 0)
+    players = [u for u in population if exposure[u] > 0]
+    final_levels = {1: 0, 2: 0, 3: 0}
+    for u in population:
+        final_levels[get_level(u)] += 1
+    total_wins = sum(level_wins.values())
+    times_ms = sorted(t * 1000.0 for t in draw_times)
+    avg_participants = entries / len(draw_times) if draw_times else 0.0
+
+    return {
+        "weeks": weeks,
+        "users": users,
+        "turnout": turnout,
+        "draws": len(draw_times),
+        "avg_participants": round(avg_participants, 1),
+        "engine": "numpy" if _use_numpy(int(avg_participants)) else "python",
+        "modifiers": modifiers,
+        "fairness": {
+            # vittorie osservate / vittorie attese con estrazione uniforme
+            "ratio_p10": round(_percentile(ratios, 0.10), 3),
+            "ratio_p50": round(_percentile(ratios, 0.50), 3),
+            "ratio_p90": round(_percentile(ratios, 0.90), 3),
+            "gini_wins": round(_gini([wins[u] for u in players]), 4),
+            "never_won": sum(1 for u in players if not wins[u]),
+            "win_rate_by_level": {
+                lvl: round(level_wins[lvl] / level_entries[lvl], 6) if level_entries[lvl] else 0.0
+                for lvl in (1, 2, 3)
+            },
+            "win_rate_overall": round(total_wins / entries, 6) if entries else 0.0,
+        },
+        "final_levels": final_levels,
+        "payout": {
+            "total": sum(payout.values()),
+            "per_week": int(sum(payout.values()) / weeks) if weeks else 0,
+            "by_modifier": payout,
+        },
+        "draw_ms": {
+            "mean": round(sum(times_ms) / len(times_ms), 3) if times_ms else 0.0,
+            "p50": round(_percentile(times_ms, 0.50), 3),
+            "p95": round(_percentile(times_ms, 0.95), 3),
+            "max": round(times_ms[-1], 3) if times_ms else 0.0,
+        },
+    }
+
+def _print_simulation(r: Dict):
+    f = r["fairness"]
+    print(f"[SIM] {r['weeks']} edizioni, {r['users']} utenti, affluenza {r['turnout']:.0%}, "
+          f"media {r['avg_participants']} partecipanti, motore {r['engine']}")
+    print("[SIM] Modificatori: " + ", ".join(f"{m} {n}" for m, n in sorted(r["modifiers"].items())))
+    print(f"[SIM] Equità (vinte/attese uniformi): p10 {f['ratio_p10']} · p50 {f['ratio_p50']} · p90 {f['ratio_p90']}"
+          f" · Gini {f['gini_wins']} · mai vinto {f['never_won']}")
+    print("[SIM] Tasso di vittoria per livello: "
+          + ", ".join(f"L{lvl} {rate:.4%}" for lvl, rate in f["win_rate_by_level"].items())
+          + f" (medio {f['win_rate_overall']:.4%})")
+    print("[SIM] Livelli finali: " + ", ".join(f"L{lvl} {n}" for lvl, n in r["final_levels"].items()))
+    p = r["payout"]
+    print(f"[SIM] Kama pagati: {fmt_kama(p['total'])} ({fmt_kama(p['per_week'])}/settimana) — "
+          + ", ".join(f"{m} {fmt_kama(n)}" for m, n in sorted(p["by_modifier"].items())))
+    d = r["draw_ms"]
+    print(f"[SIM] Estrazione: media {d['mean']} ms · p50 {d['p50']} ms · p95 {d['p95']} ms · max {d['max']} ms")
+
+def simulate_cli(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="main.py simulate", description="Simulazione offline delle estrazioni classiche.")
+    parser.add_argument("--weeks", type=int, default=520, help="edizioni da simulare (default 520 = 10 anni)")
+    parser.add_argument("--users", type=int, default=1000, help="utenti sintetici (default 1000)")
+    parser.add_argument("--turnout", type=float, default=0.5, help="probabilità di partecipare a ogni edizione")
+    parser.add_argument("--winners", type=int, default=1, help="vincitori base per edizione (come /vincitori)")
+    parser.add_argument("--engine", choices=["auto", "python", "numpy"], default=None, help="motore di estrazione")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", action="store_true", help="stampa il report in JSON")
+    args = parser.parse_args(argv)
+    if args.weeks < 1 or args.users < 1 or not 0.0 < args.turnout <= 1.0:
+        parser.error("servono --weeks >= 1, --users >= 1 e 0 < --turnout <= 1")
+
+    report = simulate_editions(args.weeks, args.users, args.turnout, args.winners, args.seed, args.engine)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print_simulation(report)
+    return 0
+
 # ---------- Avvio ----------
 
 @bot.event
 async def setup_hook():
+    start_persistence()
+    await load_state()
+
     try:
         if not SYNC_ON_START:
             print("ℹ️ Sync slash automatico DISATTIVATO (SYNC_ON_START=false).")
@@ -1554,6 +4476,18 @@ async def setup_hook():
         print("Errore sync comandi:", e)
 
 if __name__ == "__main__":
-    load_state()
+    # python3 main.py migrate-sqlite [stato.json] -> copia lo stato (file o Gist) su SQLite
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate-sqlite":
+        n = asyncio.run(migrate_to_sqlite(sys.argv[2] if len(sys.argv) > 2 else None))
+        print(f"✅ Migrazione completata: {n} utenti scritti in {SQLITE_PATH}")
+        sys.exit(0)
+
+    # python3 main.py simulate [--weeks N --users N ...] -> simulazione offline (vedi simulate_cli)
+    if len(sys.argv) > 1 and sys.argv[1] == "simulate":
+        sys.exit(simulate_cli(sys.argv[2:]))
+
+    if not TOKEN:
+        raise RuntimeError("❌ Manca DISCORD_TOKEN nelle variabili ambiente.")
+    start_metrics_server()
     bot.run(TOKEN)
     